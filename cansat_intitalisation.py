@@ -1,10 +1,14 @@
+import os
 import time
-from machine import Pin, SPI, I2C, UART
+from array import array
+from machine import Pin, SPI, I2C, UART, RTC
 from sdcard import SDCard
+from blockcache import BlockCache, fat_metadata_end
 from rfm69 import RFM69
-from gps import GPS
+from gps import GPS, load_fix
 from ms5611 import MS5611
-from bme280 import BME280
+from flightlog import FlightLog, unpartitioned_tail
+from bme280 import BME280, BME280_OSAMPLE_1, BME280_OSAMPLE_2, BME280_STANDBY_0_5, BME280_IIR_4
 
 class Can:
     def __init__(self):
@@ -37,33 +41,92 @@ class Can:
         
         self.SEALEVEL_PRESSURE = 101325.0
         
+        self.GPS_RING_SIZE = 1024
+        self.GPS_RATE_HZ = 10
+        self.GPS_BAUDRATE = 115200
+        # Fixes kept for GPS.position_at(), 3 s at 10 Hz.
+        self.GPS_HISTORY_SIZE = 30
+        # Time get_gps_data() may spend parsing buffered GPS sentences per
+        # call; raise it when fresh fixes matter more than sampling rate.
+        self.GPS_BUDGET_US = 2000
+        # Last fix, saved every GPS_SAVE_INTERVAL_MS and replayed to the
+        # receiver at boot for a faster first fix; TTFF is logged per boot.
+        self.GPS_FIX_FILE = "/sd/session/gps_fix.bin"
+        self.GPS_TTFF_FILE = "/sd/session/gps_ttff.csv"
+        self.GPS_SAVE_INTERVAL_MS = 60000
+        self.gps_saved_ms = None
+        self.gps_ttff_logged = False
+        
+        
+        # BMP280 in normal mode: T x1, P x2 (humidity unused), 0.5 ms standby
+        # and IIR filter 4, about 125 Hz.
+        self.BMP280_OVERSAMPLING = (BME280_OSAMPLE_1, BME280_OSAMPLE_1, BME280_OSAMPLE_2)
+        self.BMP280_STANDBY = BME280_STANDBY_0_5
+        self.BMP280_IIR = BME280_IIR_4
+        
+        # Calibration of the MS5611 and BMP280, cached so later boots only
+        # check it instead of reading it over I2C again.
+        self.CALIBRATION_FILE = "/sd/calibration.bin"
+        
+        # Blocks for the raw flight log, taken from the space after the last
+        # partition of the card. Without it data goes to the CSV file.
+        self.FLIGHT_LOG_BLOCKS = 65536
+        # Blocks cached in front of the card for the FAT filesystem on /sd,
+        # which keeps rereading its FAT and directory blocks.
+        self.SD_CACHE_SLOTS = 8
+        # SD card SPI clock: initial rate, and the limit for autotuning it
+        # against the last block of the card (spare, after the flight log).
+        # The card and the rate it got are logged per boot.
+        self.SD_BAUDRATE = 1320000
+        self.SD_MAX_BAUDRATE = 25000000
+        self.SD_PROFILE_FILE = "/sd/session/sd_card.csv"
+        # CRC-check every block to and from the card, retrying bad ones,
+        # so a too fast clock shows up as retries rather than bad data.
+        # Autotuning the clock needs it.
+        self.SD_CRC = True
         
         self.BUFFER_SIZE =100
         self.current_filename = "/sd/data.csv"
         
         self.operating_mode = 0
+        # MS5611 oversampling per operating mode (0 pad, 1 ascent, 2 descent):
+        # full resolution on the pad, ~2.3 ms per sample in flight.
+        self.MS5611_OSR_BY_MODE = (4096, 512, 512)
+        # Convert MS5611 temperature once per this many pressure samples
+        # (sooner if it drifts); the others reuse the last one.
+        self.MS5611_TEMPERATURE_EVERY = 4
         
-        # Initialize components
-        self.sd = self.initialize_sd()
+        # Initialize components; the SD card initializes itself while the
+        # radio and GPS, which don't need it, are brought up, and is polled
+        # in between
+        self.sd = self.begin_sd()
         self.rfm = self.initialize_rfm69()
+        self.poll_sd()
         self.gps = self.initialize_gps()
+        self.sd = self.initialize_sd()
+        self.init_session_directory()
+        self.log_sd_profile()
+        self.flight_log = self.initialize_flight_log()
+        self.assist_gps()
         self.ms5611 = self.initialize_ms5611()
         self.bmp280 = self.initialize_bmp280()
-        self.BUFFER = []
+        self.bmp280_result = array("i", [0, 0])
+        self.buffer = []
         
-        self.init_session_directory()
         
-        
-    def initialize_sd(self):
+    def begin_sd(self):
         """
-        Initializes the Micro SD card.
+        Starts initializing the Micro SD card, which then gets ready on its
+        own while other devices are set up; initialize_sd() finishes it.
 
         Returns:
-            SDCard: The Micro SD card object.
+            SDCard: The Micro SD card object, not ready yet.
         """
         try:
-            sd = SDCard(SPI(1, sck=Pin(self.SD_SCK), mosi=Pin(self.SD_MOSI), miso=Pin(self.SD_MISO)), Pin(self.SD_CS))
-            return sd
+            spi = SPI(self.SD_SPI_ID, baudrate=self.SD_BAUDRATE, sck=Pin(self.SD_SCK),
+                      mosi=Pin(self.SD_MOSI), miso=Pin(self.SD_MISO))
+            return SDCard(spi, Pin(self.SD_CS), baudrate=self.SD_BAUDRATE, write_behind=True,
+                          crc=self.SD_CRC, wait=False)
         except OSError as e:
             
             if "no SD card" in str(e):
@@ -72,6 +135,80 @@ class Can:
                 print("Unexpected OSError:", e)
             return None
 
+    def poll_sd(self):
+        """
+        Sends the SD card started by begin_sd() its next initialization
+        command if one is due. Errors are reported by initialize_sd().
+        """
+        if self.sd is None:
+            return
+        try:
+            self.sd.poll()
+        except OSError:
+            pass
+
+    def initialize_sd(self):
+        """
+        Waits for the Micro SD card started by begin_sd() and mounts its
+        filesystem on /sd through a block cache. Writes return while the
+        card is still programming; it is waited for at its next command. The
+        SPI clock is raised to the fastest rate up to SD_MAX_BAUDRATE the
+        card passes a read-back test at, if there is a spare block after the
+        flight log.
+
+        Returns:
+            SDCard: The Micro SD card object.
+        """
+        if self.sd is None:
+            return None
+        sd = self.sd
+        try:
+            sd.finish()
+            first, count = unpartitioned_tail(sd)
+            if self.SD_CRC and count > self.FLIGHT_LOG_BLOCKS:
+                sd.autotune(first + count - 1, self.SD_MAX_BAUDRATE)
+            self.sd_cache = BlockCache(sd, self.SD_CACHE_SLOTS, fat_metadata_end(sd))
+            os.mount(self.sd_cache, "/sd")
+            return sd
+        except OSError as e:
+            print("Error: SD-card:", e)
+            return None
+
+    def log_sd_profile(self):
+        """
+        Appends the SD card in use to SD_PROFILE_FILE: manufacturer id,
+        product name, serial number, sectors, CSD version, SPI clock rate,
+        single block read/write latency in microseconds (None if the clock
+        wasn't autotuned) and the time the card was polled for until it was
+        initialized in ms.
+        """
+        if self.sd is None:
+            return
+        sd = self.sd
+        cid = sd.cid
+        with open(self.SD_PROFILE_FILE, 'a') as f:
+            f.write("{},{},{},{},{},{},{},{},{}\n".format(
+                cid[0], bytes(cid[3:8]).decode(), int.from_bytes(cid[9:13], 'big'),
+                sd.sectors, sd.csd_version, sd.baudrate, sd.read_us, sd.write_us,
+                sd.init_ms))
+
+    def initialize_flight_log(self):
+        """
+        Opens the raw flight log in the FLIGHT_LOG_BLOCKS blocks after the
+        last partition of the SD card, continuing after earlier sessions.
+
+        Returns:
+            FlightLog: The flight log, or None if there is no SD card or no
+            room left after the partitions.
+        """
+        if self.sd is None:
+            return None
+        first, count = unpartitioned_tail(self.sd)
+        if count < self.FLIGHT_LOG_BLOCKS:
+            print("No unpartitioned space for the flight log, logging to", self.current_filename)
+            return None
+        return FlightLog(self.sd, first, self.FLIGHT_LOG_BLOCKS)
+
     def initialize_rfm69(self):
         """
         Initializes the RFM69HCW Transceiver.
@@ -99,37 +236,88 @@ class Can:
 
     def initialize_gps(self):
         """
-        Initializes the GPS module.
+        Initializes the GPS module and switches it to GPS_RATE_HZ updates
+        of GGA and RMC only, at GPS_BAUDRATE. The receiver is looked for at
+        9600 baud, its power-on rate, then at GPS_BAUDRATE, where it still
+        is after a reset of the board alone; if configuring it fails, once
+        more the other way round.
 
         Returns:
             GPS: The GPS module object.
         """
-        return GPS(UART(self.GPS_UART_ID, baudrate=9600, tx=Pin(self.GPS_TX), rx=Pin(self.GPS_RX)))
+        gps = GPS(UART(self.GPS_UART_ID, baudrate=9600, tx=Pin(self.GPS_TX), rx=Pin(self.GPS_RX)),
+                  ring_size=self.GPS_RING_SIZE, baudrate=9600,
+                  history_size=self.GPS_HISTORY_SIZE)
+        for rates in ((9600, self.GPS_BAUDRATE), (self.GPS_BAUDRATE, 9600)):
+            baudrate = gps.detect_baudrate(rates)
+            if baudrate is None:
+                print("Error: GPS: nothing received at 9600 or", self.GPS_BAUDRATE, "baud")
+                return gps
+            if gps.configure(rate_hz=self.GPS_RATE_HZ, baudrate=self.GPS_BAUDRATE):
+                print("GPS configured:", gps.sentences_per_s, "sentences/s")
+                return gps
+        print("Error: GPS did not confirm configuration, using its defaults at", baudrate, "baud")
+        return gps
+
+    def assist_gps(self):
+        """
+        Sends the fix saved on the SD card before the last reset to the GPS
+        receiver as a starting point, if there is one. The time of the fix
+        is stale by now, so the current time is only sent if the board
+        clock, set from GPS when the fix was saved, kept running through the
+        reset: then it can't be behind the saved fix.
+        """
+        saved = load_fix(self.GPS_FIX_FILE) if self.sd is not None else None
+        if saved is not None:
+            position, saved_utc = saved
+            now = time.localtime()[:6]
+            utc = now if now >= saved_utc else None
+            if self.gps.assist(position, utc):
+                return
+            if utc is None and not self.gps.ubx:
+                print("GPS: no valid time for assisting with the saved fix")
+            else:
+                print("Error: GPS did not accept the saved fix")
 
     def initialize_ms5611(self):
-         """
-        Initializes the MS5611 sensor.
+        """
+        Initializes the MS5611 sensor and starts its first measurement. Its
+        oversampling follows the operating mode through ms5611_osr().
 
         Returns:
-            MS5611: The MS5611 sensor object.
+            MS5611: The MS5611 sensor object, or None if its PROM is corrupt.
         """
         ms5611_i2c = I2C(self.MS5611_I2C_ID, sda=Pin(self.MS5611_SDA), scl=Pin(self.MS5611_SCL))
-        ms5611 = MS5611(ms5611_i2c)
+        try:
+            ms5611 = MS5611(ms5611_i2c, temperature_every=self.MS5611_TEMPERATURE_EVERY,
+                            calibration_file=self.CALIBRATION_FILE if self.sd is not None else None)
+        except RuntimeError as e:
+            print("Error: MS5611:", e)
+            return None
+        ms5611.osr_policy = self.ms5611_osr
+        ms5611.start()
         return ms5611
 
     def initialize_bmp280(self):
         """
-        Initializes the BMP280 sensor.
+        Initializes the BMP280 sensor and lets it sample continuously in
+        normal mode, so reads don't wait for a conversion.
 
         Returns:
-            BME280: The BMP280 sensor object.
+            BME280: The BMP280 sensor object, or None if its calibration is invalid.
         """
         bmp280_i2c = I2C(self.BMP_I2C_ID, sda=Pin(self.BMP280_SDA), scl=Pin(self.BMP280_SCL))
-        bmp280 = BME280(i2c=bmp280_i2c)  # Use BME280 class for BMP280
+        try:
+            bmp280 = BME280(mode=self.BMP280_OVERSAMPLING, i2c=bmp280_i2c,  # Use BME280 class for BMP280
+                            calibration_file=self.CALIBRATION_FILE if self.sd is not None else None)
+        except RuntimeError as e:
+            print("Error: BMP280:", e)
+            return None
+        print("BMP280 output data rate:", bmp280.set_normal_mode(self.BMP280_STANDBY, self.BMP280_IIR), "Hz")
         return bmp280
     
     def calculate_altitude(self, pressure):
-         """
+        """
         Calculates altitude based on the provided pressure.
 
         Args:
@@ -144,16 +332,33 @@ class Can:
             print("Error calculating altitude:", e)
             return 0.0
     
+    def ms5611_osr(self):
+        """
+        MS5611 oversampling for the current operating mode, called before
+        each measurement.
+
+        Returns:
+            int: The OSR from MS5611_OSR_BY_MODE, 4096 for other modes.
+        """
+        if 0 <= self.operating_mode < len(self.MS5611_OSR_BY_MODE):
+            return self.MS5611_OSR_BY_MODE[self.operating_mode]
+        return 4096
+
     def get_ms5611_data(self):
-       """
-        Reads and returns compensated data from the MS5611 sensor.
+        """
+        Returns the latest compensated data from the MS5611 sensor without
+        waiting for a conversion: the measurement is advanced with poll() and
+        a new one is started as soon as the previous one is complete.
 
         Returns:
-            array: Array containing temperature and pressure.
+            array: Array containing temperature, pressure and the OSR they
+            were measured at.
         """
         try:
-            data = self.ms5611.read_compensated_data()
-            return array("f", (data[0], data[1] / 100)) # convert to hPa
+            if self.ms5611.poll():
+                self.ms5611.start()
+            return array("f", (self.ms5611.TEMP, self.ms5611.PRES / 100, # convert to hPa
+                               self.ms5611.sample_osr))
         
         except Exception as e:
             print("Error reading MS5611 data:", e)
@@ -161,29 +366,35 @@ class Can:
 
     def get_bmp280_data(self):
         """
-        Reads and returns compensated data from the BMP280 sensor.
+        Reads and returns compensated data from the BMP280 sensor, using the
+        driver's integer compensation.
 
         Returns:
             array: Array containing temperature and pressure.
         """
         try:
-            data = self.bmp280.read_compensated_data()
-            return array("f", (data[0], data[1] / 100)) # convert to hPa
+            self.bmp280.read_compensated_into(self.bmp280_result)
+            # convert from 0.01 degC and 1/256 Pa to degC and hPa
+            return array("f", (self.bmp280_result[0] / 100, self.bmp280_result[1] / 25600))
         except Exception as e:
             print("Error reading BMP280 data:", e)
             return None, None
         
-     def get_gps_data(self):
+    def get_gps_data(self):
         """
-        Update GPS data.
+        Update GPS data, parsing every buffered sentence within GPS_BUDGET_US.
 
         Returns:
-            array: An array containing updated GPS data.
+            list: A list containing updated GPS data, None where there is
+            no value yet.
         """
-        gps_data = array("f", [None] * 11)
+        # a list, not array("f"): the timestamp is a tuple and fields are
+        # None until the receiver has sent them
+        gps_data = [None] * 11
 
         try:
-            self.gps.update()
+            if self.gps.update_all(self.GPS_BUDGET_US)[1]:
+                self.save_gps_fix()
             gps_data[0] = self.gps.timestamp_utc
             gps_data[1] = self.gps.latitude
             gps_data[2] = self.gps.longitude
@@ -201,7 +412,29 @@ class Can:
 
         return gps_data
         
-     def init_session_directory(self):
+    def save_gps_fix(self):
+        """
+        Saves the GPS fix for the next boot every GPS_SAVE_INTERVAL_MS, and
+        logs the time to first fix once it is known. The board clock is set
+        from the fix at the same time, for assist_gps() after a reset.
+        """
+        if self.sd is None:
+            return
+        if not self.gps_ttff_logged:
+            with open(self.GPS_TTFF_FILE, 'a') as f:
+                f.write("{},{}\n".format(self.gps.ttff_ms, int(self.gps.assisted)))
+            self.gps_ttff_logged = True
+        now = time.ticks_ms()
+        if self.gps_saved_ms is not None and \
+           time.ticks_diff(now, self.gps_saved_ms) < self.GPS_SAVE_INTERVAL_MS:
+            return
+        if self.gps.save_fix(self.GPS_FIX_FILE):
+            self.gps_saved_ms = now
+            year, month, day, hour, minute, second = self.gps.timestamp_utc[:6]
+            weekday = time.localtime(time.mktime((year, month, day, hour, minute, second, 0, 0)))[6]
+            RTC().datetime((year, month, day, weekday, hour, minute, second, 0))
+
+    def init_session_directory(self):
         """
         Initializes the session directory on the SD card.
         """
@@ -220,17 +453,23 @@ class Can:
         Args:
             data: Data to be stored in the buffer.
         """
-        if len(self.buffer) < self.BUFFER_SIZE:
-            self.buffer.append(data)
-        else:
+        if len(self.buffer) >= self.BUFFER_SIZE:
             self.save_buffer_to_csv()
             self.buffer = []
+        self.buffer.append(data)
             
     def save_buffer_to_csv(self):
         """
-        Saves data from the buffer to a CSV file on the SD card.
+        Saves data from the buffer to the flight log, or to a CSV file on
+        the SD card if there is no flight log. The flight log is flushed
+        each time, so nothing saved is left in RAM at landing or power-off.
         """
-        if self.sd is not None:
-            with open(self.current_file_name, 'a') as f:
-                f.write('\n'.join(buffer) + '\n')
+        if self.flight_log is not None:
+            for line in self.buffer:
+                self.flight_log.write(line)
+                self.flight_log.write('\n')
+            self.flight_log.flush()
+        elif self.sd is not None:
+            with open(self.current_filename, 'a') as f:
+                f.write('\n'.join(self.buffer) + '\n')
                 
\ No newline at end of file
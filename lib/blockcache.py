@@ -0,0 +1,151 @@
+"""
+Block cache in front of a block device such as sdcard.SDCard, to mount the
+FAT filesystem through:
+
+    sd = SDCard(spi, cs)
+    cache = BlockCache(sd, 16, fat_metadata_end(sd))
+    os.mount(cache, '/sd')
+
+The FAT driver reads the same FAT and directory blocks over and over, and
+each read is a full command round trip to the card. Single-block reads are
+kept in ``slots`` 512-byte slots, the least recently used one is evicted.
+Writes to blocks below ``metadata_end`` (boot sector, FATs and root
+directory) stay in the cache until their slot is evicted or the filesystem
+syncs (ioctl 3, on every file flush and close); other writes go straight to
+the device and update a cached copy.
+"""
+
+from array import array
+from ustruct import unpack_from
+
+_BLOCK = const(512)
+
+
+def fat_metadata_end(bdev):
+    """Return the first block after the FATs and root directory of the FAT
+    filesystem in the first partition of bdev, or on bdev itself if it has
+    no partition table. Returns 0 if there is no FAT filesystem.
+    """
+    buf = bytearray(_BLOCK)
+    bdev.readblocks(0, buf)
+    if buf[510] != 0x55 or buf[511] != 0xAA:
+        return 0
+    start = 0
+    if buf[0] not in (0xEB, 0xE9):  # not a boot sector: MBR
+        start = unpack_from('<I', buf, 446 + 8)[0]
+        if not buf[446 + 4] or not start:
+            return 0
+        bdev.readblocks(start, buf)
+        if buf[510] != 0x55 or buf[511] != 0xAA:
+            return 0
+    bytes_per_block, _, reserved, fats, root_entries = unpack_from('<HBHBH', buf, 11)
+    if bytes_per_block != _BLOCK:
+        return 0
+    fat_blocks = unpack_from('<H', buf, 22)[0] or unpack_from('<I', buf, 36)[0]
+    return start + reserved + fats * fat_blocks + (root_entries * 32 + _BLOCK - 1) // _BLOCK
+
+
+class BlockCache:
+    """LRU block cache with the readblocks/writeblocks/ioctl protocol of
+    the device it wraps.
+
+    ``hits`` and ``misses`` count single-block reads, ``write_backs`` the
+    dirty blocks written to the device.
+    """
+
+    def __init__(self, bdev, slots=16, metadata_end=0):
+        self.bdev = bdev
+        self.slots = slots
+        self.metadata_end = metadata_end
+        self._buf = bytearray(slots * _BLOCK)
+        self._mv = memoryview(self._buf)
+        self._block = array('i', [-1] * slots)  # block in each slot, -1 if free
+        self._used = array('I', [0] * slots)    # last use, for LRU
+        self._dirty = bytearray(slots)
+        self._stamp = 0
+        self.hits = 0
+        self.misses = 0
+        self.write_backs = 0
+
+    def _find(self, block_num):
+        blocks = self._block
+        for i in range(self.slots):
+            if blocks[i] == block_num:
+                return i
+        return -1
+
+    def _slot(self, i):
+        return self._mv[i * _BLOCK:(i + 1) * _BLOCK]
+
+    def _touch(self, i):
+        self._stamp += 1
+        self._used[i] = self._stamp
+
+    def _clean(self, i):
+        if self._dirty[i]:
+            self.bdev.writeblocks(self._block[i], self._slot(i))
+            self._dirty[i] = 0
+            self.write_backs += 1
+
+    def _evict(self):
+        # Free the least recently used slot; free slots have never been used.
+        used = self._used
+        victim = 0
+        for i in range(1, self.slots):
+            if used[i] < used[victim]:
+                victim = i
+        self._clean(victim)
+        self._block[victim] = -1
+        return victim
+
+    def readblocks(self, block_num, buf):
+        nblocks = len(buf) // _BLOCK
+        if nblocks == 1:
+            i = self._find(block_num)
+            if i >= 0:
+                self.hits += 1
+            else:
+                self.misses += 1
+                i = self._evict()
+                self.bdev.readblocks(block_num, self._slot(i))
+                self._block[i] = block_num
+            self._touch(i)
+            buf[:] = self._slot(i)
+            return
+        # multi-block reads are file data: read them past the cache, with
+        # any blocks not written back yet taken from it
+        self.bdev.readblocks(block_num, buf)
+        for i in range(self.slots):
+            n = self._block[i] - block_num
+            if self._dirty[i] and 0 <= n < nblocks:
+                buf[n * _BLOCK:(n + 1) * _BLOCK] = self._slot(i)
+
+    def writeblocks(self, block_num, buf):
+        nblocks = len(buf) // _BLOCK
+        if nblocks == 1 and block_num < self.metadata_end:
+            i = self._find(block_num)
+            if i < 0:
+                i = self._evict()
+                self._block[i] = block_num
+            self._slot(i)[:] = buf
+            self._dirty[i] = 1
+            self._touch(i)
+            return
+        self.bdev.writeblocks(block_num, buf)
+        # keep cached copies of the written blocks current
+        mv = memoryview(buf)
+        for i in range(self.slots):
+            n = self._block[i] - block_num
+            if 0 <= n < nblocks:
+                self._slot(i)[:] = mv[n * _BLOCK:(n + 1) * _BLOCK]
+                self._dirty[i] = 0
+
+    def sync(self):
+        """Write all dirty blocks back to the device."""
+        for i in range(self.slots):
+            self._clean(i)
+
+    def ioctl(self, op, arg):
+        if op == 2 or op == 3:  # deinit, sync
+            self.sync()
+        return self.bdev.ioctl(op, arg)
@@ -1,6 +1,7 @@
 import time
 from ustruct import unpack, unpack_from
 from array import array
+from calibration import load_calibration, save_calibration
 
 # BME280 default address.
 BME280_I2CADDR = 0x77
@@ -12,9 +13,32 @@ BME280_OSAMPLE_4 = 3
 BME280_OSAMPLE_8 = 4
 BME280_OSAMPLE_16 = 5
 
+# Normal mode standby time between measurements (t_sb). BMP280 parts have
+# 2000 and 4000 ms in place of 10 and 20 ms.
+BME280_STANDBY_0_5 = 0
+BME280_STANDBY_62_5 = 1
+BME280_STANDBY_125 = 2
+BME280_STANDBY_250 = 3
+BME280_STANDBY_500 = 4
+BME280_STANDBY_1000 = 5
+BME280_STANDBY_10 = 6
+BME280_STANDBY_20 = 7
+
+# IIR filter coefficient
+BME280_IIR_OFF = 0
+BME280_IIR_2 = 1
+BME280_IIR_4 = 2
+BME280_IIR_8 = 3
+BME280_IIR_16 = 4
+
+BME280_CHIP_ID = 0x60
+BMP280_CHIP_ID = 0x58
+
+BME280_REGISTER_CHIP_ID = 0xD0
 BME280_REGISTER_CONTROL_HUM = 0xF2
 BME280_REGISTER_STATUS = 0xF3
 BME280_REGISTER_CONTROL = 0xF4
+BME280_REGISTER_CONFIG = 0xF5
 
 MODE_SLEEP = const(0)
 MODE_FORCED = const(1)
@@ -22,12 +46,20 @@ MODE_NORMAL = const(3)
 
 BME280_TIMEOUT = const(100)  # about 1 second timeout
 
+# Key of the calibration in the calibration cache file (with the address)
+BME280_CALIBRATION_TAG = const(0x42)
+
+# t_sb in microseconds, by standby setting
+_STANDBY_US = (500, 62500, 125000, 250000, 500000, 1000000, 10000, 20000)
+_BMP280_STANDBY_US = (500, 62500, 125000, 250000, 500000, 1000000, 2000000, 4000000)
+
 class BME280:
 
     def __init__(self,
                  mode=BME280_OSAMPLE_8,
                  address=BME280_I2CADDR,
                  i2c=None,
+                 calibration_file=None,
                  **kwargs):
         # Check that mode is valid.
         if type(mode) is tuple and len(mode) == 3:
@@ -51,9 +83,29 @@ class BME280:
         self.i2c = i2c
         self.__sealevel = 101325
 
-        # load calibration data
-        dig_88_a1 = self.i2c.readfrom_mem(self.address, 0x88, 26)
-        dig_e1_e7 = self.i2c.readfrom_mem(self.address, 0xE1, 7)
+        # load calibration data: the chip id followed by the 0x88..0xA1 and
+        # 0xE1..0xE7 blocks. With calibration_file set, a copy cached at an
+        # earlier boot is used if the chip id and dig_T1..dig_T3, read back
+        # from the sensor, still match: every BME280 has the same chip id,
+        # so that alone doesn't tell a swapped board from the cached one.
+        self.calibration_cached = False
+        calibration = None
+        chip_id = self.i2c.readfrom_mem(self.address, BME280_REGISTER_CHIP_ID, 1)
+        self.chip_id = chip_id[0]
+        if calibration_file:
+            calibration = load_calibration(calibration_file, BME280_CALIBRATION_TAG, self.address)
+            if calibration is not None and (len(calibration) != 34 or calibration[0] != chip_id[0] or
+                                            self.i2c.readfrom_mem(self.address, 0x88, 6) != calibration[1:7]):
+                calibration = None
+            self.calibration_cached = calibration is not None
+        if calibration is None:
+            calibration = bytearray(34)
+            calibration[0] = chip_id[0]
+            blocks = memoryview(calibration)
+            self.i2c.readfrom_mem_into(self.address, 0x88, blocks[1:27])
+            self.i2c.readfrom_mem_into(self.address, 0xE1, blocks[27:34])
+        dig_88_a1 = calibration[1:27]
+        dig_e1_e7 = calibration[27:34]
 
         self.dig_T1, self.dig_T2, self.dig_T3, self.dig_P1, \
             self.dig_P2, self.dig_P3, self.dig_P4, self.dig_P5, \
@@ -66,54 +118,220 @@ class BME280:
         self.dig_H4 = (self.dig_H4 * 16) + (self.dig_H5 & 0xF)
         self.dig_H5 //= 16
 
+        # an all 0x00 or 0xFF block means the read failed or the trim is corrupt
+        if self.dig_T1 in (0, 0xFFFF) or self.dig_P1 in (0, 0xFFFF):
+            raise RuntimeError("BME280 calibration data invalid")
+        if calibration_file and not self.calibration_cached:
+            save_calibration(calibration_file, BME280_CALIBRATION_TAG, self.address, calibration)
+
         # temporary data holders which stay allocated
         self._l1_barray = bytearray(1)
         self._l8_barray = bytearray(8)
         self._l3_resultarray = array("i", [0, 0, 0])
+        # the data burst: pressure, temperature and, on a BME280, humidity
+        self._burst = memoryview(self._l8_barray)
+        if self.chip_id == BMP280_CHIP_ID:
+            self._burst = self._burst[:6]
 
+        self._power_mode = MODE_SLEEP
+        # maximum forced measurement time, and when the pending one was triggered
+        self._measurement_us = self.measurement_time_us()
+        self._triggered = None
+        # output data rate of the current mode, in Hz
+        self.odr_hz = 1000000 / self._measurement_us
+        # ctrl_hum keeps its value and takes effect with the next ctrl_meas write
+        self._l1_barray[0] = self._mode_hum
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL_HUM,
+                             self._l1_barray)
         self._l1_barray[0] = self._mode_temp << 5 | self._mode_press << 2 | MODE_SLEEP
         self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
                              self._l1_barray)
         self.t_fine = 0
 
-    def read_raw_data(self, result):
-        """ Reads the raw (uncompensated) data from the sensor.
+    def measurement_time_us(self, typical=False):
+        """ Time one measurement takes with the oversampling settings, from
+            the datasheet: the maximum, or the typical time the datasheet's
+            output data rates are based on.
+        """
+        t = 1 << (self._mode_temp - 1)
+        p = 1 << (self._mode_press - 1)
+        h = 1 << (self._mode_hum - 1) if self.chip_id != BMP280_CHIP_ID else 0
+        if typical:
+            return 1000 + 2000 * t + 2000 * p + 500 + (2000 * h + 500 if h else 0)
+        return 1250 + 2300 * t + 2300 * p + 575 + (2300 * h + 575 if h else 0)
+
+    def set_normal_mode(self, standby=BME280_STANDBY_0_5, iir=BME280_IIR_OFF):
+        """ Lets the sensor measure continuously, every measurement time plus
+            standby, with the IIR filter applied to pressure and temperature.
+            read_raw_data then only reads the latest result.
 
             Args:
-                result: array of length 2 or alike where the result will be
-                stored, in temperature, pressure order
+                standby: one of the BME280_STANDBY_* settings
+                iir: one of the BME280_IIR_* settings
             Returns:
-                None
+                the output data rate in Hz, also kept in odr_hz
         """
+        if not 0 <= standby <= 7 or not 0 <= iir <= 4:
+            raise ValueError("Unexpected standby {} or IIR filter {} setting".format(standby, iir))
+        # config is only reliably written in sleep mode
+        self._l1_barray[0] = self._mode_temp << 5 | self._mode_press << 2 | MODE_SLEEP
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL, self._l1_barray)
+        self._l1_barray[0] = standby << 5 | iir << 2
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONFIG, self._l1_barray)
+        self._l1_barray[0] = self._mode_temp << 5 | self._mode_press << 2 | MODE_NORMAL
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL, self._l1_barray)
+        self._power_mode = MODE_NORMAL
+        self._triggered = None
+        standby_us = _BMP280_STANDBY_US if self.chip_id == BMP280_CHIP_ID else _STANDBY_US
+        self.odr_hz = 1000000 / (self.measurement_time_us(True) + standby_us[standby])
+        return self.odr_hz
 
-        self._l1_barray[0] = self._mode_hum
-        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL_HUM,
-                             self._l1_barray)
+    def set_forced_mode(self):
+        """ Goes back to one measurement per read_raw_data call. """
+        self._l1_barray[0] = self._mode_temp << 5 | self._mode_press << 2 | MODE_SLEEP
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL, self._l1_barray)
+        self._power_mode = MODE_SLEEP
+        self.odr_hz = 1000000 / self._measurement_us
+
+    def trigger(self):
+        """ Starts a forced mode measurement and returns without waiting, so
+            other work can be done before collect(). Nothing to do in normal
+            mode.
+
+            Returns:
+                the maximum measurement time in microseconds
+        """
+        if self._power_mode == MODE_NORMAL:
+            return 0
         self._l1_barray[0] = self._mode_temp << 5 | self._mode_press << 2 | MODE_FORCED
         self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
                              self._l1_barray)
+        self._triggered = time.ticks_us()
+        return self._measurement_us
 
-        # Wait for conversion to complete
-        for _ in range(BME280_TIMEOUT):
-            if self.i2c.readfrom_mem(self.address, BME280_REGISTER_STATUS, 1)[0] & 0x08:
-                time.sleep_ms(10)  # still busy
+    def collect(self, result):
+        """ Reads the raw (uncompensated) result of the measurement started by
+            trigger(), first sleeping for whatever is left of the maximum
+            measurement time. The status register is then read once to make
+            sure the sensor is done. In normal mode, reads the latest result.
+
+            Args:
+                result: array of length 2 or 3 or alike where the result will
+                be stored, in temperature, pressure, humidity order
+            Returns:
+                None
+        """
+        if self._power_mode != MODE_NORMAL:
+            if self._triggered is None:
+                self.trigger()
+            remaining = self._measurement_us - time.ticks_diff(time.ticks_us(), self._triggered)
+            if remaining > 0:
+                time.sleep_us(remaining)
+            self._triggered = None
+            # safety check, the maximum time has passed so this normally reads done
+            for _ in range(BME280_TIMEOUT):
+                self.i2c.readfrom_mem_into(self.address, BME280_REGISTER_STATUS,
+                                           self._l1_barray)
+                if not self._l1_barray[0] & 0x08:
+                    break  # Sensor ready
+                time.sleep_ms(1)  # still busy
             else:
-                break  # Sensor ready
-        else:
-            raise RuntimeError("Sensor BME280 not ready")
+                raise RuntimeError("Sensor BME280 not ready")
 
         # burst readout from 0xF7 to 0xFE, recommended by datasheet
-        self.i2c.readfrom_mem_into(self.address, 0xF7, self._l8_barray)
+        self.i2c.readfrom_mem_into(self.address, 0xF7, self._burst)
         readout = self._l8_barray
         # pressure(0xF7): ((msb << 16) | (lsb << 8) | xlsb) >> 4
         raw_press = ((readout[0] << 16) | (readout[1] << 8) | readout[2]) >> 4
         # temperature(0xFA): ((msb << 16) | (lsb << 8) | xlsb) >> 4
         raw_temp = ((readout[3] << 16) | (readout[4] << 8) | readout[5]) >> 4
 
-        
-
         result[0] = raw_temp
         result[1] = raw_press
+        if len(result) > 2:
+            # humidity(0xFD): (msb << 8) | lsb, 0x8000 (skipped) on a BMP280
+            if self.chip_id == BMP280_CHIP_ID:
+                result[2] = 0x8000
+            else:
+                result[2] = (readout[6] << 8) | readout[7]
+
+    def read_raw_data(self, result):
+        """ Reads the raw (uncompensated) data from the sensor.
+
+            Args:
+                result: array of length 2 or 3 or alike where the result will
+                be stored, in temperature, pressure, humidity order
+            Returns:
+                None
+        """
+        self.trigger()
+        self.collect(result)
+
+    def compensate(self, result):
+        """ Compensates raw data in place with the datasheet's integer
+            formulas (32-bit for temperature and humidity, 64-bit for
+            pressure). Sets t_fine.
+
+            Args:
+                result: array of length 2 or 3 or alike holding raw data as
+                stored by read_raw_data, replaced with temperature in 0.01
+                degC, pressure in 1/256 Pa and humidity in 1/1024 %RH (0 on
+                a BMP280)
+            Returns:
+                None
+        """
+        # temperature
+        adc = result[0]
+        var1 = (((adc >> 3) - (self.dig_T1 << 1)) * self.dig_T2) >> 11
+        var2 = (adc >> 4) - self.dig_T1
+        var2 = (((var2 * var2) >> 12) * self.dig_T3) >> 14
+        t_fine = var1 + var2
+        self.t_fine = t_fine
+        result[0] = (t_fine * 5 + 128) >> 8
+
+        # pressure
+        var1 = t_fine - 128000
+        var2 = var1 * var1 * self.dig_P6
+        var2 = var2 + ((var1 * self.dig_P5) << 17)
+        var2 = var2 + (self.dig_P4 << 35)
+        var1 = ((var1 * var1 * self.dig_P3) >> 8) + ((var1 * self.dig_P2) << 12)
+        var1 = (((1 << 47) + var1) * self.dig_P1) >> 33
+        if var1 == 0:
+            result[1] = 0  # avoid exception caused by division by zero
+        else:
+            p = 1048576 - result[1]
+            p = (((p << 31) - var2) * 3125) // var1
+            var1 = (self.dig_P9 * (p >> 13) * (p >> 13)) >> 25
+            var2 = (self.dig_P8 * p) >> 19
+            result[1] = ((p + var1 + var2) >> 8) + (self.dig_P7 << 4)
+
+        # humidity
+        if len(result) > 2:
+            adc = result[2]
+            if adc == 0x8000:
+                result[2] = 0
+                return
+            h = t_fine - 76800
+            h = ((((adc << 14) - (self.dig_H4 << 20) - (self.dig_H5 * h)) + 16384) >> 15) * \
+                (((((((h * self.dig_H6) >> 10) * (((h * self.dig_H3) >> 11) + 32768)) >> 10)
+                   + 2097152) * self.dig_H2 + 8192) >> 14)
+            h = h - (((((h >> 15) * (h >> 15)) >> 7) * self.dig_H1) >> 4)
+            h = max(0, min(419430400, h))
+            result[2] = h >> 12
+
+    def read_compensated_into(self, result):
+        """ Reads the data from the sensor and stores the integer compensated
+            data, without allocating.
+
+            Args:
+                result: array of length 2 or 3 or alike, e.g. array("i"),
+                where temperature in 0.01 degC, pressure in 1/256 Pa and
+                humidity in 1/1024 %RH will be stored
+            Returns:
+                None
+        """
+        self.read_raw_data(result)
+        self.compensate(result)
 
     def read_compensated_data(self):
         """ Reads the data from the sensor and returns the compensated data.
@@ -0,0 +1,66 @@
+"""
+Cache of sensor calibration blocks in a small binary file, so drivers can
+skip reading their factory calibration over I2C at every boot.
+
+Each record is keyed by a driver tag and the sensor's I2C address:
+
+    tag (1 byte) | address (1) | length (1) | data (length) | checksum (2)
+
+The checksum is an 8-bit Fletcher sum (CK_A then CK_B) over the tag,
+address, length and data; a record that fails it is ignored.
+"""
+
+from fletcher import fletcher8
+
+
+def _records(path):
+    # Read the file and list (tag, address, start, end) for every intact
+    # record in it; data[start:end] is the calibration block.
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return b'', ()
+    records = []
+    pos = 0
+    while pos + 5 <= len(data):
+        end = pos + 3 + data[pos + 2]
+        if end + 2 > len(data):
+            break
+        if fletcher8(data, pos, end) == data[end] | data[end + 1] << 8:
+            records.append((data[pos], data[pos + 1], pos + 3, end))
+        pos = end + 2
+    return data, records
+
+
+def load_calibration(path, tag, address):
+    """Return the calibration block cached for (tag, address) in path as
+    bytes, or None if there is no intact record for it.
+    """
+    data, records = _records(path)
+    for record_tag, record_address, start, end in records:
+        if record_tag == tag and record_address == address:
+            return data[start:end]
+    return None
+
+
+def save_calibration(path, tag, address, block):
+    """Store block as the calibration of (tag, address) in path, keeping the
+    records of other sensors. Returns False if the file can't be written.
+    """
+    data, records = _records(path)
+    out = bytearray()
+    for record_tag, record_address, start, end in records:
+        if record_tag != tag or record_address != address:
+            out += data[start - 3:end + 2]
+    pos = len(out)
+    out += bytes((tag, address, len(block)))
+    out += block
+    checksum = fletcher8(out, pos, len(out))
+    out += bytes((checksum & 0xFF, checksum >> 8))
+    try:
+        with open(path, 'wb') as f:
+            f.write(out)
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,16 @@
+"""
+8-bit Fletcher checksum, as used by u-blox UBX frames (gps), the sensor
+calibration cache (calibration) and the flight log header (flightlog).
+"""
+
+
+def fletcher8(buf, start, end):
+    """Return the 8-bit Fletcher checksum of buf[start:end], CK_A in the
+    low byte and CK_B in the high byte.
+    """
+    ck_a = 0
+    ck_b = 0
+    for i in range(start, end):
+        ck_a = (ck_a + buf[i]) & 0xFF
+        ck_b = (ck_b + ck_a) & 0xFF
+    return ck_b << 8 | ck_a
@@ -0,0 +1,207 @@
+"""
+Flight log written straight to a reserved range of SD card blocks, without
+the FAT filesystem: no directory or FAT updates, so no write stalls from
+them. Works on any block device with readblocks/writeblocks/ioctl, such as
+sdcard.SDCard, whose multi-block writeblocks is a single CMD25 transfer.
+
+The range starts with a header block holding the write cursor, followed by
+the data blocks:
+
+    header: b'CSFL' | version (B) | 0 (B) | sessions (H) | data blocks (I)
+            | cursor (I) | sequence (I) | checksum (H)
+    data:   b'FL' | used bytes (H) | sequence (I) | payload (504 bytes)
+
+Data blocks are numbered with an increasing sequence number. The header is
+only rewritten every few batches and on flush(), so at boot the blocks
+after its cursor are checked for the sequence numbers that follow and the
+cursor is moved past any that were written after the last header update.
+
+Example, logging to the blocks after the last partition of the card:
+
+    first, count = unpartitioned_tail(sd)
+    log = FlightLog(sd, first, count)
+    log.write(b"...\\n")
+    log.flush()
+"""
+
+from ustruct import pack_into, unpack_from
+from fletcher import fletcher8
+
+_BLOCK = const(512)
+_HEADER = '<4sBBHIIIH'
+_MAGIC = b'CSFL'
+_CHECKED = const(20)  # header bytes covered by its checksum
+_VERSION = const(1)
+_DATA_HEADER = '<2sHI'
+_DATA_MAGIC = b'FL'
+_DATA_OFFSET = const(8)
+_PAYLOAD = const(504)
+
+
+def unpartitioned_tail(bdev):
+    """Return (first block, block count) of the space after the last MBR
+    partition on bdev, e.g. left free for the flight log when the card was
+    partitioned. The count is 0 if the partitions fill the card. A card
+    formatted without a partition table (a FAT boot sector at block 0, as
+    os.VfsFat.mkfs makes it) is used up to the end of that volume.
+    """
+    mbr = bytearray(_BLOCK)
+    bdev.readblocks(0, mbr)
+    sectors = bdev.ioctl(4, 0)
+    end = 1
+    if mbr[510] == 0x55 and mbr[511] == 0xAA:
+        if mbr[0] in (0xEB, 0xE9) and unpack_from('<H', mbr, 11)[0] == _BLOCK:
+            # boot sector, not an MBR: total sectors of the volume, in the
+            # 16 or the 32-bit field
+            end = unpack_from('<H', mbr, 19)[0] or unpack_from('<I', mbr, 32)[0] or sectors
+        else:
+            for entry in range(446, 510, 16):
+                start, size = unpack_from('<II', mbr, entry + 8)
+                if mbr[entry + 4] and size:
+                    end = max(end, start + size)
+    return end, max(0, sectors - end)
+
+
+def read_log(bdev, first_block):
+    """Return the payload of every data block of the log at first_block, in
+    order, as bytes. For downloading the log after the flight.
+    """
+    block = bytearray(_BLOCK)
+    bdev.readblocks(first_block, block)
+    magic, version, _, _, blocks, _, _, checksum = unpack_from(_HEADER, block)
+    if magic != _MAGIC or checksum != fletcher8(block, 0, _CHECKED):
+        raise ValueError("no flight log at block {}".format(first_block))
+    out = bytearray()
+    expected = None
+    for i in range(blocks):
+        bdev.readblocks(first_block + 1 + i, block)
+        magic, used, sequence = unpack_from(_DATA_HEADER, block)
+        if magic != _DATA_MAGIC or (expected is not None and sequence != expected) \
+           or used > _PAYLOAD:
+            break
+        out += block[_DATA_OFFSET:_DATA_OFFSET + used]
+        expected = sequence + 1
+    return bytes(out)
+
+
+class FlightLog:
+    """Append-only log in blocks first_block .. first_block + blocks - 1 of
+    bdev; the first one is the header.
+
+    write() collects data into a buffer of ``batch`` blocks, which is
+    written with one writeblocks call once it is full. The header is
+    rewritten every ``header_every`` batches and by flush().
+    """
+
+    def __init__(self, bdev, first_block, blocks, batch=8, header_every=8):
+        if blocks < 2:
+            raise ValueError("flight log needs at least 2 blocks")
+        self.bdev = bdev
+        self.first_block = first_block
+        self.capacity = blocks - 1  # data blocks
+        self.batch = batch
+        self.header_every = header_every
+        self._buf = bytearray(batch * _BLOCK)
+        self._mv = memoryview(self._buf)
+        self._header = bytearray(_BLOCK)
+        self._filled = 0     # blocks completed in _buf
+        self._used = 0       # payload bytes in the current block of _buf
+        self._batches = 0    # batches written since the last header update
+        self.cursor = 0      # data blocks written
+        self.sequence = 0    # sequence number of the next data block
+        self.sessions = 1
+        self.bytes_written = 0
+        self.dropped = 0     # bytes that didn't fit anymore
+        self._open()
+
+    def _open(self):
+        # Continue after the previous session, or start a new log.
+        header = self._header
+        self.bdev.readblocks(self.first_block, header)
+        magic, version, _, sessions, blocks, cursor, sequence, checksum = \
+            unpack_from(_HEADER, header)
+        if magic == _MAGIC and version == _VERSION and blocks == self.capacity \
+           and checksum == fletcher8(header, 0, _CHECKED):
+            self.cursor = cursor
+            self.sequence = sequence
+            self.sessions = sessions + 1
+            self._recover()
+        self._write_header()
+
+    def _recover(self):
+        # Move the cursor past blocks written after the last header update.
+        block = self._mv[:_BLOCK]
+        for _ in range(self.batch * self.header_every):
+            if self.cursor >= self.capacity:
+                break
+            self.bdev.readblocks(self.first_block + 1 + self.cursor, block)
+            magic, _, sequence = unpack_from(_DATA_HEADER, block)
+            if magic != _DATA_MAGIC or sequence != self.sequence:
+                break
+            self.cursor += 1
+            self.sequence += 1
+
+    def _write_header(self):
+        header = self._header
+        pack_into(_HEADER, header, 0, _MAGIC, _VERSION, 0, self.sessions & 0xFFFF,
+                  self.capacity, self.cursor, self.sequence, 0)
+        pack_into('<H', header, _CHECKED, fletcher8(header, 0, _CHECKED))
+        self.bdev.writeblocks(self.first_block, header)
+        self._batches = 0
+
+    def write(self, data):
+        """Append data (bytes, bytearray or str) to the log. Returns the
+        number of bytes taken, which is less than len(data) once the log is
+        full.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        data = memoryview(data)
+        taken = 0
+        length = len(data)
+        while taken < length:
+            if self.cursor + self._filled >= self.capacity:
+                self.dropped += length - taken
+                break
+            offset = self._filled * _BLOCK + _DATA_OFFSET + self._used
+            n = min(_PAYLOAD - self._used, length - taken)
+            self._buf[offset:offset + n] = data[taken:taken + n]
+            self._used += n
+            taken += n
+            if self._used == _PAYLOAD:
+                self._close_block()
+                if self._filled == self.batch:
+                    self._write_batch()
+        self.bytes_written += taken
+        return taken
+
+    def _close_block(self):
+        pack_into(_DATA_HEADER, self._buf, self._filled * _BLOCK,
+                  _DATA_MAGIC, self._used, self.sequence)
+        self.sequence += 1
+        self._filled += 1
+        self._used = 0
+
+    def _write_batch(self):
+        if self._filled:
+            self.bdev.writeblocks(self.first_block + 1 + self.cursor,
+                                  self._mv[:self._filled * _BLOCK])
+            self.cursor += self._filled
+            self._filled = 0
+            self._batches += 1
+            if self._batches >= self.header_every:
+                self._write_header()
+
+    def flush(self):
+        """Write out everything written so far, including a partly filled
+        block, and update the header. The next write starts a new block.
+        """
+        if self._used and self.cursor + self._filled < self.capacity:
+            self._close_block()
+        self._used = 0
+        self._write_batch()
+        if self._batches:
+            self._write_header()
+
+    def close(self):
+        self.flush()
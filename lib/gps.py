@@ -45,28 +45,163 @@ Implementation Notes
 __version__ = "0.0.0-auto.0"
 __repo__ = "https://github.com/alexmrqt/Adafruit_CircuitPython_GPS.git"
 
-# Internal helper parsing functions.
-# These handle input that might be none or null and return none instead of
-# throwing errors.
-def _parse_degrees(nmea_data):
-    # Parse a NMEA lat/long data pair 'dddmm.mmmm' into a pure degrees value.
-    # Where ddd is the degrees, mm.mmmm is the minutes.
-    if nmea_data is None or len(nmea_data) < 3:
-        return None
-    raw = float(nmea_data.decode())
-    deg = raw // 100
-    minutes = raw % 100
-    return deg + minutes/60
+import time
+from array import array
+from ustruct import pack, unpack, unpack_from
+from fletcher import fletcher8
 
-def _parse_int(nmea_data):
-    if nmea_data is None or nmea_data == b'':
-        return None
-    return int(nmea_data)
+# Powers of ten for turning fixed-point field values into floats.
+_POW10 = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Longest sentence the streaming reader will frame, including '$' and CRLF.
+# NMEA caps standard sentences at 82 characters, proprietary ones (PMTK)
+# can run a little longer.
+_MAX_SENTENCE = 128
+
+# Reads the streaming reader remembers the receive time of until their
+# bytes are parsed, and the wrap of the byte count that locates them.
+_RX_MARKS = 16
+_RX_COUNT_MASK = 0x3FFFFFFF
+
+# Sentence types with a parser, in the order of the parse statistics. The
+# two letter talker ID in front of them (GP, GN, GL, GA, ...) is ignored.
+_SENTENCE_TYPES = (b'GGA', b'RMC', b'GSA', b'GSV', b'VTG')
+# Parse statistics are kept for the NMEA sentence types and NAV-PVT.
+_STAT_NAMES = _SENTENCE_TYPES + (b'NAV-PVT',)
+_STAT_NAV_PVT = len(_SENTENCE_TYPES)
+
+# UBX message classes and IDs (u-blox M8 protocol specification).
+_UBX_SYNC1 = 0xB5
+_UBX_SYNC2 = 0x62
+_UBX_NAV = 0x01
+_UBX_NAV_PVT = 0x07
+_UBX_ACK = 0x05
+_UBX_ACK_ACK = 0x01
+_UBX_CFG = 0x06
+_UBX_CFG_MSG = 0x01
+_UBX_CFG_PRT = 0x00
+_UBX_CFG_RATE = 0x08
+_UBX_NMEA = 0xF0
+# NMEA messages a u-blox receiver outputs by default: GGA, GLL, GSA, GSV,
+# RMC, VTG and TXT.
+_UBX_NMEA_IDS = (0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x41)
+_UBX_NAV_PVT_LENGTH = 92
+_UBX_MGA = 0x13
+_UBX_MGA_INI = 0x40
+
+# Saved fix for assisted start: latitude, longitude (micro-degrees),
+# altitude (cm), then the UTC year, month, day, hour, minute, second.
+_SAVED_FIX = '<3iH5B'
+
+# Time for a configuration command to leave the UART before it is
+# re-initialised at another rate (~30 bytes at 9600 baud).
+_TX_SETTLE_MS = 50
 
-def _parse_float(nmea_data):
-    if nmea_data is None or nmea_data == b'':
+# Field positions of the sentences in the PMTK314 output mask (19 fields)
+# and the matching UBX CFG-MSG NMEA message IDs.
+_PMTK314_FIELDS = 19
+_SENTENCE_OUTPUT = (('gll', 0, 0x01), ('rmc', 1, 0x04), ('vtg', 2, 0x05),
+                    ('gga', 3, 0x00), ('gsa', 4, 0x02), ('gsv', 5, 0x03))
+
+# Most satellites tracked from one GSV cycle across all constellations.
+_MAX_SATELLITES = 48
+
+def _hex_value(char):
+    # Value of one ASCII hex digit, or a value that can never match a
+    # checksum byte if it is not one.
+    if 48 <= char <= 57:
+        return char - 48
+    char |= 0x20
+    if 97 <= char <= 102:
+        return char - 87
+    return 0x100
+
+def _udeg_str(udeg):
+    # Micro-degrees as a decimal degrees string, without float rounding.
+    sign = '-' if udeg < 0 else ''
+    udeg = abs(udeg)
+    return '{}{}.{:06d}'.format(sign, udeg // 1000000, udeg % 1000000)
+
+def load_fix(path):
+    """Read a fix stored by `GPS.save_fix`. Returns a tuple of (latitude
+    micro-degrees, longitude micro-degrees, altitude cm) and the UTC time
+    as a (year, month, day, hour, minute, second) tuple, or None if there
+    is no usable file.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        values = unpack(_SAVED_FIX, data)
+    except (OSError, ValueError):
         return None
-    return float(nmea_data.decode())
+    return values[:3], values[3:]
+
+def _starts_with(buf, start, prefix):
+    # Compare buf[start:] to prefix without slicing.
+    for i in range(len(prefix)):
+        if buf[start + i] != prefix[i]:
+            return False
+    return True
+
+def _type_key(buf, start):
+    # Pack the three letter sentence type at buf[start:] into an int for
+    # dispatch, upper-casing it on the way. No bytes object is created.
+    return ((buf[start] & 0xDF) << 16 | (buf[start + 1] & 0xDF) << 8
+            | (buf[start + 2] & 0xDF))
+
+class FixHistory:
+    """Fixed-capacity history of GPS fixes, each stamped with the
+    ``time.ticks_us()`` value at which it was received. The newest
+    `capacity` fixes are kept in preallocated arrays, oldest overwritten
+    first.
+
+    :param int capacity: Number of fixes to keep.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._ticks = array('l', [0] * capacity)
+        self._lat = array('l', [0] * capacity)
+        self._lon = array('l', [0] * capacity)
+        self._alt = array('l', [0] * capacity)
+        self._head = 0   # slot the next fix goes into
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, ticks, latitude_udeg, longitude_udeg, altitude_cm):
+        """Store a fix received at ticks (``time.ticks_us()``)."""
+        i = self._head
+        self._ticks[i] = ticks
+        self._lat[i] = latitude_udeg
+        self._lon[i] = longitude_udeg
+        self._alt[i] = altitude_cm
+        self._head = (i + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def position_at(self, ticks):
+        """Return the position at ticks (``time.ticks_us()``) as a tuple of
+        latitude and longitude in micro-degrees and altitude in centimetres,
+        linearly interpolated between the two fixes received around it.
+        Returns None if ticks is before the oldest or after the newest fix.
+        """
+        # Walk back from the newest fix to the first one at or before ticks.
+        newer = -1
+        for n in range(self._count):
+            i = (self._head - 1 - n) % self.capacity
+            age = time.ticks_diff(ticks, self._ticks[i])
+            if age == 0:
+                return (self._lat[i], self._lon[i], self._alt[i])
+            if age > 0:
+                if newer < 0:
+                    return None  # after the newest fix
+                span = time.ticks_diff(self._ticks[newer], self._ticks[i])
+                return (self._lat[i] + (self._lat[newer] - self._lat[i]) * age // span,
+                        self._lon[i] + (self._lon[newer] - self._lon[i]) * age // span,
+                        self._alt[i] + (self._alt[newer] - self._alt[i]) * age // span)
+            newer = i
+        return None  # before the oldest fix
 
 # lint warning about too many attributes disabled
 #pylint: disable-msg=R0902
@@ -75,39 +210,163 @@ class GPS:
     modules to read latitude, longitude, and more.
 
     :param uart: The `UART` object to use.
+    :param int ring_size: Size in bytes of the receive ring buffer. When set,
+        `update` drains the UART with ``readinto()`` into this preallocated
+        ring and parses sentences in place instead of one ``readline()`` per
+        call. 0 (the default) keeps the original readline behaviour. The
+        streaming reader also understands u-blox UBX binary frames, see
+        `enable_ubx`.
+    :param int baudrate: The rate the UART was opened at, so `set_baudrate`
+        can go back to it.
+    :param int history_size: Number of completed fixes to keep in `history`
+        for `position_at`. 0 (the default) keeps none.
     """
-    def __init__(self, uart):
+    def __init__(self, uart, ring_size=0, baudrate=9600, history_size=0):
         self._uart = uart
+        # Rate the UART was opened at, kept up to date by set_baudrate().
+        self._uart_baudrate = baudrate
         # Initialize null starting values for GPS attributes.
         self.timestamp_utc = None
-        self.latitude = None
-        self.longitude = None
+        # Position is kept in fixed point: integer micro-degrees and
+        # centimetres. latitude, longitude and altitude_m are float views.
+        self.latitude_udeg = None
+        self.longitude_udeg = None
         self.fix_quality = None
         self.satellites = None
         self.horizontal_dilution = None
-        self.altitude_m = None
+        self.altitude_cm = None
         self.height_geoid = None
         self.velocity_knots = None
         self.speed_knots = None
+        self.speed_kmh = None
         self.track_angle_deg = None
+        # GSA: fix type (1 = none, 2 = 2D, 3 = 3D) and dilution of precision.
+        self.fix_type = None
+        self.pdop = None
+        self.vdop = None
+        # GSV: satellites in view over all constellations, and the PRN and
+        # SNR (dB-Hz, 0 when not tracked) of the first satellites_tracked
+        # of them.
+        self.satellites_in_view = None
+        self.satellites_tracked = 0
+        self.satellite_prn = array('H', [0] * _MAX_SATELLITES)
+        self.satellite_snr = array('B', [0] * _MAX_SATELLITES)
+        # Work area filled while a GSV group is coming in.
+        self._gsv_prn = array('H', [0] * _MAX_SATELLITES)
+        self._gsv_snr = array('B', [0] * _MAX_SATELLITES)
+        self._gsv_count = 0
+        self._gsv_in_view = 0
+        self._gsv_talkers = 0
+        # Dispatch table: sentence type key -> index into _parsers and the
+        # per-type counters.
+        self._parsers = (self._parse_gga, self._parse_rmc, self._parse_gsa,
+                         self._parse_gsv, self._parse_vtg, self._parse_nav_pvt)
+        self._dispatch = {}
+        for index, data_type in enumerate(_SENTENCE_TYPES):
+            self._dispatch[_type_key(data_type, 0)] = index
+        self._parse_count = array('L', [0] * len(_STAT_NAMES))
+        self._parse_us = array('L', [0] * len(_STAT_NAMES))
+        self.ignored_sentences = 0
+        # Number of fixes completed so far, see _fix_completed(), and the
+        # time.ticks_us() at which the data of the last one was received.
+        self.fix_count = 0
+        self.fix_ticks_us = None
+        # Time to first fix in milliseconds from the creation of this object,
+        # and whether the receiver was given assistance data for it.
+        self.ttff_ms = None
+        self.assisted = False
+        self._start_ms = time.ticks_ms()
+        self.history = FixHistory(history_size) if history_size else None
+        # time.ticks_us() of the read that delivered the sentence being
+        # handled.
+        self._rx_ticks = 0
+        # Streaming reader state. The ring holds everything drained from the
+        # UART that has not been parsed yet: _used bytes starting at _tail.
+        # _scanned counts how far past _tail the framer has looked for the
+        # end of the sentence that starts at _tail.
+        self._ring = None
+        if ring_size:
+            if ring_size < _MAX_SENTENCE:
+                raise ValueError('ring_size must be at least {}'.format(_MAX_SENTENCE))
+            self._ring = bytearray(ring_size)
+            self._ring_mv = memoryview(self._ring)
+            # Sentences that wrap around the end of the ring are copied here
+            # so they can be parsed from one contiguous buffer.
+            self._line = bytearray(_MAX_SENTENCE)
+            self._tail = 0
+            self._used = 0
+            self._scanned = 0
+            self._in_sentence = False
+            self._is_ubx = False
+            # Location of the last framed sentence or UBX frame: buffer,
+            # start, end (end excludes the CR/LF of a sentence).
+            self._sbuf = None
+            self._sstart = 0
+            self._send = 0
+            # Receive times of the bytes in the ring: for each read, the
+            # count of bytes drained up to its end and its time.ticks_us(),
+            # oldest at _mark_first. _rx_count wraps at _RX_COUNT_MASK.
+            self._rx_count = 0
+            self._mark_end = array('l', [0] * _RX_MARKS)
+            self._mark_ticks = array('l', [0] * _RX_MARKS)
+            self._mark_first = 0
+            self._marks = 0
+        # Streaming reader statistics.
+        self.overflows = 0          # drains that left bytes behind in a full ring
+        self.partial_sentences = 0  # sentences cut short or too long to frame
+        self.checksum_errors = 0
+        # Sentences and UBX frames that passed their checksum.
+        self.sentences_received = 0
+        # Measured by measure_rate().
+        self.sentences_per_s = None
+        # UBX mode: True once enable_ubx() switched the receiver over.
+        self.ubx = False
+        # Last command acknowledgement from the receiver: _ack_key is the
+        # PMTK command number (PMTK001) or class << 8 | id of a UBX message
+        # (ACK-ACK/NAK), _ack is 1 when it succeeded and -1 when it failed.
+        self._ack_key = 0
+        self._ack = 0
 
     def update(self):
         """Check for updated data from the GPS module and process it
         accordingly.  Returns True if new data was processed, and False if
         nothing new was received.
         """
-        # Grab a sentence and check its data type to call the appropriate
-        # parsing function.
-        sentence = self._parse_sentence()
-        if sentence is None:
-            return False
-        data_type, args = sentence
-        data_type = data_type.upper()
-        if data_type == b'GPGGA':      # GGA, 3d location fix
-            self._parse_gpgga(args)
-        elif data_type == b'GPRMC':    # RMC, minimum location info
-            self._parse_gprmc(args)
-        return True
+        if self._ring is not None:
+            return self._update_stream()
+        return self._update_line() is True
+
+    def update_all(self, budget_us):
+        """Process every complete sentence the GPS module has sent so far,
+        stopping early once more than budget_us microseconds have been
+        spent. Sentences that fail their checksum are skipped, not waited
+        on. Returns a tuple of the number of sentences processed (skipped
+        ones included) and True if a new fix was completed on the way.
+        """
+        started = time.ticks_us()
+        fixes = self.fix_count
+        count = 0
+        while True:
+            if self._ring is not None:
+                if not self._update_stream():
+                    break
+            elif self._update_line() is None:
+                break
+            count += 1
+            if time.ticks_diff(time.ticks_us(), started) >= budget_us:
+                break
+        return count, self.fix_count != fixes
+
+    def parse_stats(self):
+        """Return the per sentence type parse counters as a dict mapping the
+        sentence type (``b'GGA'``, ``b'RMC'``, ..., ``b'NAV-PVT'``) to a ``(sentences parsed,
+        total parse time in microseconds)`` tuple. Sentences of other types
+        are only counted in `ignored_sentences`.
+        """
+        stats = {}
+        for index, data_type in enumerate(_STAT_NAMES):
+            stats[data_type] = (self._parse_count[index], self._parse_us[index])
+        return stats
 
     def send_command(self, command, add_checksum=True):
         """Send a command string to the GPS.  If add_checksum is True (the
@@ -125,16 +384,243 @@ class GPS:
             self._uart.write('{:02x}'.format(checksum).upper())
         self._uart.write('\r\n')
 
+    def send_ubx(self, msg_class, msg_id, payload=b''):
+        """Send a UBX binary message to the GPS, the binary counterpart of
+        `send_command`. The sync characters, length and checksum are added
+        automatically.
+        """
+        length = len(payload)
+        frame = bytearray(length + 8)
+        frame[0] = _UBX_SYNC1
+        frame[1] = _UBX_SYNC2
+        frame[2] = msg_class
+        frame[3] = msg_id
+        frame[4] = length & 0xFF
+        frame[5] = length >> 8
+        frame[6:6 + length] = payload
+        checksum = fletcher8(frame, 2, length + 6)
+        frame[length + 6] = checksum & 0xFF
+        frame[length + 7] = checksum >> 8
+        self._uart.write(frame)
+
+    def enable_ubx(self, timeout_ms=1000):
+        """Switch a u-blox receiver to binary output: NAV-PVT on every epoch,
+        the default NMEA sentences off. A NAV-PVT message carries the fix,
+        time and velocity that otherwise take a GGA and an RMC sentence.
+        Needs the streaming reader (ring_size). Returns True if the receiver
+        acknowledged the change; if it does not answer within timeout_ms
+        nothing else is sent and parsing stays on NMEA.
+        """
+        if self._ring is None:
+            raise ValueError('UBX mode needs a GPS created with ring_size')
+        if not self._send_ubx_config(_UBX_CFG_MSG, bytes((_UBX_NAV, _UBX_NAV_PVT, 1)),
+                                     timeout_ms):
+            return False
+        self.ubx = True
+        for msg_id in _UBX_NMEA_IDS:
+            self._send_ubx_config(_UBX_CFG_MSG, bytes((_UBX_NMEA, msg_id, 0)),
+                                  timeout_ms)
+        return True
+
+    def configure(self, rate_hz=10, baudrate=115200, timeout_ms=1000, **sentences):
+        """Set the receiver up for flight: only the sentences that are parsed
+        (keyword arguments as for `set_sentences`), a higher baud rate, then
+        the higher update rate that needs it. Each step is confirmed by the
+        receiver. Finally the sentence rate actually arriving is measured
+        into `sentences_per_s`. Returns True if every step was confirmed.
+        """
+        if not self.set_sentences(timeout_ms=timeout_ms, **sentences):
+            return False
+        if baudrate and not self.set_baudrate(baudrate, timeout_ms=timeout_ms):
+            return False
+        if not self.set_rate(rate_hz, timeout_ms=timeout_ms):
+            return False
+        self.measure_rate()
+        return True
+
+    def set_rate(self, rate_hz, timeout_ms=1000):
+        """Set the position fix rate of the receiver (PMTK220, or CFG-RATE in
+        UBX mode). Returns True once the receiver acknowledges it.
+        """
+        interval_ms = 1000 // rate_hz
+        if self.ubx:
+            return self._send_ubx_config(_UBX_CFG_RATE, bytes(
+                (interval_ms & 0xFF, interval_ms >> 8, 1, 0, 1, 0)), timeout_ms)
+        return self._send_pmtk('PMTK220,{}'.format(interval_ms), timeout_ms)
+
+    def set_sentences(self, gga=True, rmc=True, gsa=False, gsv=False, vtg=False,
+                      gll=False, timeout_ms=1000):
+        """Choose which NMEA sentences the receiver outputs, once per fix
+        (PMTK314, or CFG-MSG in UBX mode). Returns True once the receiver
+        acknowledges it.
+        """
+        enabled = {'gga': gga, 'rmc': rmc, 'gsa': gsa, 'gsv': gsv, 'vtg': vtg,
+                   'gll': gll}
+        if self.ubx:
+            for name, _, msg_id in _SENTENCE_OUTPUT:
+                if not self._send_ubx_config(_UBX_CFG_MSG, bytes(
+                        (_UBX_NMEA, msg_id, 1 if enabled[name] else 0)), timeout_ms):
+                    return False
+            return True
+        fields = ['0'] * _PMTK314_FIELDS
+        for name, field, _ in _SENTENCE_OUTPUT:
+            if enabled[name]:
+                fields[field] = '1'
+        return self._send_pmtk('PMTK314,' + ','.join(fields), timeout_ms)
+
+    def set_baudrate(self, baudrate, timeout_ms=1000):
+        """Switch the receiver and the UART to baudrate (PMTK251, or CFG-PRT
+        in UBX mode). Receivers do not acknowledge this at the old rate, so
+        the change counts as confirmed when a valid sentence arrives at the
+        new one. Otherwise the UART goes back to the old rate and False is
+        returned.
+        """
+        previous = self._uart_baudrate
+        if self.ubx:
+            # UART1, 8N1, UBX + NMEA in, UBX out.
+            payload = bytearray(20)
+            payload[0] = 1
+            payload[4:8] = b'\xd0\x08\x00\x00'
+            for i in range(4):
+                payload[8 + i] = (baudrate >> (8 * i)) & 0xFF
+            payload[12] = 0x03
+            payload[14] = 0x01
+            self.send_ubx(_UBX_CFG, _UBX_CFG_PRT, payload)
+        else:
+            self.send_command('PMTK251,{}'.format(baudrate))
+        # Let the command leave the UART before changing its rate.
+        time.sleep_ms(_TX_SETTLE_MS)
+        self._reopen_uart(baudrate)
+        if self._wait_sentence(timeout_ms):
+            return True
+        self._reopen_uart(previous)
+        return False
+
+    def detect_baudrate(self, rates=(9600, 115200), timeout_ms=1500):
+        """Find the rate the receiver is sending at: reopen the UART at each
+        of rates in turn until a valid sentence arrives within timeout_ms.
+        After a reset of the board alone the receiver is still at the rate
+        `set_baudrate` gave it. Returns the rate, or None if nothing was
+        received at any of them (the UART is left at the last one).
+        """
+        for baudrate in rates:
+            if baudrate != self._uart_baudrate:
+                self._reopen_uart(baudrate)
+            if self._wait_sentence(timeout_ms):
+                return baudrate
+        return None
+
+    def measure_rate(self, duration_ms=2000):
+        """Process incoming data for duration_ms and return the number of
+        valid sentences (or UBX frames) received per second. The result is
+        also kept in `sentences_per_s`; it is None if duration_ms is 0.
+        """
+        received = self.sentences_received
+        started = time.ticks_ms()
+        elapsed = 0
+        while elapsed < duration_ms:
+            if not self.update():
+                time.sleep_ms(1)
+            elapsed = time.ticks_diff(time.ticks_ms(), started)
+        if elapsed <= 0:
+            self.sentences_per_s = None
+        else:
+            self.sentences_per_s = (self.sentences_received - received) * 1000 / elapsed
+        return self.sentences_per_s
+
+    def _reopen_uart(self, baudrate):
+        # Re-initialise the UART at a new rate and drop what was received at
+        # the old one.
+        self._uart.init(baudrate=baudrate)
+        self._uart_baudrate = baudrate
+        while self._uart.any():
+            self._uart.read()
+        if self._ring is not None:
+            self._used = 0
+            self._scanned = 0
+            self._in_sentence = False
+
+    def _wait_sentence(self, timeout_ms):
+        # Process incoming data until a sentence with a valid checksum
+        # arrives. Returns False if none does within timeout_ms.
+        received = self.sentences_received
+        started = time.ticks_ms()
+        while self.sentences_received == received:
+            if time.ticks_diff(time.ticks_ms(), started) >= timeout_ms:
+                return False
+            if not self.update():
+                time.sleep_ms(1)
+        return True
+
+    def _send_pmtk(self, command, timeout_ms):
+        # Send a PMTK command and wait for its PMTK001 acknowledgement.
+        self._ack_key = 0
+        self.send_command(command)
+        return self._wait_ack(int(command[4:7]), timeout_ms)
+
+    def _send_ubx_config(self, msg_id, payload, timeout_ms):
+        # Send a CFG message and wait for its ACK-ACK.
+        self._ack_key = 0
+        self.send_ubx(_UBX_CFG, msg_id, payload)
+        return self._wait_ack(_UBX_CFG << 8 | msg_id, timeout_ms)
+
+    def _wait_ack(self, key, timeout_ms):
+        # Process incoming data until the receiver acknowledges the command
+        # identified by key. Returns True if it succeeded, False if it was
+        # rejected or no answer came within timeout_ms.
+        started = time.ticks_ms()
+        while self._ack_key != key:
+            if time.ticks_diff(time.ticks_ms(), started) >= timeout_ms:
+                return False
+            if not self.update():
+                time.sleep_ms(1)
+        return self._ack > 0
+
+    @property
+    def latitude(self):
+        """Latitude in decimal degrees, computed from `latitude_udeg`."""
+        if self.latitude_udeg is None:
+            return None
+        return self.latitude_udeg / 1000000
+
+    @property
+    def longitude(self):
+        """Longitude in decimal degrees, computed from `longitude_udeg`."""
+        if self.longitude_udeg is None:
+            return None
+        return self.longitude_udeg / 1000000
+
+    @property
+    def altitude_m(self):
+        """Altitude above mean sea level in meters, computed from
+        `altitude_cm`."""
+        if self.altitude_cm is None:
+            return None
+        return self.altitude_cm / 100
+
     @property
     def has_fix(self):
         """True if a current fix for location information is available."""
         return self.fix_quality is not None and self.fix_quality >= 1
 
+    def _update_line(self):
+        # readline() counterpart of _update_stream(): grab a sentence and
+        # hand it to the parser for its data type. Returns None if no line
+        # was available, False if the line was rejected and True once it
+        # was handled.
+        sentence = self._parse_sentence()
+        if not sentence:
+            return sentence
+        self._handle(sentence, 0, len(sentence))
+        return True
+
     def _parse_sentence(self):
-        # Parse any NMEA sentence that is available.
+        # Parse any NMEA sentence that is available. Returns None if there
+        # is none and False if it fails its checksum or is blank.
         sentence = self._uart.readline()
         if sentence is None or sentence == b'' or len(sentence) < 1:
             return None
+        self._rx_ticks = time.ticks_us()
         sentence = sentence.strip()
         # Look for a checksum and validate it if present.
         if len(sentence) > 7 and sentence[-3] == ord('*'):
@@ -144,103 +630,576 @@ class GPS:
             for i in range(1, len(sentence)-3):
                 actual ^= sentence[i]
             if actual != expected:
-                return None  # Failed to validate checksum.
+                return False  # Failed to validate checksum.
             # Remove checksum once validated.
             sentence = sentence[:-3]
-        # Parse out the type of sentence (first string after $ up to comma)
-        # and then grab the rest as data within the sentence.
-        delineator = sentence.find(b',')
-        if delineator == -1:
-            return None  # Invalid sentence, no comma after data type.
-        data_type = sentence[1:delineator]
-        return (data_type, sentence[delineator+1:])
-
-    def _parse_gpgga(self, args):
-        # Parse the arguments (everything after data type) for NMEA GPGGA
-        # 3D location fix sentence.
-        data = args.split(b',')
-        if data is None or len(data) != 14:
+        return sentence or False
+
+    def _handle(self, buf, start, end):
+        # Dispatch the sentence in buf[start:end] ('$' up to the checksum) on
+        # its type. Standard sentences have a 5 letter data type: a talker ID
+        # followed by the sentence type the table is keyed on.
+        self.sentences_received += 1
+        if end - start > 9 and _starts_with(buf, start, b'$PMTK001,'):
+            # Acknowledgement of a PMTK command: command number, flag.
+            self._fields(buf, start + 9, end)
+            command = self._next_fixed(0)
+            self._ack = 1 if self._next_fixed(0) == 3 else -1
+            self._ack_key = command
+            return
+        if end - start < 7 or buf[start + 6] != 44:  # ','
+            self.ignored_sentences += 1
+            return
+        index = self._dispatch.get(_type_key(buf, start + 3))
+        if index is None:
+            self.ignored_sentences += 1
+            return
+        self._timed_parse(index, buf, start + 7, end)
+
+    def _handle_ubx(self, buf, start, end):
+        # Verify and dispatch the UBX frame in buf[start:end].
+        if fletcher8(buf, start + 2, end - 2) != buf[end - 2] | buf[end - 1] << 8:
+            self.checksum_errors += 1
+            return
+        self.sentences_received += 1
+        msg_class = buf[start + 2]
+        msg_id = buf[start + 3]
+        length = end - start - 8
+        if msg_class == _UBX_NAV and msg_id == _UBX_NAV_PVT \
+           and length == _UBX_NAV_PVT_LENGTH:
+            self._timed_parse(_STAT_NAV_PVT, buf, start + 6, end - 2)
+        elif msg_class == _UBX_ACK and length == 2:
+            self._ack = 1 if msg_id == _UBX_ACK_ACK else -1
+            self._ack_key = buf[start + 6] << 8 | buf[start + 7]
+        else:
+            self.ignored_sentences += 1
+
+    def _timed_parse(self, index, buf, pos, end):
+        # Run parser number index and account for it in the statistics.
+        started = time.ticks_us()
+        self._parsers[index](buf, pos, end)
+        self._parse_us[index] += time.ticks_diff(time.ticks_us(), started)
+        self._parse_count[index] += 1
+
+    def _update_stream(self):
+        # Streaming counterpart of update(): move whatever the UART has into
+        # the ring, then handle the oldest complete sentence in it.
+        self._drain()
+        if not self._frame():
+            return False
+        self._rx_ticks = self._received_ticks()
+        if self._is_ubx:
+            self._handle_ubx(self._sbuf, self._sstart, self._send)
+        elif self._check_sentence(self._sbuf, self._sstart, self._send):
+            self._handle(self._sbuf, self._sstart, self._send)
+        self._consume()
+        return True
+
+    def _drain(self):
+        # Read as much as fits from the UART into the free part of the ring.
+        # readinto() only fills contiguous space, so a wrap takes two reads.
+        ring = self._ring
+        size = len(ring)
+        while self._used < size:
+            head = (self._tail + self._used) % size
+            n = size - self._used
+            if n > size - head:
+                n = size - head
+            got = self._uart.readinto(self._ring_mv[head:head + n])
+            if not got:
+                return
+            self._mark(got)
+            self._used += got
+            if got < n:
+                return
+        if self._uart.any():
+            self.overflows += 1
+
+    def _mark(self, got):
+        # Remember when the got bytes just read arrived. If too many reads
+        # are waiting the oldest mark is dropped, so its bytes get the time
+        # of the next one.
+        self._rx_count = (self._rx_count + got) & _RX_COUNT_MASK
+        if self._marks == _RX_MARKS:
+            self._mark_first = (self._mark_first + 1) % _RX_MARKS
+            self._marks -= 1
+        i = (self._mark_first + self._marks) % _RX_MARKS
+        self._mark_end[i] = self._rx_count
+        self._mark_ticks[i] = time.ticks_us()
+        self._marks += 1
+
+    def _received_ticks(self):
+        # time.ticks_us() of the read that delivered the last byte of the
+        # framed sentence. Marks of earlier reads are released: sentences
+        # are framed in order, so no later one can end in them.
+        end = (self._rx_count - self._used + self._scanned) & _RX_COUNT_MASK
+        while self._marks > 1:
+            i = self._mark_first
+            if (self._mark_end[i] - end) & _RX_COUNT_MASK <= _RX_COUNT_MASK >> 1:
+                break  # this read ends at or after the sentence
+            self._mark_first = (i + 1) % _RX_MARKS
+            self._marks -= 1
+        return self._mark_ticks[self._mark_first]
+
+    def _frame(self):
+        # Find the next complete '$...\n' sentence or UBX frame at the tail
+        # of the ring without copying it, unless it wraps. On success it is
+        # described by _sbuf/_sstart/_send and True is returned.
+        ring = self._ring
+        size = len(ring)
+        while self._scanned < self._used:
+            char = ring[(self._tail + self._scanned) % size]
+            if not self._in_sentence:
+                # Skip noise until the start of a sentence or UBX frame.
+                if char == 36:  # '$'
+                    self._in_sentence = True
+                    self._scanned = 1
+                    continue
+                if char == _UBX_SYNC1:
+                    length = self._ubx_length()
+                    if length == 0:
+                        return False  # wait for the rest of the frame
+                    if length > 0:
+                        self._scanned = length
+                        self._is_ubx = True
+                        break
+                self._tail = (self._tail + 1) % size
+                self._used -= 1
+                continue
+            if char == 10:  # '\n'
+                self._scanned += 1
+                break
+            if char == 36 or self._scanned >= _MAX_SENTENCE:
+                # A new sentence began before this one ended, or it is too
+                # long to be NMEA: drop what we have and resync.
+                self.partial_sentences += 1
+                self._tail = (self._tail + self._scanned) % size
+                self._used -= self._scanned
+                self._scanned = 0
+                self._in_sentence = False
+                continue
+            self._scanned += 1
+        else:
+            return False
+        length = self._scanned
+        start = self._tail
+        if start + length <= size:
+            buf = ring
+        else:
+            # Copy the two halves of a wrapped sentence into _line.
+            first = size - start
+            buf = self._line
+            buf[0:first] = self._ring_mv[start:size]
+            buf[first:length] = self._ring_mv[0:length - first]
+            start = 0
+        end = start + length
+        if not self._is_ubx:
+            end -= 1  # '\n'
+            if end > start and buf[end - 1] == 13:  # '\r'
+                end -= 1
+        self._sbuf = buf
+        self._sstart = start
+        self._send = end
+        return True
+
+    def _ubx_length(self):
+        # Length of the UBX frame at the tail of the ring: 0 while it is
+        # still coming in, -1 if the tail does not start a usable frame.
+        ring = self._ring
+        size = len(ring)
+        tail = self._tail
+        if self._used < 2:
+            return 0
+        if ring[(tail + 1) % size] != _UBX_SYNC2:
+            return -1
+        if self._used < 6:
+            return 0
+        length = ring[(tail + 4) % size] | ring[(tail + 5) % size] << 8
+        if length > _MAX_SENTENCE - 8:
+            self.partial_sentences += 1
+            return -1
+        if self._used < length + 8:
+            return 0
+        return length + 8
+
+    def _consume(self):
+        # Release the sentence returned by the last successful _frame().
+        self._tail = (self._tail + self._scanned) % len(self._ring)
+        self._used -= self._scanned
+        self._scanned = 0
+        self._in_sentence = False
+        self._is_ubx = False
+
+    def _check_sentence(self, buf, start, end):
+        # Validate the optional '*hh' checksum of the sentence in
+        # buf[start:end] in place. Strips the checksum from _send on success.
+        if end - start > 7 and buf[end - 3] == 42:  # '*'
+            expected = _hex_value(buf[end - 2]) << 4 | _hex_value(buf[end - 1])
+            actual = 0
+            for i in range(start + 1, end - 3):
+                actual ^= buf[i]
+            if actual != expected:
+                self.checksum_errors += 1
+                return False
+            self._send = end - 3
+        return True
+
+    # Field decoder. A sentence is decoded by walking it once from left to
+    # right: _fields() points the cursor at the first field and each
+    # _next_*() call decodes one field and steps past its comma. Values are
+    # accumulated digit by digit as small ints, so no strings, lists or
+    # intermediate floats are created.
+    def _fields(self, buf, pos, end):
+        self._fbuf = buf
+        self._fpos = pos
+        self._fend = end
+
+    def _field_count(self):
+        # Number of fields from the cursor to the end of the sentence.
+        buf = self._fbuf
+        count = 1
+        for i in range(self._fpos, self._fend):
+            if buf[i] == 44:  # ','
+                count += 1
+        return count
+
+    def _skip(self):
+        # Step over one field.
+        buf = self._fbuf
+        pos = self._fpos
+        end = self._fend
+        while pos < end and buf[pos] != 44:
+            pos += 1
+        self._fpos = pos + 1
+
+    def _next_char(self):
+        # First character of the field, lower-cased, or 0 if it is empty.
+        char = 0
+        if self._fpos < self._fend and self._fbuf[self._fpos] != 44:
+            char = self._fbuf[self._fpos] | 0x20
+        self._skip()
+        return char
+
+    def _next_fixed(self, decimals):
+        # Decimal field as an int scaled by 10**decimals, or None if the
+        # field is empty. Surplus fraction digits are truncated. The number
+        # of digits before the decimal point is left in _fdigits.
+        buf = self._fbuf
+        pos = self._fpos
+        end = self._fend
+        value = 0
+        digits = 0
+        fraction = -1
+        negative = False
+        while pos < end:
+            char = buf[pos]
+            if char == 44:  # ','
+                break
+            if 48 <= char <= 57:
+                if fraction < 0:
+                    value = value * 10 + char - 48
+                    digits += 1
+                elif fraction < decimals:
+                    value = value * 10 + char - 48
+                    fraction += 1
+            elif char == 46:  # '.'
+                fraction = 0
+            elif char == 45:  # '-'
+                negative = True
+            pos += 1
+        self._fpos = pos + 1
+        self._fdigits = digits
+        if digits == 0 and fraction <= 0:
+            return None
+        if fraction < 0:
+            fraction = 0
+        while fraction < decimals:
+            value *= 10
+            fraction += 1
+        return -value if negative else value
+
+    def _next_float(self, decimals):
+        # Decimal field as a float, or None if the field is empty.
+        value = self._next_fixed(decimals)
+        if value is None:
+            return None
+        return value / _POW10[decimals]
+
+    def _next_degrees(self):
+        # NMEA 'dddmm.mmmm' angle and its hemisphere field as signed integer
+        # micro-degrees, or None. Whole minutes and up to six minute
+        # decimals are scaled to micro-minutes, which keeps every
+        # intermediate value a small int.
+        buf = self._fbuf
+        pos = self._fpos
+        end = self._fend
+        whole = 0
+        digits = 0
+        minutes = 0
+        scale = -1
+        while pos < end:
+            char = buf[pos]
+            if char == 44:  # ','
+                break
+            if 48 <= char <= 57:
+                if scale < 0:
+                    whole = whole * 10 + char - 48
+                    digits += 1
+                elif scale:
+                    minutes += (char - 48) * scale
+                    scale //= 10
+            elif char == 46:  # '.'
+                scale = 100000
+            pos += 1
+        self._fpos = pos + 1
+        hemisphere = self._next_char()
+        if digits < 3:
+            return None
+        minutes += (whole % 100) * 1000000
+        udeg = (whole // 100) * 1000000 + (minutes + 30) // 60
+        if hemisphere == 115 or hemisphere == 119:  # 's', 'w'
+            udeg = -udeg
+        return udeg
+
+    def _set_time(self, time_utc):
+        # Set or update the time of day of timestamp_utc from 'hhmmss'.
+        if time_utc is None:
+            return
+        hours = time_utc // 10000
+        mins = (time_utc // 100) % 100
+        secs = time_utc % 100
+        # Set or update time to a friendly python time struct.
+        if self.timestamp_utc is not None:
+            self.timestamp_utc = (
+                self.timestamp_utc[0], self.timestamp_utc[1],
+                self.timestamp_utc[2], hours, mins, secs, 0, 0)
+        else:
+            self.timestamp_utc = (0, 0, 0, hours, mins, secs, 0, 0)
+
+    def _parse_gga(self, buf, pos, end):
+        # Parse the fields (everything after data type) in buf[pos:end] of
+        # a NMEA GGA 3D location fix sentence.
+        self._fields(buf, pos, end)
+        if self._field_count() != 14:
             return  # Unexpected number of params.
         # Parse fix time.
-        time_utc = int(_parse_float(data[0]))
-        if time_utc is not None:
-            hours = time_utc // 10000
-            mins = (time_utc // 100) % 100
-            secs = time_utc % 100
-            # Set or update time to a friendly python time struct.
-            if self.timestamp_utc is not None:
-                self.timestamp_utc = (
-                    self.timestamp_utc[0], self.timestamp_utc[1],
-                    self.timestamp_utc[2], hours, mins, secs, 0, 0)
-            else:
-                self.timestamp_utc = (0, 0, 0, hours, mins, secs, 0, 0)
+        self._set_time(self._next_fixed(0))
         # Parse latitude and longitude.
-        self.latitude = _parse_degrees(data[1])
-        if self.latitude is not None and \
-           data[2] is not None and data[2].lower() == b's':
-            self.latitude *= -1.0
-        self.longitude = _parse_degrees(data[3])
-        if self.longitude is not None and \
-           data[4] is not None and data[4].lower() == b'w':
-            self.longitude *= -1.0
+        self.latitude_udeg = self._next_degrees()
+        self.longitude_udeg = self._next_degrees()
         # Parse out fix quality and other simple numeric values.
-        self.fix_quality = _parse_int(data[5])
-        self.satellites = _parse_int(data[6])
-        self.horizontal_dilution = _parse_float(data[7])
-        self.altitude_m = _parse_float(data[8])
-        self.height_geoid = _parse_float(data[10])
-
-    def _parse_gprmc(self, args):
-        # Parse the arguments (everything after data type) for NMEA GPRMC
-        # minimum location fix sentence.
-        data = args.split(b',')
-        if data is None or len(data) < 11 or data[0] is None:
+        self.fix_quality = self._next_fixed(0)
+        self.satellites = self._next_fixed(0)
+        self.horizontal_dilution = self._next_float(2)
+        self.altitude_cm = self._next_fixed(2)
+        self._skip()  # altitude units
+        self.height_geoid = self._next_float(2)
+        if self.has_fix:
+            self._fix_completed()
+
+    def _fix_completed(self):
+        # Called once per epoch when a sentence with a valid 3D position
+        # (GGA or NAV-PVT) has been parsed.
+        self.fix_count += 1
+        self.fix_ticks_us = self._rx_ticks
+        if self.ttff_ms is None:
+            self.ttff_ms = time.ticks_diff(time.ticks_ms(), self._start_ms)
+        if self.history is not None and self.latitude_udeg is not None \
+           and self.longitude_udeg is not None:
+            self.history.append(self._rx_ticks, self.latitude_udeg,
+                                self.longitude_udeg, self.altitude_cm or 0)
+
+    def save_fix(self, path):
+        """Store the current position and UTC date/time in path, to be
+        replayed with `assist` after the next boot. Returns False if there
+        is no fix with a full timestamp to store yet.
+        """
+        if not self.has_fix or self.latitude_udeg is None \
+           or self.longitude_udeg is None or self.timestamp_utc is None \
+           or not self.timestamp_utc[0]:
+            return False
+        with open(path, 'wb') as f:
+            f.write(pack(_SAVED_FIX, self.latitude_udeg, self.longitude_udeg,
+                         self.altitude_cm or 0, *self.timestamp_utc[:6]))
+        return True
+
+    def assist(self, position, utc=None, timeout_ms=1000):
+        """Give the receiver an approximate position and the current UTC time
+        so it can skip most of a cold start: PMTK741 for MTK receivers, or
+        MGA-INI-POS_LLH and MGA-INI-TIME_UTC in UBX mode.
+
+        :param position: (latitude micro-degrees, longitude micro-degrees,
+            altitude cm), as returned by `load_fix`.
+        :param utc: The current time as (year, month, day, hour, minute,
+            second), or None if it isn't known. A time that is off by more
+            than a few seconds, such as the one saved with an old fix, makes
+            acquisition slower, not faster. Without it only the position is
+            sent in UBX mode; PMTK741 needs both, so MTK receivers get
+            nothing and False is returned.
+
+        Returns True if the receiver took the data. MGA messages are not
+        acknowledged by default, so in UBX mode that is assumed.
+        """
+        latitude, longitude, altitude = position
+        if self.ubx:
+            payload = bytearray(20)
+            payload[0] = 0x01  # POS_LLH
+            payload[4:16] = pack('<3i', latitude * 10, longitude * 10, altitude)
+            payload[16:20] = pack('<I', 100000)  # 1 km accuracy, in cm
+            self.send_ubx(_UBX_MGA, _UBX_MGA_INI, payload)
+            self.assisted = True
+            if utc is None:
+                return True
+            payload = bytearray(24)
+            payload[0] = 0x10  # TIME_UTC
+            payload[3] = 0x80  # leap seconds unknown
+            payload[4:11] = pack('<H5B', *utc)
+            payload[16:18] = pack('<H', 10)  # 10 s accuracy
+            self.send_ubx(_UBX_MGA, _UBX_MGA_INI, payload)
+        elif utc is None:
+            return False
+        else:
+            self.assisted = self._send_pmtk(
+                'PMTK741,{},{},{},{},{:02d},{:02d},{:02d},{:02d},{:02d}'.format(
+                    _udeg_str(latitude), _udeg_str(longitude), altitude // 100,
+                    *utc), timeout_ms)
+        return self.assisted
+
+    def position_at(self, ticks):
+        """Return the position at ticks (a ``time.ticks_us()`` value) as
+        (latitude micro-degrees, longitude micro-degrees, altitude cm),
+        interpolated between the received fixes around it, or None when the
+        history does not cover ticks. Needs history_size.
+        """
+        if self.history is None:
+            raise ValueError('position_at needs a GPS created with history_size')
+        return self.history.position_at(ticks)
+
+    def _parse_rmc(self, buf, pos, end):
+        # Parse the fields (everything after data type) in buf[pos:end] of
+        # a NMEA RMC minimum location fix sentence.
+        self._fields(buf, pos, end)
+        if self._field_count() < 11:
             return  # Unexpected number of params.
         # Parse fix time.
-        time_utc = int(_parse_float(data[0]))
-        if time_utc is not None:
-            hours = time_utc // 10000
-            mins = (time_utc // 100) % 100
-            secs = time_utc % 100
-            # Set or update time to a friendly python time struct.
-            if self.timestamp_utc is not None:
-                self.timestamp_utc = (
-                    self.timestamp_utc[0], self.timestamp_utc[1],
-                    self.timestamp_utc[2], hours, mins, secs, 0, 0)
-            else:
-                self.timestamp_utc = (0, 0, 0, hours, mins, secs, 0, 0)
+        self._set_time(self._next_fixed(0))
         # Parse status (active/fixed or void).
-        status = data[1]
-        self.fix_quality = 0
-        if status is not None and status.lower() == b'a':
-            self.fix_quality = 1
+        self.fix_quality = 1 if self._next_char() == 97 else 0  # 'a'
         # Parse latitude and longitude.
-        self.latitude = _parse_degrees(data[2])
-        if self.latitude is not None and \
-           data[3] is not None and data[3].lower() == b's':
-            self.latitude *= -1.0
-        self.longitude = _parse_degrees(data[4])
-        if self.longitude is not None and \
-           data[5] is not None and data[5].lower() == b'w':
-            self.longitude *= -1.0
+        self.latitude_udeg = self._next_degrees()
+        self.longitude_udeg = self._next_degrees()
         # Parse out speed and other simple numeric values.
-        self.speed_knots = _parse_float(data[6])
-        self.track_angle_deg = _parse_float(data[7])
+        self.speed_knots = self._next_float(3)
+        self.track_angle_deg = self._next_float(2)
         # Parse date.
-        if data[8] is not None and len(data[8]) == 6:
-            day = int(data[8][0:2])
-            month = int(data[8][2:4])
-            year = 2000 + int(data[8][4:6])  # Y2k bug, 2 digit date assumption.
-                                             # This is a problem with the NMEA
-                                             # spec and not this code.
+        date = self._next_fixed(0)
+        if date is not None and self._fdigits == 6:
+            day = date // 10000
+            month = (date // 100) % 100
+            year = 2000 + date % 100  # Y2k bug, 2 digit date assumption.
+                                      # This is a problem with the NMEA
+                                      # spec and not this code.
             if self.timestamp_utc is not None:
                 # Replace the timestamp with an updated one.
                 self.timestamp_utc = (year, month, day,
-                                                       self.timestamp_utc[3],
-                                                       self.timestamp_utc[4],
-                                                       self.timestamp_utc[5],
-                                                       0,
-                                                       0)
+                                      self.timestamp_utc[3],
+                                      self.timestamp_utc[4],
+                                      self.timestamp_utc[5],
+                                      0,
+                                      0)
             else:
                 # Time hasn't been set so create it.
                 self.timestamp_utc = (year, month, day, 0, 0, 0, 0, 0)
+
+    def _parse_gsa(self, buf, pos, end):
+        # Parse a NMEA GSA sentence: fix type and dilution of precision.
+        # Multi-GNSS receivers send one per constellation; the DOP values
+        # are for the combined solution, so the last one wins.
+        self._fields(buf, pos, end)
+        if self._field_count() < 17:
+            return  # Unexpected number of params.
+        self._skip()  # selection mode, M or A
+        self.fix_type = self._next_fixed(0)
+        for _ in range(12):
+            self._skip()  # PRNs of the satellites used
+        self.pdop = self._next_float(2)
+        self.horizontal_dilution = self._next_float(2)
+        self.vdop = self._next_float(2)
+
+    def _parse_gsv(self, buf, pos, end):
+        # Parse a NMEA GSV sentence: satellites in view. One view is spread
+        # over a group of up to 4 satellites per sentence, with a group per
+        # constellation. Satellites are collected as the parts arrive and
+        # published when the last part of a group is in. Seeing the first
+        # part of a constellation's group again starts the next cycle.
+        self._fields(buf, pos, end)
+        total = self._next_fixed(0)
+        number = self._next_fixed(0)
+        in_view = self._next_fixed(0)
+        if total is None or number is None or in_view is None:
+            return
+        if number == 1:
+            talker = 1 << (buf[pos - 5] & 0x1F)
+            if self._gsv_talkers & talker:
+                self._gsv_count = 0
+                self._gsv_in_view = 0
+                self._gsv_talkers = 0
+            self._gsv_talkers |= talker
+            self._gsv_in_view += in_view
+        # Only whole PRN/elevation/azimuth/SNR blocks; NMEA 4.1 appends a
+        # signal ID field after them.
+        for _ in range(self._field_count() // 4):
+            prn = self._next_fixed(0)
+            self._skip()  # elevation
+            self._skip()  # azimuth
+            snr = self._next_fixed(0)
+            if prn is None or self._gsv_count >= _MAX_SATELLITES:
+                continue
+            self._gsv_prn[self._gsv_count] = prn
+            self._gsv_snr[self._gsv_count] = snr or 0
+            self._gsv_count += 1
+        if number == total:
+            for i in range(self._gsv_count):
+                self.satellite_prn[i] = self._gsv_prn[i]
+                self.satellite_snr[i] = self._gsv_snr[i]
+            self.satellites_tracked = self._gsv_count
+            self.satellites_in_view = self._gsv_in_view
+
+    def _parse_vtg(self, buf, pos, end):
+        # Parse a NMEA VTG sentence: track made good and ground speed.
+        self._fields(buf, pos, end)
+        if self._field_count() < 8:
+            return  # Unexpected number of params.
+        self.track_angle_deg = self._next_float(2)
+        self._skip()  # T
+        self._skip()  # magnetic track
+        self._skip()  # M
+        self.speed_knots = self._next_float(3)
+        self._skip()  # N
+        self.speed_kmh = self._next_float(3)
+
+    def _parse_nav_pvt(self, buf, pos, end):
+        # Parse the 92 byte payload of a UBX NAV-PVT message at buf[pos:]
+        # into the same attributes the GGA and RMC sentences fill.
+        (year, month, day, hour, minute, second, valid, fix_type, flags,
+         satellites, lon, lat, height, height_msl, ground_speed, heading,
+         pdop) = unpack_from('<4xH6B8x2BxB4i20x2i8xH', buf, pos)
+        if valid & 0x03 == 0x03:  # validDate and validTime
+            self.timestamp_utc = (year, month, day, hour, minute, second, 0, 0)
+        # fixType: 2 = 2D, 3 = 3D, 4 = GNSS + dead reckoning.
+        if 2 <= fix_type <= 4:
+            self.fix_type = 2 if fix_type == 2 else 3
+        else:
+            self.fix_type = 1
+        self.fix_quality = 1 if flags & 0x01 and self.fix_type > 1 else 0
+        self.satellites = satellites
+        # Position comes in 1e-7 degrees and millimetres.
+        self.latitude_udeg = (lat + 5) // 10
+        self.longitude_udeg = (lon + 5) // 10
+        self.altitude_cm = (height_msl + 5) // 10
+        self.height_geoid = (height - height_msl) / 1000
+        self.speed_knots = ground_speed / 514.444  # mm/s per knot
+        self.track_angle_deg = heading / 100000
+        self.pdop = pdop / 100
+        if self.has_fix:
+            self._fix_completed()
@@ -33,6 +33,22 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import time
 from machine import I2C
 from array import array
+from ustruct import unpack
+from calibration import load_calibration, save_calibration
+
+
+def _crc4(prom):
+    # CRC-4 of the 16 PROM bytes as in MEAS AN520, with the CRC nibble in the
+    # last byte counted as 0. Compared against prom[15] & 0x0F.
+    rem = 0
+    for i in range(16):
+        rem ^= prom[i] if i < 15 else 0
+        for _ in range(8):
+            if rem & 0x8000:
+                rem = ((rem << 1) ^ 0x3000) & 0xFFFF
+            else:
+                rem = (rem << 1) & 0xFFFF
+    return (rem >> 12) & 0x0F
 
 class MS5611:
     __MS5611_ADDRESS_CSB_LOW  = 0x76
@@ -63,9 +79,27 @@ class MS5611:
     __MS5611_RA_D2_OSR_2048   = 0x56
     __MS5611_RA_D2_OSR_4096   = 0x58
 
-    def __init__(self, i2c, address=0x77):
+    # Supported oversampling ratios and their maximum conversion times from the
+    # datasheet, in microseconds. The command for OSR n is D1/D2_OSR_256 + 2 * n.
+    __MS5611_OSR              = (256, 512, 1024, 2048, 4096)
+    __MS5611_CONVERSION_US    = (600, 1170, 2280, 4540, 9040)
+
+    # Key of the PROM in the calibration cache file (with the address)
+    __CALIBRATION_TAG         = 0x4D
+
+    # Measurement states for start()/poll()
+    __STATE_IDLE              = 0
+    __STATE_PRESSURE          = 1
+    __STATE_TEMPERATURE       = 2
+
+    def __init__(self, i2c, address=0x77, osr=4096, temperature_every=1, drift_limit_cdeg=10,
+                 calibration_file=None):
         self.i2c = i2c
         self.address = address
+        # Optional file the PROM is cached in (see lib/calibration.py), and
+        # whether this boot used the cached copy
+        self.calibration_file = calibration_file
+        self.calibration_cached = False
         self.C1 = 0
         self.C2 = 0
         self.C3 = 0
@@ -74,72 +108,186 @@ class MS5611:
         self.C6 = 0
         self.D1 = 0
         self.D2 = 0
-        self.TEMP = 0.0  # Calculated temperature
-        self.PRES = 0.0  # Calculated Pressure
-        
+        self.temperature_cdeg = 0  # Calculated temperature, 0.01 degC
+        self.pressure_pa = 0       # Calculated pressure, Pa (0.01 mbar)
+
+        # I2C buffers which stay allocated, so sampling doesn't allocate
+        self._cmd = bytearray(1)
+        self._adc = bytearray(3)
+
+        # Oversampling ratio for the next measurement, and the one TEMP/PRES were
+        # measured at. osr_policy, if set, is called by start() and returns the OSR
+        # to use, so it can follow the flight phase.
+        self.osr = 0
+        self.sample_osr = 0
+        self.osr_policy = None
+        self._osr_command = 0
+        self._conversion_us = 0
+        self.set_osr(osr)
+
+        # Non-blocking measurement: the conversion in progress and when it was started
+        self.ready = False
+        self._state = self.__STATE_IDLE
+        self._started = 0
+        self._started_osr = 0
+        self._wait_us = 0
+
+        # Temperature decimation: a temperature conversion is done for one in
+        # temperature_every measurements, or sooner once the temperature is
+        # estimated to have drifted drift_limit_cdeg since the last one. The
+        # estimate extrapolates the change between the last two conversions.
+        # The other measurements only convert pressure and reuse D2.
+        self.temperature_every = temperature_every
+        self.drift_limit_cdeg = drift_limit_cdeg
+        self._since_temperature = 0     # measurements since the last temperature conversion
+        self._temperature_step = 0      # |change| at the last temperature conversion, 0.01 degC
+        self._temperature_interval = 1  # measurements that change was spread over
+        self._with_temperature = True
+        self._off = 0                   # OFF and SENS at the last temperature
+        self._sens = 0
+
+        # Throughput: completed measurements, temperature conversions, and the
+        # pressure sample rate over the last second
+        self.samples = 0
+        self.temperature_samples = 0
+        self.pressure_rate_hz = 0
+        self._rate_count = 0
+        self._rate_start = time.ticks_us()
+
         self.initialize()
 
     def initialize(self):
         # The MS6511 Sensor stores 6 values in the EPROM memory that we need in order to calculate the actual temperature and pressure
         # These values are calculated/stored at the factory when the sensor is calibrated.
-        # I probably could have used the read word function instead of the whole block, but I wanted to keep things consistent.
-        C1 = self.i2c.readfrom_mem(self.address, self.__MS5611_RA_C1, 2)  # Pressure Sensitivity
-        C2 = self.i2c.readfrom_mem(self.address, self.__MS5611_RA_C2, 2)  # Pressure Offset
-        C3 = self.i2c.readfrom_mem(self.address, self.__MS5611_RA_C3, 2)  # Temperature coefficient of pressure sensitivity
-        C4 = self.i2c.readfrom_mem(self.address, self.__MS5611_RA_C4, 2)  # Temperature coefficient of pressure offset
-        C5 = self.i2c.readfrom_mem(self.address, self.__MS5611_RA_C5, 2)  # Reference temperature
-        C6 = self.i2c.readfrom_mem(self.address, self.__MS5611_RA_C6, 2)  # Temperature coefficient of the temperature
-
-        # Again here we are converting the 2 8bit packages into a single decimal
-        self.C1 = C1[0] * 256.0 + C1[1]
-        self.C2 = C2[0] * 256.0 + C2[1]
-        self.C3 = C3[0] * 256.0 + C3[1]
-        self.C4 = C4[0] * 256.0 + C4[1]
-        self.C5 = C5[0] * 256.0 + C5[1]
-        self.C6 = C6[0] * 256.0 + C6[1]
+        # The whole PROM (C0 factory data, C1..C6, C7 ending in a CRC-4) is read so the CRC can be checked.
+        # If a copy was cached at an earlier boot, only C7 is read back to check it's the same sensor.
+        prom = None
+        if self.calibration_file:
+            prom = load_calibration(self.calibration_file, self.__CALIBRATION_TAG, self.address)
+            if prom is not None and (len(prom) != 16 or _crc4(prom) != prom[15] & 0x0F or
+                                     self.i2c.readfrom_mem(self.address, self.__MS5611_RA_C7, 2) != prom[14:]):
+                prom = None
+            self.calibration_cached = prom is not None
+        if prom is None:
+            prom = self.readPROM()
+            if _crc4(prom) != prom[15] & 0x0F:
+                raise RuntimeError("MS5611 PROM CRC error")
+            if self.calibration_file:
+                save_calibration(self.calibration_file, self.__CALIBRATION_TAG, self.address, prom)
+
+        # C1 Pressure Sensitivity
+        # C2 Pressure Offset
+        # C3 Temperature coefficient of pressure sensitivity
+        # C4 Temperature coefficient of pressure offset
+        # C5 Reference temperature
+        # C6 Temperature coefficient of the temperature
+        _, self.C1, self.C2, self.C3, self.C4, self.C5, self.C6, _ = unpack(">8H", prom)
+
+        # The calibration terms of the compensation that don't depend on the readings
+        self._c5_ref = self.C5 << 8     # C5 * 2^8, reference temperature reading
+        self._off_ref = self.C2 << 16   # C2 * 2^16, offset at reference temperature
+        self._sens_ref = self.C1 << 15  # C1 * 2^15, sensitivity at reference temperature
 
         self.update()
 
-    def refreshPressure(self, OSR=__MS5611_RA_D1_OSR_4096):
-        self.i2c.writeto(self.address, bytes([OSR]))
+    def readPROM(self):
+        # The PROM is read one 16-bit word per command, there is no burst read
+        prom = bytearray(16)
+        words = memoryview(prom)
+        for i in range(8):
+            self.i2c.readfrom_mem_into(self.address, self.__MS5611_RA_C0 + 2 * i, words[2 * i:2 * i + 2])
+        return prom
 
-    def refreshTemperature(self, OSR=__MS5611_RA_D2_OSR_4096):
-        self.i2c.writeto(self.address, bytes([OSR]))
+    def set_osr(self, osr):
+        # Select the oversampling ratio (256, 512, 1024, 2048 or 4096) used from
+        # the next start() on. Higher is less noisy, lower converts faster.
+        if osr == self.osr:
+            return
+        if osr not in self.__MS5611_OSR:
+            raise ValueError("unsupported OSR {}".format(osr))
+        index = self.__MS5611_OSR.index(osr)
+        self.osr = osr
+        self._osr_command = index << 1
+        self._conversion_us = self.__MS5611_CONVERSION_US[index]
+
+    def conversion_us(self, osr=None):
+        # Maximum time one conversion takes at osr (default: the current one)
+        if osr is None:
+            return self._conversion_us
+        return self.__MS5611_CONVERSION_US[self.__MS5611_OSR.index(osr)]
+
+    def refreshPressure(self, OSR=None):
+        if OSR is None:
+            OSR = self.__MS5611_RA_D1_OSR_256 + self._osr_command
+        self._cmd[0] = OSR
+        self.i2c.writeto(self.address, self._cmd)
+
+    def refreshTemperature(self, OSR=None):
+        if OSR is None:
+            OSR = self.__MS5611_RA_D2_OSR_256 + self._osr_command
+        self._cmd[0] = OSR
+        self.i2c.writeto(self.address, self._cmd)
 
     def readPressure(self):
-        D1 = self.i2c.readfrom_mem(self.address, self.__MS5611_RA_ADC, 3)
-        self.D1 = D1[0] * 65536 + D1[1] * 256.0 + D1[2]
+        self.D1 = self.readADC()
 
     def readTemperature(self):
-        D2 = self.i2c.readfrom_mem(self.address, self.__MS5611_RA_ADC, 3)
-        self.D2 = D2[0] * 65536 + D2[1] * 256.0 + D2[2]
+        self.D2 = self.readADC()
+
+    def readADC(self):
+        # 24-bit result of the last conversion, read into the persistent buffer
+        adc = self._adc
+        self.i2c.readfrom_mem_into(self.address, self.__MS5611_RA_ADC, adc)
+        return adc[0] << 16 | adc[1] << 8 | adc[2]
 
     def calculatePressureAndTemperature(self):
-        dT = self.D2 - self.C5 * 2**8
-        self.TEMP = 2000 + dT * self.C6 / 2**23
+        # First and second order compensation exactly as in the datasheet, in
+        # integer arithmetic (divisions by 2^N are shifts). TEMP is in degC and
+        # PRES in Pa; temperature_cdeg and pressure_pa keep the exact values.
+        self.calculateTemperature()
+        self.calculatePressure()
 
-        OFF = self.C2 * 2**16 + (self.C4 * dT) / 2**7
-        SENS = self.C1 * 2**15 + (self.C3 * dT) / 2**8
+    def calculateTemperature(self):
+        # The D2 half of the compensation: TEMP, and the OFF and SENS terms
+        # calculatePressure() applies to every D1 until the next D2.
+        dT = self.D2 - self._c5_ref
+        temp = 2000 + ((dT * self.C6) >> 23)
+        off = self._off_ref + ((self.C4 * dT) >> 7)
+        sens = self._sens_ref + ((self.C3 * dT) >> 8)
 
-        if (self.TEMP >= 2000):
-            T2 = 0
-            OFF2 = 0
-            SENS2 = 0
-        elif (self.TEMP < 2000):
-            T2 = dT * dT / 2**31
-            OFF2 = 5 * ((self.TEMP - 2000) ** 2) / 2
-            SENS2 = OFF2 / 2
-        elif (self.TEMP < -1500):
-            OFF2 = OFF2 + 7 * ((self.TEMP + 1500) ** 2)
-            SENS2 = SENS2 + 11 * (self.TEMP + 1500) ** 2 / 2
+        if temp < 2000:
+            # Low temperature
+            t2 = (dT * dT) >> 31
+            low = temp - 2000
+            low = 5 * low * low
+            off2 = low >> 1
+            sens2 = low >> 2
+            if temp < -1500:
+                # Very low temperature
+                very_low = temp + 1500
+                very_low *= very_low
+                off2 += 7 * very_low
+                sens2 += (11 * very_low) >> 1
+            temp -= t2
+            off -= off2
+            sens -= sens2
 
-        self.TEMP = self.TEMP - T2
-        OFF = OFF - OFF2
-        SENS = SENS - SENS2
+        self.temperature_cdeg = temp
+        self._off = off
+        self._sens = sens
 
-        self.PRES = (self.D1 * SENS / 2**21 - OFF) / 2**15
+    def calculatePressure(self):
+        self.pressure_pa = (((self.D1 * self._sens) >> 21) - self._off) >> 15
 
-        self.TEMP = self.TEMP / 100  # Temperature updated
+    @property
+    def TEMP(self):
+        # Calculated temperature, degC
+        return self.temperature_cdeg / 100
+
+    @property
+    def PRES(self):
+        # Calculated pressure, Pa
+        return self.pressure_pa
 
     def returnPressure(self):
         return self.PRES
@@ -147,15 +295,87 @@ class MS5611:
     def returnTemperature(self):
         return self.TEMP
 
-    def update(self):
+    def temperature_due(self):
+        # True if the next measurement has to convert temperature as well
+        since = self._since_temperature
+        if self.temperature_samples == 0 or since + 1 >= self.temperature_every:
+            return True
+        drift = self._temperature_step * (since + 1) // self._temperature_interval
+        return drift >= self.drift_limit_cdeg
+
+    def start(self):
+        # Start a pressure (and, when due, temperature) measurement and return
+        # straight away. Call poll() from the main loop until it returns True.
+        if self.osr_policy is not None:
+            self.set_osr(self.osr_policy())
+        self.ready = False
+        self._with_temperature = self.temperature_due()
+        self._started_osr = self.osr
+        self._wait_us = self._conversion_us
         self.refreshPressure()
-        time.sleep(0.01)
-        self.readPressure()
-        self.refreshTemperature()
-        time.sleep(0.01)
-        self.readTemperature()
-        self.calculatePressureAndTemperature()
+        self._started = time.ticks_us()
+        self._state = self.__STATE_PRESSURE
+
+    def poll(self):
+        # Move the measurement started by start() along without waiting: read
+        # the ADC once the running conversion has had its conversion time, then
+        # start the next one. Returns True (and sets ready) once TEMP and PRES
+        # hold the new values.
+        if self._state == self.__STATE_IDLE:
+            return self.ready
+        if time.ticks_diff(time.ticks_us(), self._started) < self._wait_us:
+            return False
+        if self._state == self.__STATE_PRESSURE:
+            self.readPressure()
+            if self._with_temperature:
+                self.refreshTemperature()
+                self._started = time.ticks_us()
+                self._state = self.__STATE_TEMPERATURE
+                return False
+            self._since_temperature += 1
+        else:
+            self.readTemperature()
+            previous = self.temperature_cdeg
+            self.calculateTemperature()
+            if self.temperature_samples:
+                self._temperature_step = abs(self.temperature_cdeg - previous)
+                self._temperature_interval = self._since_temperature + 1
+            self.temperature_samples += 1
+            self._since_temperature = 0
+        self.calculatePressure()
+        self.sample_osr = self._started_osr
+        self._state = self.__STATE_IDLE
+        self.ready = True
+        self._count_sample()
+        return True
+
+    def _count_sample(self):
+        self.samples += 1
+        self._rate_count += 1
+        now = time.ticks_us()
+        elapsed = time.ticks_diff(now, self._rate_start)
+        if elapsed >= 1000000:
+            self.pressure_rate_hz = self._rate_count * 1000000 // elapsed
+            self._rate_count = 0
+            self._rate_start = now
+
+    def update(self):
+        # Blocking measurement, waits out the conversions.
+        self.start()
+        while not self.poll():
+            time.sleep_us(100)
     
     def read_compensated_data(self):
         self.update()
         return array("f", (self.TEMP, self.PRES))
+
+    def read_into(self, result):
+        # Measure (blocking, like read_compensated_data) and store temperature in
+        # 0.01 degC and pressure in Pa into result, e.g. an array("i") of length 2,
+        # and the OSR too if it has a third element. Nothing is allocated; for
+        # non-blocking use, poll() and read the same attributes.
+        self.update()
+        result[0] = self.temperature_cdeg
+        result[1] = self.pressure_pa
+        if len(result) > 2:
+            result[2] = self.sample_osr
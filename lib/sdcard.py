@@ -18,14 +18,57 @@ Example usage on ESP8266:
     os.mount(sd, '/sd')
     os.listdir('/')
 
+With write_behind=True, writeblocks returns as soon as the card has taken
+the data, while it is still programming it; the wait for the card moves to
+the start of the next command. busy() tells whether the card is still
+programming and flush() waits for it.
+
+open_writer() starts a multi-block write that stays open across calls, for
+streaming a log to consecutive blocks:
+
+    w = sd.open_writer(first_block, count)
+    w.write(buf)         # whole blocks
+    w.payload[:] = ...   # or fill the send buffer in place...
+    w.write()            # ...and send it
+    w.close()
+
+With crc=True the card checks a CRC on every command and data block
+(CMD59), and the driver checks the CRC of every block it reads. A block
+that fails is sent or read again, up to ``retries`` times, before
+readblocks/writeblocks raise OSError; read_crc_errors, write_errors and
+retries count what happened.
+
+With wait=False the constructor only starts initialising the card;
+poll() continues without blocking and returns True once it is ready, so
+other devices can be set up meanwhile:
+
+    sd = sdcard.SDCard(spi, cs, wait=False)
+    ...
+    sd.finish()  # or: while not sd.poll(): ...
+
+autotune() raises the SPI clock as far as a spare block (past the
+partitions, see flightlog.unpartitioned_tail) reads back intact,
+and records the card's read and write latency at that rate. It needs
+crc=True: without the command CRC a write address garbled by a too fast
+clock would put the test pattern on whatever block it names.
+
 """
 
 from micropython import const
+from array import array
 import time
 
 
 _CMD_TIMEOUT = const(100)
 
+# initialisation: SPI clock (cards take at most 400 kHz until initialised),
+# ACMD41 interval doubling from _ACMD41_MIN_US to _ACMD41_MAX_US, timeout
+# in time polled for (see poll())
+_INIT_BAUDRATE = const(400000)
+_ACMD41_MIN_US = const(250)
+_ACMD41_MAX_US = const(8000)
+_INIT_TIMEOUT_MS = const(2000)
+
 _R1_IDLE_STATE = const(1 << 0)
 # R1_ERASE_RESET = const(1 << 1)
 _R1_ILLEGAL_COMMAND = const(1 << 2)
@@ -37,21 +80,123 @@ _TOKEN_CMD25 = const(0xFC)
 _TOKEN_STOP_TRAN = const(0xFD)
 _TOKEN_DATA = const(0xFE)
 
+# waiting for a data token or the end of busy: polls in a tight spin, then
+# sleeps doubling from _BACKOFF_MIN_US to _BACKOFF_MAX_US between polls
+_SPIN_POLLS = const(32)
+_BACKOFF_MIN_US = const(16)
+_BACKOFF_MAX_US = const(128)
+_READ_TIMEOUT_MS = const(100)
+_WRITE_TIMEOUT_MS = const(500)
+
+
+def _crc7_table():
+    # CRC7 (x^7 + x^3 + 1) of each byte value, shifted left by one
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x12) if crc & 0x80 else (crc << 1)
+        table[i] = crc & 0xFF
+    return table
+
+
+def _crc16_table():
+    # CRC16-CCITT (x^16 + x^12 + x^5 + 1) of each byte value
+    table = array("H", [0] * 256)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xFFFF
+    return table
+
+
+_CRC7_TABLE = _crc7_table()
+_CRC16_TABLE = _crc16_table()
+
+
+def _crc7(buf):
+    # last byte of a command: CRC7 of its first five bytes and the end bit
+    table = _CRC7_TABLE
+    crc = 0
+    for i in range(5):
+        crc = table[crc ^ buf[i]]
+    return crc | 1
+
+
+def crc16(buf):
+    """CRC16 of a data block as the card computes it, over any buffer."""
+    table = _CRC16_TABLE
+    crc = 0
+    for b in buf:
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ b]
+    return crc
+
+
+# clock rates tried by autotune(), rising
+_AUTOTUNE_RATES = (4000000, 8000000, 10000000, 12000000, 16000000, 20000000, 25000000)
+
+# busy_histogram[i] counts busy periods shorter than 128 << i us; the last
+# bin counts everything longer. Only periods whose end was seen are
+# counted: when the card is found already done, it could have finished any
+# time since the write, and busy_unmeasured counts that instead.
+_BUSY_BINS = const(12)
+
 
 class SDCard:
-    def __init__(self, spi, cs, baudrate=1320000):
+    def __init__(self, spi, cs, baudrate=1320000, write_behind=False, crc=False, retries=3,
+                 wait=True):
         self.spi = spi
         self.cs = cs
+        self.write_behind = write_behind
+        self.crc = False  # turned on at the end of init_card
+        self.max_retries = retries
+        self.read_crc_errors = 0  # blocks read with a bad CRC
+        self.write_errors = 0     # blocks the card rejected
+        self.retries = 0          # block transfers repeated
+
+        # card programming after a write: busy flag, start time, whether a
+        # poll has seen it busy, and statistics
+        self._busy = False
+        self._busy_start = 0
+        self._busy_seen = False
+        self.busy_histogram = array("I", [0] * _BUSY_BINS)
+        self.busy_max_us = 0
+        self.busy_unmeasured = 0  # busy periods over before the first poll
+        self.busy_wait_us = 0  # time spent blocked waiting for the card
 
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
+        self.respbuf = bytearray(4)  # R3/R7 response after the R1 byte
+        self.crcbuf = bytearray(2)   # CRC of the last block read
+        self.stopbuf = bytearray(b"\xfd\xff")  # stop token and one byte
+        # data block as sent: token, 512 bytes of payload, CRC
+        self.frame = bytearray(515)
+        self.frame[513] = 0xFF
+        self.frame[514] = 0xFF
+        self.frame_payload = memoryview(self.frame)[1:513]
+        self._writer = None  # open BlockWriter
+
         for i in range(512):
             self.dummybuf[i] = 0xFF
         self.dummybuf_memoryview = memoryview(self.dummybuf)
 
-        # initialise the card
-        self.init_card(baudrate)
+        # card profile, read_us and write_us are measured by autotune()
+        self.csd_version = 0
+        self.cid = None
+        self.baudrate = 0
+        self.ready = False
+        self.init_ms = None  # polled for until the card was ready, see poll()
+        self.read_us = None
+        self.write_us = None
+
+        # initialise the card, or with wait=False only start it and leave
+        # the rest to poll()
+        if wait:
+            self.init_card(baudrate, crc)
+        else:
+            self.begin(baudrate, crc)
 
     def init_spi(self, baudrate):
         try:
@@ -63,12 +208,25 @@ class SDCard:
             # on pyboard
             self.spi.init(master, baudrate=baudrate, phase=0, polarity=0)
 
-    def init_card(self, baudrate):
+    def init_card(self, baudrate, crc=False):
+        self.begin(baudrate, crc)
+        self.finish()
+
+    def begin(self, baudrate=1320000, crc=False):
+        """Start initialising the card: reset it and send the first ACMD41,
+        which sets off the card's own initialisation. poll() or finish()
+        complete it, switching to baudrate, with CRC checks if crc is True.
+        """
+        self.ready = False
+        self._init_start = time.ticks_us()
+        self._init_baudrate = baudrate
+        self._init_crc = crc
+
         # init CS pin
         self.cs.init(self.cs.OUT, value=1)
 
         # init SPI bus; use low data rate for initialisation
-        self.init_spi(100000)
+        self.init_spi(_INIT_BAUDRATE)
 
         # clock card at least 100 cycles with cs high
         for i in range(16):
@@ -84,18 +242,68 @@ class SDCard:
         # CMD8: determine card version
         r = self.cmd(8, 0x01AA, 0x87, 4)
         if r == _R1_IDLE_STATE:
-            self.init_card_v2()
+            self._version = 2
         elif r == (_R1_IDLE_STATE | _R1_ILLEGAL_COMMAND):
-            self.init_card_v1()
+            self._version = 1
         else:
             raise OSError("couldn't determine SD card version")
 
+        # ACMD41 polls, close together at first: most cards are ready after
+        # a few milliseconds
+        self._poll_us = _ACMD41_MIN_US
+        self._next_poll = self._init_start
+        self._last_poll = self._init_start
+        self._polled_us = 0
+        self.poll()
+
+    def poll(self):
+        """Continue initialising the card; returns True once it is ready.
+        Returns at once while the next ACMD41 isn't due, so it can be called
+        in between bringing up other devices.
+
+        The init timeout and init_ms count the time the card was polled
+        for: a poll more than _ACMD41_MAX_US after it was due only counts
+        up to that, so time spent elsewhere between polls doesn't run down
+        the timeout or add to init_ms.
+        """
+        if self.ready:
+            return True
+        now = time.ticks_us()
+        if time.ticks_diff(self._next_poll, now) > 0:
+            return False
+        self._polled_us += min(time.ticks_diff(now, self._last_poll),
+                               time.ticks_diff(self._next_poll, self._last_poll) + _ACMD41_MAX_US)
+        self._last_poll = now
+        # ACMD41, announcing SDHC/SDXC support (HCS) to a v2 card
+        self.cmd(55, 0, 0)
+        if self.cmd(41, 0x40000000 if self._version == 2 else 0, 0) != 0:
+            if self._polled_us > _INIT_TIMEOUT_MS * 1000:
+                raise OSError("timeout waiting for v{} card".format(self._version))
+            self._next_poll = time.ticks_add(time.ticks_us(), self._poll_us)
+            if self._poll_us < _ACMD41_MAX_US:
+                self._poll_us <<= 1
+            return False
+
+        if self._version == 2:
+            self.cmd(58, 0, 0, 4)
+            ocr = self.respbuf[0]  # first byte of the OCR
+            if not ocr & 0x40:
+                # SDSC card, uses byte addressing in read/write/erase commands
+                self.cdv = 512
+            else:
+                # SDHC/SDXC card, uses block addressing in read/write/erase commands
+                self.cdv = 1
+        else:
+            # SDSC card, uses byte addressing in read/write/erase commands
+            self.cdv = 512
+
         # get the number of sectors
         # CMD9: response R2 (R1 byte + 16-byte block read)
         if self.cmd(9, 0, 0, 0, False) != 0:
             raise OSError("no response from SD card")
         csd = bytearray(16)
         self.readinto(csd)
+        self.csd_version = (csd[0] >> 6) + 1
         if csd[0] & 0xC0 == 0x40:  # CSD version 2.0
             self.sectors = ((csd[8] << 8 | csd[9]) + 1) * 1024
         elif csd[0] & 0xC0 == 0x00:  # CSD version 1.0 (old, <=2GB)
@@ -108,53 +316,104 @@ class SDCard:
             raise OSError("SD card CSD format not supported")
         # print('sectors', self.sectors)
 
+        # CMD10: card identification (manufacturer, product name, serial)
+        self.cid = bytearray(16)
+        if self.cmd(10, 0, 0, 0, False) != 0:
+            raise OSError("no response from SD card")
+        self.readinto(self.cid)
+
         # CMD16: set block length to 512 bytes
         if self.cmd(16, 512, 0) != 0:
             raise OSError("can't set 512 block size")
 
-        # set to high data rate now that it's initialised
-        self.init_spi(baudrate)
+        # CMD59: CRC checks on; commands carry a real CRC from here on
+        if self._init_crc:
+            self.crc = True
+            if self.cmd(59, 1, 0) != 0:
+                raise OSError("can't enable SD card CRC")
 
-    def init_card_v1(self):
-        for i in range(_CMD_TIMEOUT):
-            time.sleep_ms(50)
-            self.cmd(55, 0, 0)
-            if self.cmd(41, 0, 0) == 0:
-                # SDSC card, uses byte addressing in read/write/erase commands
-                self.cdv = 512
-                # print("[SDCard] v1 card")
-                return
-        raise OSError("timeout waiting for v1 card")
+        # set to high data rate now that it's initialised
+        self.init_spi(self._init_baudrate)
+        self.baudrate = self._init_baudrate
+        self.init_ms = (self._polled_us + time.ticks_diff(time.ticks_us(), now)) // 1000
+        self.ready = True
+        return True
+
+    def finish(self):
+        """Wait until the card is ready, polling it as poll() would."""
+        while not self.poll():
+            time.sleep_us(max(0, time.ticks_diff(self._next_poll, time.ticks_us())))
+
+    def autotune(self, block_num, max_baudrate=25000000, rates=_AUTOTUNE_RATES):
+        """Raise the SPI clock to the highest of rates, up to max_baudrate,
+        at which a test pattern written to block_num reads back intact, and
+        measure the card's latency there. block_num must be a spare block
+        past the partitions (or the volume, on a card without a partition
+        table): it is overwritten. Returns the clock rate, also kept in
+        baudrate, with the latencies in read_us and write_us (None if the
+        card fails to answer at the rate it falls back to).
+        """
+        if not self.crc:
+            raise ValueError('autotune needs an SDCard created with crc=True')
+        from flightlog import unpartitioned_tail
+        if block_num < unpartitioned_tail(self)[0]:
+            raise ValueError('autotune block {} is inside the filesystem'.format(block_num))
+        pattern = bytearray(512)
+        back = bytearray(512)
+        rate = self.baudrate
+        for candidate in rates:
+            if candidate <= rate:
+                continue
+            if candidate > max_baudrate:
+                break
+            # alternating bits, different for every rate so a copy written
+            # at the last one doesn't pass
+            for i in range(512):
+                pattern[i] = ((0x55 if i & 1 else 0xAA) ^ (i >> 1) ^ (candidate >> 16)) & 0xFF
+            self.init_spi(candidate)
+            try:
+                self.writeblocks(block_num, pattern)
+                self.readblocks(block_num, back)
+                self.flush()
+            except OSError:
+                break
+            if back != pattern:
+                break
+            rate = candidate
+        self.init_spi(rate)
+        self.baudrate = rate
 
-    def init_card_v2(self):
-        for i in range(_CMD_TIMEOUT):
-            time.sleep_ms(50)
-            self.cmd(58, 0, 0, 4)
-            self.cmd(55, 0, 0)
-            if self.cmd(41, 0x40000000, 0) == 0:
-                self.cmd(58, 0, 0, -4)  # 4-byte response, negative means keep the first byte
-                ocr = self.tokenbuf[0]  # get first byte of response, which is OCR
-                if not ocr & 0x40:
-                    # SDSC card, uses byte addressing in read/write/erase commands
-                    self.cdv = 512
-                else:
-                    # SDHC/SDXC card, uses block addressing in read/write/erase commands
-                    self.cdv = 1
-                # print("[SDCard] v2 card")
-                return
-        raise OSError("timeout waiting for v2 card")
+        # latency of a single block read and write at that rate
+        try:
+            start = time.ticks_us()
+            self.readblocks(block_num, back)
+            self.read_us = time.ticks_diff(time.ticks_us(), start)
+            start = time.ticks_us()
+            self.writeblocks(block_num, pattern)
+            self.flush()
+            self.write_us = time.ticks_diff(time.ticks_us(), start)
+        except OSError:
+            pass
+        return rate
 
     def cmd(self, cmd, arg, crc, final=0, release=True, skip1=False):
+        # end an open multi-block write and let the card finish programming
+        # a previous write first
+        if self._writer is not None:
+            self._writer.close()
+        if self._busy:
+            self.flush()
+
         self.cs(0)
 
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
-        buf[5] = crc
+        buf[1] = (arg >> 24) & 0xFF
+        buf[2] = (arg >> 16) & 0xFF
+        buf[3] = (arg >> 8) & 0xFF
+        buf[4] = arg & 0xFF
+        buf[5] = _crc7(buf) if self.crc else crc
         self.spi.write(buf)
 
         if skip1:
@@ -165,13 +424,10 @@ class SDCard:
             self.spi.readinto(self.tokenbuf, 0xFF)
             response = self.tokenbuf[0]
             if not (response & 0x80):
-                # this could be a big-endian integer that we are getting here
-                # if final<0 then store the first byte to tokenbuf and discard the rest
-                if final < 0:
-                    self.spi.readinto(self.tokenbuf, 0xFF)
-                    final = -1 - final
-                for j in range(final):
-                    self.spi.write(b"\xff")
+                # final bytes of an R3/R7 response (OCR, voltage) follow,
+                # they go to respbuf
+                if final:
+                    self.spi.readinto(self.respbuf, 0xFF)
                 if release:
                     self.cs(1)
                     self.spi.write(b"\xff")
@@ -182,16 +438,33 @@ class SDCard:
         self.spi.write(b"\xff")
         return -1
 
+    def _wait_while(self, value, timeout_ms):
+        # Poll the card until it sends something other than value: a tight
+        # spin first, for cards that answer quickly, then with growing
+        # sleeps. Returns that byte, or -1 on timeout.
+        spi = self.spi
+        buf = self.tokenbuf
+        for i in range(_SPIN_POLLS):
+            spi.readinto(buf, 0xFF)
+            if buf[0] != value:
+                return buf[0]
+        start = time.ticks_ms()
+        delay = _BACKOFF_MIN_US
+        while time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+            time.sleep_us(delay)
+            if delay < _BACKOFF_MAX_US:
+                delay <<= 1
+            spi.readinto(buf, 0xFF)
+            if buf[0] != value:
+                return buf[0]
+        return -1
+
     def readinto(self, buf):
+        # returns False if the block failed its CRC check
         self.cs(0)
 
-        # read until start byte (0xff)
-        for i in range(_CMD_TIMEOUT):
-            self.spi.readinto(self.tokenbuf, 0xFF)
-            if self.tokenbuf[0] == _TOKEN_DATA:
-                break
-            time.sleep_ms(1)
-        else:
+        # wait for the start byte
+        if self._wait_while(0xFF, _READ_TIMEOUT_MS) != _TOKEN_DATA:
             self.cs(1)
             raise OSError("timeout waiting for response")
 
@@ -202,44 +475,114 @@ class SDCard:
         self.spi.write_readinto(mv, buf)
 
         # read checksum
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        self.spi.readinto(self.crcbuf, 0xFF)
 
         self.cs(1)
         self.spi.write(b"\xff")
 
-    def write(self, token, buf):
+        if self.crc and crc16(buf) != (self.crcbuf[0] << 8 | self.crcbuf[1]):
+            self.read_crc_errors += 1
+            return False
+        return True
+
+    def write(self, token, buf=None):
+        # buf=None sends what is already in frame_payload; returns False if
+        # the card rejected the block
         self.cs(0)
 
-        # send: start of block, data, checksum
-        self.spi.read(1, token)
-        self.spi.write(buf)
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        # send: start of block, data, checksum in one transfer
+        frame = self.frame
+        frame[0] = token
+        if buf is not None:
+            self.frame_payload[:] = buf
+        if self.crc:
+            crc = crc16(self.frame_payload)
+            frame[513] = crc >> 8
+            frame[514] = crc & 0xFF
+        self.spi.write(frame)
 
         # check the response
-        if (self.spi.read(1, 0xFF)[0] & 0x1F) != 0x05:
+        self.spi.readinto(self.tokenbuf, 0xFF)
+        if (self.tokenbuf[0] & 0x1F) != 0x05:
             self.cs(1)
             self.spi.write(b"\xff")
-            return
+            self.write_errors += 1
+            return False
 
-        # wait for write to finish
-        while self.spi.read(1, 0xFF)[0] == 0:
-            pass
+        # the card is programming the block now; release it and let the
+        # caller decide when to wait
+        self._set_busy()
+        return True
 
-        self.cs(1)
-        self.spi.write(b"\xff")
+    def _retry(self, failures):
+        # count a failed block transfer; raise once it failed too often
+        if failures > self.max_retries:
+            raise OSError(5)  # EIO
+        self.retries += 1
 
     def write_token(self, token):
         self.cs(0)
-        self.spi.read(1, token)
+        self.stopbuf[0] = token
+        self.spi.write(self.stopbuf)
+        self._set_busy()
+
+    def _set_busy(self):
+        self._busy = True
+        self._busy_start = time.ticks_us()
+        self._busy_seen = False
+        self.cs(1)
         self.spi.write(b"\xff")
-        # wait for write to finish
-        while self.spi.read(1, 0xFF)[0] == 0x00:
-            pass
 
+    def _ready(self):
+        # the card released MISO: record how long it was busy, if a poll
+        # saw it still busy
+        self._busy = False
+        if not self._busy_seen:
+            self.busy_unmeasured += 1
+            return
+        busy_us = time.ticks_diff(time.ticks_us(), self._busy_start)
+        if busy_us > self.busy_max_us:
+            self.busy_max_us = busy_us
+        i = 0
+        while i < _BUSY_BINS - 1 and busy_us >= 128 << i:
+            i += 1
+        self.busy_histogram[i] += 1
+
+    def busy(self):
+        """Return True while the card is still programming the last write,
+        without waiting for it.
+        """
+        if not self._busy:
+            return False
+        self.cs(0)
+        self.spi.readinto(self.tokenbuf, 0xFF)
         self.cs(1)
         self.spi.write(b"\xff")
+        if self.tokenbuf[0] == 0x00:
+            self._busy_seen = True
+            return True
+        self._ready()
+        return False
+
+    def flush(self):
+        """Wait until the card has finished programming the last write."""
+        if not self._busy:
+            return
+        start = time.ticks_us()
+        self.cs(0)
+        # the card holds MISO low while it is busy
+        self.spi.readinto(self.tokenbuf, 0xFF)
+        ready = self.tokenbuf[0]
+        if ready == 0x00:
+            self._busy_seen = True
+            ready = self._wait_while(0x00, _WRITE_TIMEOUT_MS)
+        self.cs(1)
+        self.spi.write(b"\xff")
+        if ready < 0:
+            self._busy = False
+            raise OSError("timeout waiting for write")
+        self._ready()
+        self.busy_wait_us += time.ticks_diff(time.ticks_us(), start)
 
     def readblocks(self, block_num, buf):
         # workaround for shared bus, required for (at least) some Kingston
@@ -248,6 +591,18 @@ class SDCard:
 
         nblocks = len(buf) // 512
         assert nblocks and not len(buf) % 512, "Buffer length is invalid"
+        done = self._read(block_num, buf)
+        failures = 0
+        while done < nblocks:
+            # read again from the block that failed its CRC check
+            failures += 1
+            self._retry(failures)
+            done += self._read(block_num + done, memoryview(buf)[done * 512 :])
+
+    def _read(self, block_num, buf):
+        # read the blocks in buf, returns how many were read before one
+        # failed its CRC check
+        nblocks = len(buf) // 512
         if nblocks == 1:
             # CMD17: set read address for single block
             if self.cmd(17, block_num * self.cdv, 0, release=False) != 0:
@@ -255,22 +610,22 @@ class SDCard:
                 self.cs(1)
                 raise OSError(5)  # EIO
             # receive the data and release card
-            self.readinto(buf)
-        else:
-            # CMD18: set read address for multiple blocks
-            if self.cmd(18, block_num * self.cdv, 0, release=False) != 0:
-                # release the card
-                self.cs(1)
-                raise OSError(5)  # EIO
-            offset = 0
-            mv = memoryview(buf)
-            while nblocks:
-                # receive the data and release card
-                self.readinto(mv[offset : offset + 512])
-                offset += 512
-                nblocks -= 1
-            if self.cmd(12, 0, 0xFF, skip1=True):
-                raise OSError(5)  # EIO
+            return 1 if self.readinto(buf) else 0
+        # CMD18: set read address for multiple blocks
+        if self.cmd(18, block_num * self.cdv, 0, release=False) != 0:
+            # release the card
+            self.cs(1)
+            raise OSError(5)  # EIO
+        done = 0
+        mv = memoryview(buf)
+        while done < nblocks:
+            # receive the data and release card
+            if not self.readinto(mv[done * 512 : (done + 1) * 512]):
+                break
+            done += 1
+        if self.cmd(12, 0, 0xFF, skip1=True):
+            raise OSError(5)  # EIO
+        return done
 
     def writeblocks(self, block_num, buf):
         # workaround for shared bus, required for (at least) some Kingston
@@ -280,27 +635,112 @@ class SDCard:
         nblocks, err = divmod(len(buf), 512)
         assert nblocks and not err, "Buffer length is invalid"
         if nblocks == 1:
-            # CMD24: set write address for single block
-            if self.cmd(24, block_num * self.cdv, 0) != 0:
-                raise OSError(5)  # EIO
-
-            # send the data
-            self.write(_TOKEN_DATA, buf)
+            failures = 0
+            while True:
+                # CMD24: set write address for single block
+                if self.cmd(24, block_num * self.cdv, 0) != 0:
+                    raise OSError(5)  # EIO
+
+                # send the data
+                if self.write(_TOKEN_DATA, buf):
+                    break
+                failures += 1
+                self._retry(failures)
+            if not self.write_behind:
+                self.flush()
         else:
-            # CMD25: set write address for first block
-            if self.cmd(25, block_num * self.cdv, 0) != 0:
-                raise OSError(5)  # EIO
-            # send the data
-            offset = 0
-            mv = memoryview(buf)
-            while nblocks:
-                self.write(_TOKEN_CMD25, mv[offset : offset + 512])
-                offset += 512
-                nblocks -= 1
-            self.write_token(_TOKEN_STOP_TRAN)
+            # CMD25 with a pre-erase hint, sending the data as one stream
+            writer = self.open_writer(block_num, nblocks)
+            writer.write(buf)
+            writer.close()
+
+    def open_writer(self, block_num, count=0):
+        """Start a multi-block write (CMD25) at block_num and return its
+        BlockWriter. count, if known, is passed to the card with ACMD23 so
+        it can erase the blocks ahead of the data. The write stays open
+        until BlockWriter.close() or the next command to the card.
+        """
+        # MOSI high before starting the transaction, as in writeblocks
+        self.spi.write(b"\xff")
+        if count:
+            # ACMD23: number of blocks to pre-erase (a hint, cards may ignore it)
+            self.cmd(55, 0, 0)
+            self.cmd(23, count & 0x7FFFFF, 0)
+        # CMD25: set write address for first block
+        if self.cmd(25, block_num * self.cdv, 0) != 0:
+            raise OSError(5)  # EIO
+        self._writer = BlockWriter(self, block_num)
+        return self._writer
 
     def ioctl(self, op, arg):
+        if op == 3:  # sync
+            if self._writer is not None:
+                self._writer.close()
+            self.flush()
+            return 0
         if op == 4:  # get number of blocks
             return self.sectors
         if op == 5:  # get block size in bytes
-            return 512
\ No newline at end of file
+            return 512
+
+class BlockWriter:
+    """Open multi-block write from SDCard.open_writer(). Each block goes to
+    the card as a single SPI transfer of token, data and CRC; the card
+    programs it while the caller prepares the next one.
+    """
+
+    def __init__(self, sd, block_num):
+        self.sd = sd
+        self.next_block = block_num
+        self.blocks = 0
+        # the send buffer: fill it and call write() without data
+        self.payload = sd.frame_payload
+
+    def write(self, buf=None):
+        """Send buf, a whole number of blocks, or the block in payload if
+        buf is None.
+        """
+        sd = self.sd
+        if sd._writer is not self:
+            raise OSError("block writer is closed")
+        if buf is None:
+            self._send(None)
+            return
+        nblocks, err = divmod(len(buf), 512)
+        assert not err, "Buffer length is invalid"
+        mv = memoryview(buf)
+        offset = 0
+        while nblocks:
+            self._send(mv[offset : offset + 512])
+            offset += 512
+            nblocks -= 1
+
+    def _send(self, block):
+        sd = self.sd
+        failures = 0
+        while True:
+            # the card takes the next block once it has programmed the last
+            sd.flush()
+            if sd.write(_TOKEN_CMD25, block):
+                break
+            # rejected: end the transfer and resume at this block
+            failures += 1
+            sd._writer = None
+            sd.write_token(_TOKEN_STOP_TRAN)
+            sd._retry(failures)
+            if sd.cmd(25, self.next_block * sd.cdv, 0) != 0:
+                raise OSError(5)  # EIO
+            sd._writer = self
+        self.blocks += 1
+        self.next_block += 1
+
+    def close(self):
+        """End the multi-block write."""
+        sd = self.sd
+        if sd._writer is not self:
+            return
+        sd._writer = None
+        sd.flush()
+        sd.write_token(_TOKEN_STOP_TRAN)
+        if not sd.write_behind:
+            sd.flush()
@@ -0,0 +1,195 @@
+"""
+Host-side tests and benchmarks for lib/blockcache.py, on an in-memory block
+device and on the fake SD card over SPI.
+
+Run with pytest, or directly (python tests/blockcache_host_test.py) to also
+print the benchmark numbers.
+"""
+import struct
+
+from host import FakeSDCard, MemoryBlockDevice, clock
+from blockcache import BlockCache, fat_metadata_end
+from sdcard import SDCard
+
+# FAT16 partition at block 64: 1 reserved block, 2 FATs of 8 blocks and a
+# 512-entry (32 block) root directory, so data starts at block 113.
+PART_START = 64
+FAT = PART_START + 1
+FAT_BLOCKS = 8
+ROOT_DIR = FAT + 2 * FAT_BLOCKS
+DATA = ROOT_DIR + 32
+CLUSTER_BLOCKS = 4
+
+
+def _format(bdev, sectors=8192, mbr=True):
+    start = PART_START if mbr else 0
+    boot = bytearray(512)
+    boot[0:3] = b"\xeb\x3c\x90"
+    struct.pack_into("<HBHBHHBH", boot, 11, 512, CLUSTER_BLOCKS, 1, 2, 512,
+                     0, 0xF8, FAT_BLOCKS)
+    boot[510:512] = b"\x55\xaa"
+    bdev.writeblocks(start, boot)
+    if mbr:
+        table = bytearray(512)
+        struct.pack_into("<B3sB3sII", table, 446, 0, b"", 0x06, b"",
+                         PART_START, sectors - PART_START)
+        table[510:512] = b"\x55\xaa"
+        bdev.writeblocks(0, table)
+
+
+def _block(fill):
+    return bytearray([fill]) * 512
+
+
+def _append_log(bdev, appends, size=300):
+    # Block accesses of the FAT driver appending size bytes to a file and
+    # closing it, as Can.save_buffer_to_csv() did with the CSV file: look
+    # the file up in the root directory, follow its cluster chain in the
+    # FAT, read-modify-write the last data block, extend the chain in both
+    # FATs when a new cluster starts, update the directory entry, sync.
+    buf = bytearray(512)
+    length = 0
+    for n in range(appends):
+        bdev.readblocks(ROOT_DIR, buf)
+        bdev.readblocks(FAT, buf)
+        end = length + size
+        for block in range(length // 512, (end - 1) // 512 + 1):
+            if block * 512 < length:
+                bdev.readblocks(DATA + block, buf)
+            if block % CLUSTER_BLOCKS == 0 and block * 512 >= length:
+                for copy in range(2):
+                    bdev.readblocks(FAT + copy * FAT_BLOCKS, buf)
+                    buf[block // CLUSTER_BLOCKS * 2] = 0xFF
+                    bdev.writeblocks(FAT + copy * FAT_BLOCKS, buf)
+            buf[:] = _block(n & 0xFF)
+            bdev.writeblocks(DATA + block, buf)
+        length = end
+        bdev.readblocks(ROOT_DIR, buf)
+        struct.pack_into("<I", buf, 28, length)
+        bdev.writeblocks(ROOT_DIR, buf)
+        bdev.ioctl(3, 0)
+
+
+def test_fat_metadata_end():
+    bdev = MemoryBlockDevice()
+    assert fat_metadata_end(bdev) == 0
+    _format(bdev)
+    assert fat_metadata_end(bdev) == DATA
+    bdev = MemoryBlockDevice()
+    _format(bdev, mbr=False)
+    assert fat_metadata_end(bdev) == DATA - PART_START
+
+
+def test_reads_are_cached():
+    bdev = MemoryBlockDevice()
+    bdev.writeblocks(5, _block(5))
+    cache = BlockCache(bdev, 4)
+    buf = bytearray(512)
+    for _ in range(3):
+        cache.readblocks(5, buf)
+        assert buf == _block(5)
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert bdev.reads == 1
+
+
+def test_least_recently_used_is_evicted():
+    bdev = MemoryBlockDevice()
+    cache = BlockCache(bdev, 2)
+    buf = bytearray(512)
+    for block in (1, 2, 1, 3):
+        cache.readblocks(block, buf)
+    assert cache.misses == 3
+    cache.readblocks(1, buf)
+    assert cache.misses == 3
+    cache.readblocks(2, buf)
+    assert cache.misses == 4
+
+
+def test_metadata_writes_wait_for_sync():
+    bdev = MemoryBlockDevice()
+    cache = BlockCache(bdev, 4, metadata_end=100)
+    cache.writeblocks(10, _block(1))
+    cache.writeblocks(10, _block(2))
+    assert bdev.writes == 0
+    buf = bytearray(512)
+    cache.readblocks(10, buf)
+    assert buf == _block(2)
+    assert cache.ioctl(3, 0) == 0
+    assert bdev.writes == 1 and cache.write_backs == 1
+    assert bdev.data[10 * 512:11 * 512] == _block(2)
+    cache.sync()
+    assert bdev.writes == 1
+
+
+def test_dirty_block_written_back_on_eviction():
+    bdev = MemoryBlockDevice()
+    cache = BlockCache(bdev, 2, metadata_end=100)
+    cache.writeblocks(10, _block(1))
+    buf = bytearray(512)
+    cache.readblocks(11, buf)
+    cache.readblocks(12, buf)
+    assert bdev.data[10 * 512:11 * 512] == _block(1)
+    assert cache.write_backs == 1
+
+
+def test_data_writes_go_through_and_update_cache():
+    bdev = MemoryBlockDevice()
+    cache = BlockCache(bdev, 4, metadata_end=100)
+    buf = bytearray(512)
+    cache.readblocks(200, buf)
+    cache.writeblocks(199, _block(7) + _block(8))
+    assert bdev.writes == 1
+    cache.readblocks(200, buf)
+    assert buf == _block(8) and cache.hits == 1
+
+
+def test_multi_block_read_sees_dirty_blocks():
+    bdev = MemoryBlockDevice()
+    cache = BlockCache(bdev, 4, metadata_end=100)
+    cache.writeblocks(21, _block(3))
+    buf = bytearray(3 * 512)
+    cache.readblocks(20, buf)
+    assert buf == _block(0) + _block(3) + _block(0)
+
+
+def test_append_pattern_saves_commands():
+    images = []
+    commands = []
+    for slots in (0, 8):
+        card = FakeSDCard(sectors=8192)
+        sd = SDCard(card, card.cs)
+        _format(sd)
+        bdev = BlockCache(sd, slots, fat_metadata_end(sd)) if slots else sd
+        start = len(card.commands)
+        _append_log(bdev, 40)
+        commands.append(len(card.commands) - start)
+        images.append(card.blocks)
+    assert images[0] == images[1]
+    assert commands[1] < commands[0] // 2
+
+
+def bench_append(appends=100, baudrate=8000000):
+    # Card commands, SPI transactions (busy polls included) and time of
+    # 300-byte appends to a file.
+    for slots in (0, 2, 4, 8, 16):
+        card = FakeSDCard(sectors=8192)
+        sd = SDCard(card, card.cs, baudrate=baudrate)
+        _format(sd)
+        bdev = BlockCache(sd, slots, fat_metadata_end(sd)) if slots else sd
+        transactions = card.transactions
+        commands = len(card.commands)
+        start = clock.ticks_us()
+        _append_log(bdev, appends)
+        elapsed = clock.ticks_us() - start
+        hits = "{:3d} hits {:3d} misses".format(bdev.hits, bdev.misses) if slots else "no cache"
+        print("{:2d} slots: {:4d} commands, {:6d} SPI transactions, {:5.2f} ms per append ({})".format(
+            slots, len(card.commands) - commands, card.transactions - transactions,
+            elapsed / appends / 1000, hits))
+
+
+if __name__ == "__main__":
+    for name, func in sorted(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print("ok", name)
+    bench_append()
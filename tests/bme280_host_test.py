@@ -0,0 +1,249 @@
+"""
+Host-side tests and benchmarks for lib/bme280.py against a fake I2C bus.
+
+Run with pytest, or directly (python tests/bme280_host_test.py) to also
+print the benchmark numbers.
+"""
+import os
+import tempfile
+import time
+from array import array
+
+from host import FakeBME280, FakeMS5611, clock
+from bme280 import (BME280, BME280_IIR_4, BME280_OSAMPLE_1, BME280_OSAMPLE_2,
+                    BME280_STANDBY_0_5, BME280_STANDBY_62_5, BMP280_CHIP_ID)
+from ms5611 import MS5611
+
+
+def _calibration(sensor):
+    return tuple(getattr(sensor, "dig_" + name) for name in (
+        "T1", "T2", "T3", "P1", "P2", "P3", "P4", "P5", "P6", "P7", "P8", "P9",
+        "H1", "H2", "H3", "H4", "H5", "H6"))
+
+
+def test_calibration_is_unpacked():
+    sensor = BME280(i2c=FakeBME280())
+    assert _calibration(sensor) == FakeBME280.CALIBRATION + FakeBME280.HUMIDITY
+
+
+def test_calibration_is_cached():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "calibration.bin")
+        bus = FakeBME280()
+        first = BME280(i2c=bus, calibration_file=path)
+        assert not first.calibration_cached
+        uncached = bus.bytes_read
+        bus = FakeBME280()
+        second = BME280(i2c=bus, calibration_file=path)
+        assert second.calibration_cached
+        assert bus.bytes_read == 7 < uncached  # chip id and dig_T1..dig_T3
+        assert _calibration(second) == _calibration(first)
+        # A BMP280 at the same address is a different chip: read it again
+        bus = FakeBME280(chip_id=0x58)
+        assert not BME280(i2c=bus, calibration_file=path).calibration_cached
+
+
+def test_swapped_sensor_is_not_given_cached_calibration():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "calibration.bin")
+        BME280(i2c=FakeBME280(), calibration_file=path)
+        # Another BME280 board at the same address: same chip id, own trim
+        bus = FakeBME280()
+        bus.regs[0x8A:0x8C] = (26000).to_bytes(2, "little")  # dig_T2
+        swapped = BME280(i2c=bus, calibration_file=path)
+        assert not swapped.calibration_cached
+        assert swapped.dig_T2 == 26000
+        assert BME280(i2c=bus, calibration_file=path).calibration_cached
+
+
+def test_cache_is_shared_with_ms5611():
+    # Both sensors sit at 0x77 on their own bus; the driver tag keeps them apart.
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "calibration.bin")
+        BME280(i2c=FakeBME280(), calibration_file=path)
+        MS5611(FakeMS5611(), calibration_file=path)
+        assert BME280(i2c=FakeBME280(), calibration_file=path).calibration_cached
+        assert MS5611(FakeMS5611(), calibration_file=path).calibration_cached
+
+
+def test_invalid_calibration_is_rejected():
+    bus = FakeBME280()
+    bus.regs[0x88:0xA2] = b"\xff" * 26
+    try:
+        BME280(i2c=bus)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("blank calibration accepted")
+
+
+def _read(sensor, bus, count=10):
+    # Bus transactions and virtual microseconds per read_raw_data
+    result = [0, 0, 0]
+    transactions = bus.transactions
+    start = clock.ticks_us()
+    for _ in range(count):
+        sensor.read_raw_data(result)
+    return (bus.transactions - transactions) / count, (clock.ticks_us() - start) / count, result
+
+
+def test_normal_mode_reads_one_burst():
+    bus = FakeBME280()
+    sensor = BME280(i2c=bus)
+    forced = sensor.read_compensated_data()
+    odr = sensor.set_normal_mode(BME280_STANDBY_0_5, BME280_IIR_4)
+    assert bus.regs[0xF5] == BME280_STANDBY_0_5 << 5 | BME280_IIR_4 << 2
+    assert bus.regs[0xF4] & 3 == 3
+    assert odr == sensor.odr_hz == 1e6 / (50000 + 500)  # 1 + 16 + 16.5 + 16.5 ms, standby
+    bytes_read = bus.bytes_read
+    transactions, _, result = _read(sensor, bus)
+    assert transactions == 1 and bus.bytes_read - bytes_read == 10 * 8
+    assert result[:2] == [519888, 415148]
+    assert list(sensor.read_compensated_data()) == list(forced)
+    sensor.set_forced_mode()
+    assert bus.regs[0xF4] & 3 == 0
+    assert _read(sensor, bus)[0] > 1
+
+
+def test_normal_mode_odr_for_flight():
+    # BMP280 at T x1, P x2: 7.5 ms typical + 0.5 ms standby
+    bus = FakeBME280(chip_id=BMP280_CHIP_ID)
+    sensor = BME280(mode=(BME280_OSAMPLE_1, BME280_OSAMPLE_1, BME280_OSAMPLE_2), i2c=bus)
+    assert sensor.set_normal_mode(BME280_STANDBY_0_5, BME280_IIR_4) == 125
+    assert sensor.set_normal_mode(BME280_STANDBY_62_5) == 1e6 / 70000
+    bytes_read = bus.bytes_read
+    sensor.read_raw_data([0, 0])
+    assert bus.bytes_read - bytes_read == 6  # no humidity on a BMP280
+
+
+def test_trigger_collect_waits_measurement_time():
+    bus = FakeBME280(chip_id=BMP280_CHIP_ID)
+    sensor = BME280(mode=(BME280_OSAMPLE_1, BME280_OSAMPLE_1, BME280_OSAMPLE_2), i2c=bus)
+    assert sensor.measurement_time_us() == 1250 + 2300 + 4600 + 575
+    result = [0, 0]
+    transactions = bus.transactions
+    start = clock.ticks_us()
+    wait_us = sensor.trigger()
+    assert wait_us == sensor.measurement_time_us()
+    clock.advance_us(5000)  # other work
+    sensor.collect(result)
+    assert wait_us <= clock.ticks_us() - start < wait_us + 1000
+    assert bus.transactions - transactions == 3  # trigger, status, burst
+    assert result == [519888, 415148]
+    # collecting late doesn't wait at all
+    sensor.trigger()
+    clock.advance_us(20000)
+    start = clock.ticks_us()
+    sensor.collect(result)
+    assert clock.ticks_us() - start < 1000
+
+
+def test_collect_polls_a_slow_sensor():
+    bus = FakeBME280()
+    sensor = BME280(i2c=bus)
+    sensor.trigger()
+    bus._done_us += 2500  # slower than the datasheet maximum
+    transactions = bus.transactions
+    sensor.collect([0, 0])
+    assert bus.transactions - transactions == 4 + 1  # 3 ms of status reads, burst
+    sensor.trigger()
+    bus._done_us += 10**9
+    try:
+        sensor.collect([0, 0])
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("stuck sensor not reported")
+
+
+def _float_humidity(sensor, adc_h):
+    # bme280_compensate_H_double from the datasheet, reference for the
+    # integer path; the driver has no float humidity.
+    h = sensor.t_fine - 76800.0
+    h = (adc_h - (sensor.dig_H4 * 64.0 + sensor.dig_H5 / 16384.0 * h)) * \
+        (sensor.dig_H2 / 65536.0 * (1.0 + sensor.dig_H6 / 67108864.0 * h *
+                                    (1.0 + sensor.dig_H3 / 67108864.0 * h)))
+    h = h * (1.0 - sensor.dig_H1 * h / 524288.0)
+    return max(0.0, min(100.0, h))
+
+
+def test_integer_compensation_matches_datasheet():
+    # BMP280 datasheet example: 25.08 degC, t_fine 128422, 100653.27 Pa
+    sensor = BME280(i2c=FakeBME280())
+    result = array("i", [0, 0, 0])
+    sensor.read_compensated_into(result)
+    assert result[0] == 2508 and sensor.t_fine == 128422
+    assert abs(result[1] / 256 - 100653.27) < 0.05
+    temp, pres = sensor.read_compensated_data()
+    assert abs(temp - 25.08) < 0.01 and abs(pres - 100653.27) < 0.05
+    assert abs(result[2] / 1024 - _float_humidity(sensor, 30000)) < 0.01
+
+
+def test_integer_compensation_matches_float_over_range():
+    bus = FakeBME280()
+    sensor = BME280(i2c=bus)
+    result = array("i", [0, 0, 0])
+    for adc_t in range(420000, 620001, 20000):      # about -12 to +60 degC
+        for adc_p in range(250000, 550001, 30000):  # about 430 to 1090 hPa
+            for adc_h in (20000, 30000, 40000):
+                bus.set_adc(adc_t, adc_p, adc_h)
+                temp, pres = sensor.read_compensated_data()
+                humidity = _float_humidity(sensor, adc_h)
+                sensor.read_compensated_into(result)
+                assert abs(result[0] / 100 - temp) < 0.01
+                if 30000 < pres < 110000:  # float path clamps
+                    assert abs(result[1] / 256 - pres) < 0.1
+                assert abs(result[2] / 1024 - humidity) < 0.02
+
+
+def test_humidity_on_bmp280():
+    sensor = BME280(i2c=FakeBME280(chip_id=BMP280_CHIP_ID))
+    result = array("i", [0, 0, 0])
+    sensor.read_raw_data(result)
+    assert result[2] == 0x8000
+    sensor.read_compensated_into(result)
+    assert result[0] == 2508 and result[2] == 0
+    pair = array("i", [0, 0])
+    sensor.read_compensated_into(pair)
+    assert pair[0] == 2508
+
+
+def bench_compensation(count=20000):
+    sensor = BME280(i2c=FakeBME280())
+    raw = array("i", [0, 0, 0])
+    sensor.read_raw_data(raw)
+    result = array("i", [0, 0, 0])
+    start = time.perf_counter()
+    for _ in range(count):
+        result[0], result[1], result[2] = raw
+        sensor.compensate(result)
+    integer = time.perf_counter() - start
+    sensor.read_raw_data = lambda result: None  # compensation only
+    sensor._l3_resultarray[:] = raw
+    start = time.perf_counter()
+    for _ in range(count):
+        sensor.read_compensated_data()
+        _float_humidity(sensor, raw[2])
+    floating = time.perf_counter() - start
+    print("compensation T/P/H: integer {:.2f} us, float {:.2f} us per sample".format(
+        integer * 1e6 / count, floating * 1e6 / count))
+
+
+def bench_modes(count=100):
+    for label, normal in (("forced", False), ("normal", True)):
+        bus = FakeBME280(chip_id=BMP280_CHIP_ID)
+        sensor = BME280(mode=(BME280_OSAMPLE_1, BME280_OSAMPLE_1, BME280_OSAMPLE_2), i2c=bus)
+        if normal:
+            sensor.set_normal_mode(BME280_STANDBY_0_5, BME280_IIR_4)
+        transactions, micros, _ = _read(sensor, bus, count)
+        print("{:6s} {:4.1f} bus transactions, {:7.0f} us per read, ODR {:.0f} Hz".format(
+            label, transactions, micros, sensor.odr_hz))
+
+
+if __name__ == "__main__":
+    for name, func in sorted(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print("ok", name)
+    bench_modes()
+    bench_compensation()
@@ -0,0 +1,125 @@
+"""
+Host-side tests and benchmarks for lib/flightlog.py on an in-memory block
+device.
+
+Run with pytest, or directly (python tests/flightlog_host_test.py) to also
+print the benchmark numbers.
+"""
+import struct
+
+from host import MemoryBlockDevice, clock
+from flightlog import FlightLog, read_log, unpartitioned_tail
+
+
+def _lines(count, start=0):
+    return [("{},1013.25,21.50,48.117300,11.516667,545.4\n".format(i)).encode()
+            for i in range(start, start + count)]
+
+
+def test_log_round_trip():
+    bdev = MemoryBlockDevice()
+    log = FlightLog(bdev, 100, 1000)
+    lines = _lines(500)
+    for line in lines:
+        assert log.write(line) == len(line)
+    log.flush()
+    assert read_log(bdev, 100) == b"".join(lines)
+    # whole batches went out as single multi-block writes
+    assert log.cursor == (len(b"".join(lines)) + 503) // 504
+
+
+def test_log_continues_after_reboot():
+    bdev = MemoryBlockDevice()
+    log = FlightLog(bdev, 100, 1000)
+    first = _lines(200)
+    for line in first:
+        log.write(line)
+    log.flush()
+    log = FlightLog(bdev, 100, 1000)
+    assert log.sessions == 2
+    second = _lines(200, 200)
+    for line in second:
+        log.write(line)
+    log.flush()
+    assert read_log(bdev, 100) == b"".join(first + second)
+
+
+def test_blocks_after_last_header_are_recovered():
+    # Power lost after some batches but before the header was rewritten
+    bdev = MemoryBlockDevice()
+    log = FlightLog(bdev, 100, 1000, batch=2, header_every=4)
+    lines = _lines(120)
+    for line in lines:
+        log.write(line)
+    written = log.cursor
+    assert written and log._batches  # header behind the data
+    log = FlightLog(bdev, 100, 1000, batch=2, header_every=4)
+    assert log.cursor == written
+    log.write(b"after reboot\n")
+    log.flush()
+    data = read_log(bdev, 100)
+    assert data.endswith(b"after reboot\n")
+    assert data.startswith(b"".join(lines)[:written * 504])
+
+
+def test_full_log_drops_data():
+    bdev = MemoryBlockDevice()
+    log = FlightLog(bdev, 10, 3, batch=1)  # header and 2 data blocks
+    assert log.write(b"x" * 2000) == 1008
+    assert log.dropped == 2000 - 1008
+    log.flush()
+    assert read_log(bdev, 10) == b"x" * 1008
+
+
+def test_unpartitioned_tail():
+    bdev = MemoryBlockDevice(sectors=8192)
+    mbr = bytearray(512)
+    mbr[446 + 4] = 0x0C  # FAT32 LBA
+    mbr[446 + 8:446 + 16] = struct.pack("<II", 2048, 4096)
+    mbr[510:512] = b"\x55\xaa"
+    bdev.writeblocks(0, mbr)
+    assert unpartitioned_tail(bdev) == (6144, 2048)
+
+
+def test_unpartitioned_tail_of_superfloppy():
+    # FAT volume from block 0, no partition table: none of the card is free
+    bdev = MemoryBlockDevice(sectors=200000)
+    boot = bytearray(512)
+    boot[0:3] = b"\xeb\x58\x90"
+    struct.pack_into("<HBHBHHBH", boot, 11, 512, 8, 32, 2, 0, 0, 0xF8, 0)
+    struct.pack_into("<I", boot, 32, 200000)
+    boot[510:512] = b"\x55\xaa"
+    bdev.writeblocks(0, boot)
+    assert unpartitioned_tail(bdev) == (200000, 0)
+    # a volume smaller than the card leaves the rest free
+    struct.pack_into("<H", boot, 19, 4096)
+    bdev.writeblocks(0, boot)
+    assert unpartitioned_tail(bdev) == (4096, 195904)
+
+
+def bench_log(seconds=20, rate_hz=100):
+    # 100 Hz telemetry lines to a card costing 1 ms per command and 50 us per
+    # block, stalling 100 ms every 64 blocks (32 KiB).
+    line = _lines(1)[0]
+    for batch in (1, 4, 8, 16):
+        bdev = MemoryBlockDevice(sectors=65536, command_us=1000, block_us=50,
+                                 stall_every=64, stall_us=100000)
+        log = FlightLog(bdev, 1, 65535, batch=batch)
+        worst = busy = 0
+        for _ in range(seconds * rate_hz):
+            start = clock.ticks_us()
+            log.write(line)
+            elapsed = clock.ticks_us() - start
+            worst = max(worst, elapsed)
+            busy += elapsed
+        log.flush()
+        print("batch {:2d}: {:6.0f} bytes/s sustained, worst write {:6.1f} ms, {:4d} card writes".format(
+            batch, log.bytes_written * 1e6 / busy, worst / 1000, bdev.writes))
+
+
+if __name__ == "__main__":
+    for name, func in sorted(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print("ok", name)
+    bench_log()
@@ -0,0 +1,668 @@
+"""
+Host-side (CPython) helpers for exercising the drivers in lib/ without the
+board attached.
+
+Importing this module puts lib/ on the path and fills in the handful of
+MicroPython-only names the drivers use (const, ustruct, time.ticks_*,
+time.sleep_ms). Time is a virtual clock: it follows the real monotonic
+clock, but sleep_ms()/sleep_us() advance it instantly instead of blocking,
+so sensor conversion delays can be simulated at full speed.
+
+The fake peripherals below only implement the calls the drivers make.
+"""
+
+import builtins
+import os
+import struct
+import sys
+import time
+import types
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+
+def _const(value):
+    return value
+
+
+builtins.const = _const
+sys.modules.setdefault("ustruct", struct)
+if "micropython" not in sys.modules:
+    _micropython = types.ModuleType("micropython")
+    _micropython.const = _const
+    sys.modules["micropython"] = _micropython
+if "machine" not in sys.modules:
+    _machine = types.ModuleType("machine")
+    for _name in ("Pin", "SPI", "I2C", "UART", "RTC"):
+        setattr(_machine, _name, type(_name, (), {}))
+    sys.modules["machine"] = _machine
+
+
+class Clock:
+    """Virtual microsecond clock: real elapsed time plus simulated sleeps."""
+
+    def __init__(self):
+        self.offset_us = 0
+        self.realtime = True
+
+    def ticks_us(self):
+        if not self.realtime:
+            return self.offset_us
+        return time.perf_counter_ns() // 1000 + self.offset_us
+
+    @contextmanager
+    def simulated(self):
+        """Leave real elapsed time out while the block runs, so only sleeps
+        advance the clock and timing dependent results are reproducible."""
+        self.offset_us = self.ticks_us()
+        self.realtime = False
+        try:
+            yield
+        finally:
+            self.realtime = True
+            self.offset_us -= time.perf_counter_ns() // 1000
+
+    def ticks_ms(self):
+        return self.ticks_us() // 1000
+
+    def advance_us(self, us):
+        self.offset_us += us
+
+
+clock = Clock()
+time.ticks_us = clock.ticks_us
+time.ticks_ms = clock.ticks_ms
+time.ticks_diff = lambda a, b: a - b
+time.ticks_add = lambda a, b: a + b
+time.sleep_us = clock.advance_us
+time.sleep_ms = lambda ms: clock.advance_us(ms * 1000)
+
+
+class FakeUART:
+    """Replays a byte stream in chunks, like a UART receiving at a fixed rate.
+
+    ``chunk`` limits how many bytes become available per readinto()/read()
+    call, which is how a slow main loop sees the RX FIFO fill up.
+    ``responder`` plays the receiver side: it is called with the UART after
+    every write and can feed() replies, looking at ``written`` for what the
+    driver sent.
+    """
+
+    def __init__(self, data=b"", chunk=None, responder=None):
+        self.data = bytearray(data)
+        self.pos = 0
+        self.chunk = chunk
+        self.responder = responder
+        self.written = bytearray()
+        self.baudrate = None
+
+    def feed(self, data):
+        self.data.extend(data)
+
+    def any(self):
+        return len(self.data) - self.pos
+
+    def _take(self, n):
+        n = min(n, self.any())
+        if self.chunk is not None:
+            n = min(n, self.chunk)
+        out = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return out
+
+    def readinto(self, buf, nbytes=None):
+        n = len(buf) if nbytes is None else nbytes
+        got = self._take(n)
+        if not got:
+            return None
+        buf[:len(got)] = got
+        return len(got)
+
+    def readline(self):
+        end = self.data.find(b"\n", self.pos)
+        if end == -1:
+            return None
+        line = bytes(self.data[self.pos:end + 1])
+        self.pos = end + 1
+        return line
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.written.extend(data)
+        if self.responder is not None:
+            self.responder(self)
+        return len(data)
+
+    def init(self, baudrate=None, **kwargs):
+        self.baudrate = baudrate
+
+
+def nmea(body):
+    """Wrap a sentence body in ``$...*CS\\r\\n`` with a valid checksum."""
+    checksum = 0
+    for char in body.encode():
+        checksum ^= char
+    return "${}*{:02X}\r\n".format(body, checksum).encode()
+
+
+def ubx(msg_class, msg_id, payload=b""):
+    """Frame a UBX message: sync chars, class, id, length, payload, checksum."""
+    body = bytes((msg_class, msg_id)) + struct.pack("<H", len(payload)) + payload
+    ck_a = ck_b = 0
+    for byte in body:
+        ck_a = (ck_a + byte) & 0xFF
+        ck_b = (ck_b + ck_a) & 0xFF
+    return b"\xb5\x62" + body + bytes((ck_a, ck_b))
+
+
+def crc4(prom):
+    """CRC-4 over the eight MS5611 PROM words (AN520), CRC nibble zeroed."""
+    words = list(prom)
+    words[7] &= 0xFF00
+    rem = 0
+    for i in range(16):
+        word = words[i >> 1]
+        rem ^= (word & 0xFF) if i & 1 else (word >> 8)
+        for _ in range(8):
+            rem = (((rem << 1) ^ 0x3000) if rem & 0x8000 else (rem << 1)) & 0xFFFF
+    return (rem >> 12) & 0xF
+
+
+class FakeMS5611:
+    """I2C bus with an MS5611 on it.
+
+    Conversions take the datasheet maximum for the OSR of the command, on
+    the virtual clock. Reading the ADC before the conversion is finished
+    returns 0, as the real part does, and is counted in ``early_reads``.
+    The defaults are the datasheet example: C1..C6, D1 and D2 give
+    20.07 degC and 1000.09 mbar. ``commands`` records every command byte,
+    ``prom_reads`` counts PROM word reads.
+    """
+
+    CONVERSION_US = (600, 1170, 2280, 4540, 9040)
+
+    def __init__(self, address=0x77, prom=(0, 40127, 36924, 23317, 23282, 33464, 28312, 0),
+                 d1=9085466, d2=8569150):
+        self.address = address
+        self.prom = list(prom)
+        self.prom[7] = (self.prom[7] & 0xFFF0) | crc4(self.prom)
+        self.d1 = d1
+        self.d2 = d2
+        self.transactions = 0
+        self.early_reads = 0
+        self.conversions = 0
+        self.commands = bytearray()
+        self.prom_reads = 0
+        self._adc = 0
+        self._done_us = 0
+
+    def writeto(self, address, buf):
+        assert address == self.address
+        self.transactions += 1
+        command = buf[0]
+        self.commands.append(command)
+        if command == 0x1E:
+            self._adc = 0
+        elif 0x40 <= command <= 0x58:
+            self.conversions += 1
+            self._adc = self.d1 if command < 0x50 else self.d2
+            self._done_us = clock.ticks_us() + self.CONVERSION_US[(command & 0x0F) >> 1]
+        return len(buf)
+
+    def readfrom_mem_into(self, address, reg, buf):
+        assert address == self.address
+        self.transactions += 1
+        if reg == 0x00:
+            value = self._adc
+            if clock.ticks_us() < self._done_us:
+                value = 0
+                self.early_reads += 1
+            self._adc = 0
+            data = value.to_bytes(3, "big")
+        else:
+            self.prom_reads += 1
+            data = b""
+            for i in range((reg - 0xA0) >> 1, 8):
+                data += self.prom[i].to_bytes(2, "big")
+        buf[:len(buf)] = data[:len(buf)]
+
+    def readfrom_mem(self, address, reg, n):
+        buf = bytearray(n)
+        self.readfrom_mem_into(address, reg, buf)
+        return bytes(buf)
+
+
+class FakeBME280:
+    """I2C bus with a BME280 on it, as a 256 byte register file ``regs``.
+
+    Calibration is the BMP280 datasheet example (dig_T1..dig_P9) with typical
+    humidity trim. The ADC registers hold adc_T=519888 and adc_P=415148,
+    which the datasheet compensates to 25.08 degC and 100653 Pa. A forced
+    measurement keeps the status "measuring" bit set for the datasheet
+    maximum measurement time on the virtual clock.
+    """
+
+    CALIBRATION = (27504, 26435, -1000, 36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000)
+    HUMIDITY = (75, 362, 0, 313, 50, 30)  # dig_H1..dig_H6
+
+    def __init__(self, address=0x77, chip_id=0x60, adc_t=519888, adc_p=415148, adc_h=30000):
+        self.address = address
+        self.regs = bytearray(256)
+        self.regs[0x88:0xA0] = struct.pack("<HhhHhhhhhhhh", *self.CALIBRATION)
+        h1, h2, h3, h4, h5, h6 = self.HUMIDITY
+        self.regs[0xA1] = h1
+        self.regs[0xE1:0xE4] = struct.pack("<hB", h2, h3)
+        self.regs[0xE4] = (h4 >> 4) & 0xFF
+        self.regs[0xE5] = (h4 & 0x0F) | ((h5 & 0x0F) << 4)
+        self.regs[0xE6] = (h5 >> 4) & 0xFF
+        self.regs[0xE7] = h6 & 0xFF
+        self.regs[0xD0] = chip_id
+        self.set_adc(adc_t, adc_p, adc_h)
+        self.transactions = 0
+        self.bytes_read = 0
+        self._done_us = 0
+
+    def set_adc(self, adc_t, adc_p, adc_h):
+        self.regs[0xF7:0xFA] = (adc_p << 4).to_bytes(3, "big")
+        self.regs[0xFA:0xFD] = (adc_t << 4).to_bytes(3, "big")
+        self.regs[0xFD:0xFF] = adc_h.to_bytes(2, "big")
+
+    def measurement_us(self):
+        # Datasheet t_measure,max for the oversampling in ctrl_hum/ctrl_meas
+        def osr(setting):
+            return 0 if setting == 0 else 1 << (min(setting, 5) - 1)
+        ctrl = self.regs[0xF4]
+        t, p, h = osr(ctrl >> 5), osr((ctrl >> 2) & 7), osr(self.regs[0xF2] & 7)
+        if self.regs[0xD0] == 0x58:
+            h = 0  # BMP280, no humidity
+        return 1250 + 2300 * t + (2300 * p + 575 if p else 0) + (2300 * h + 575 if h else 0)
+
+    def writeto_mem(self, address, reg, buf):
+        assert address == self.address
+        self.transactions += 1
+        self.regs[reg:reg + len(buf)] = buf
+        if reg == 0xF4 and buf[0] & 3 == 1:  # forced mode
+            self._done_us = clock.ticks_us() + self.measurement_us()
+
+    def readfrom_mem_into(self, address, reg, buf):
+        assert address == self.address
+        self.transactions += 1
+        self.bytes_read += len(buf)
+        if clock.ticks_us() >= self._done_us and self.regs[0xF4] & 3 == 1:
+            self.regs[0xF4] &= 0xFC  # forced measurement done, back to sleep
+        self.regs[0xF3] = 0x08 if clock.ticks_us() < self._done_us else 0
+        buf[:len(buf)] = self.regs[reg:reg + len(buf)]
+
+    def readfrom_mem(self, address, reg, n):
+        buf = bytearray(n)
+        self.readfrom_mem_into(address, reg, buf)
+        return bytes(buf)
+
+
+class MemoryBlockDevice:
+    """In-memory block device with the readblocks/writeblocks/ioctl protocol
+    of sdcard.SDCard, 512-byte blocks.
+
+    Each readblocks/writeblocks call costs ``command_us`` plus ``block_us``
+    per block on the virtual clock, like a card transfer would. A write that
+    crosses a multiple of ``stall_every`` blocks additionally stalls for
+    ``stall_us``, the way cards do when they move on to a new erase block.
+    """
+
+    def __init__(self, sectors=8192, command_us=0, block_us=0, stall_every=0, stall_us=0):
+        self.sectors = sectors
+        self.data = bytearray(sectors * 512)
+        self.command_us = command_us
+        self.block_us = block_us
+        self.stall_every = stall_every
+        self.stall_us = stall_us
+        self.reads = 0
+        self.writes = 0
+        self.blocks_written = 0
+
+    def _transfer(self, block_num, buf):
+        nblocks, err = divmod(len(buf), 512)
+        assert nblocks and not err, "Buffer length is invalid"
+        assert 0 <= block_num and block_num + nblocks <= self.sectors, "Block out of range"
+        clock.advance_us(self.command_us + nblocks * self.block_us)
+        return block_num * 512, nblocks
+
+    def readblocks(self, block_num, buf):
+        start, _ = self._transfer(block_num, buf)
+        self.reads += 1
+        buf[:] = self.data[start:start + len(buf)]
+
+    def writeblocks(self, block_num, buf):
+        start, nblocks = self._transfer(block_num, buf)
+        self.writes += 1
+        if self.stall_every and (self.blocks_written + nblocks) // self.stall_every \
+                != self.blocks_written // self.stall_every:
+            clock.advance_us(self.stall_us)
+        self.blocks_written += nblocks
+        self.data[start:start + len(buf)] = buf
+
+    def ioctl(self, op, arg):
+        if op == 4:  # get number of blocks
+            return self.sectors
+        if op == 5:  # get block size in bytes
+            return 512
+        return 0
+
+
+class FakePin:
+    """Output pin: cs(0)/cs(1), cs.init(cs.OUT, value=1), cs.value()."""
+
+    OUT = 1
+
+    def __init__(self, value=1):
+        self._value = value
+
+    def init(self, mode=None, value=None):
+        if value is not None:
+            self._value = value
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+
+def crc7(data):
+    """CRC7 of an SD command (first five bytes), as sent in the last byte."""
+    crc = 0
+    for byte in data:
+        for bit in range(7, -1, -1):
+            crc <<= 1
+            if ((byte >> bit) & 1) ^ ((crc >> 7) & 1):
+                crc ^= 0x09
+            crc &= 0x7F
+    return (crc << 1) | 1
+
+
+def crc16(data):
+    """CRC16-CCITT (XModem) of an SD data block."""
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+    return crc
+
+
+class FakeSDCard:
+    """SDHC card in SPI mode, answering byte by byte. It is the SPI bus itself
+    (init/write/read/readinto/write_readinto) with its chip select in ``cs``:
+
+        card = FakeSDCard()
+        sd = SDCard(card, card.cs)
+
+    Every SPI call advances the virtual clock by ``call_us`` plus the bytes
+    at the current baud rate. The card answers reads after ``read_us``,
+    holds MISO low for ``write_us`` after each written block while it
+    programs, and takes ``init_us`` from the first ACMD41 to leave the idle
+    state. Blocks are kept in ``blocks`` (block number -> bytearray).
+
+    Above ``max_baudrate`` the data blocks get corrupted on the wire, in
+    both directions, after the sender computed their CRC; with ``flaky``
+    set, every flaky-th data block is. A card with CRC checks on (CMD59)
+    rejects corrupted writes and counts them in ``crc_errors``.
+
+    Time spent in the fake itself is taken back off the clock, so elapsed
+    time is the driver's own run time plus the modelled bus and card time.
+
+    ``transactions`` counts SPI calls, ``commands`` the command numbers
+    received (ACMDs as 100 + n), ``busy_violations`` commands sent while
+    the card was still busy (which it ignores, as real cards do) and
+    ``pre_erase`` holds the last ACMD23 block count.
+    """
+
+    CID = b"\x03SDSU08G\x80\x12\x34\x56\x78\x01\x4b\x00"
+
+    def __init__(self, sectors=65536, read_us=100, write_us=500, init_us=20000,
+                 call_us=2, version=2, max_baudrate=None, flaky=0):
+        self.cs = FakePin()
+        self.sectors = sectors
+        self.read_us = read_us
+        self.write_us = write_us
+        self.init_us = init_us
+        self.call_us = call_us
+        self.version = version
+        self.max_baudrate = max_baudrate
+        self.flaky = flaky
+        self.data_blocks = 0
+        self.crc_errors = 0
+        self.baudrate = 0
+        self.blocks = {}
+        self.transactions = 0
+        self.bytes = 0
+        self.commands = []
+        self.busy_violations = 0
+        self.pre_erase = 0
+        self.crc_on = False
+        self._ns = 0
+        self._now = 0
+        self._reset()
+
+    def _reset(self):
+        self.idle = True
+        self._init_started = None
+        self._app = False
+        self._cmd = bytearray()
+        self._out = []             # [(not before us, bytes)]
+        self._mode = None          # None, "write", "write_multi", "read_multi"
+        self._rx = bytearray()     # data block being received
+        self._rx_block = 0
+        self._read_block = 0
+        self._busy_until = 0
+
+    # SPI bus -------------------------------------------------------------
+
+    def init(self, baudrate=None, **kwargs):
+        if baudrate is not None:
+            self.baudrate = baudrate
+
+    def _account(self, nbytes):
+        # Bus time of the transfer; returns the real time to take back once
+        # the bytes are processed, so only the modelled time is counted.
+        self.transactions += 1
+        self.bytes += nbytes
+        self._ns += self.call_us * 1000 + nbytes * 8 * 10**9 // max(self.baudrate, 1)
+        clock.advance_us(self._ns // 1000)
+        self._ns %= 1000
+        self._now = clock.ticks_us()  # the card's time for these bytes
+        return time.perf_counter_ns()
+
+    def _done(self, start_ns):
+        clock.advance_us(-((time.perf_counter_ns() - start_ns) // 1000))
+
+    def write(self, buf):
+        start = self._account(len(buf))
+        for byte in buf:
+            self._exchange(byte)
+        self._done(start)
+
+    def readinto(self, buf, write=0x00):
+        start = self._account(len(buf))
+        for i in range(len(buf)):
+            buf[i] = self._exchange(write)
+        self._done(start)
+
+    def read(self, nbytes, write=0x00):
+        buf = bytearray(nbytes)
+        self.readinto(buf, write)
+        return bytes(buf)
+
+    def write_readinto(self, write_buf, read_buf):
+        start = self._account(len(write_buf))
+        for i in range(len(write_buf)):
+            read_buf[i] = self._exchange(write_buf[i])
+        self._done(start)
+
+    # Card ----------------------------------------------------------------
+
+    def busy(self):
+        return clock.ticks_us() < self._busy_until
+
+    def _busy(self):
+        return self._now < self._busy_until
+
+    def _queue(self, data, delay_us=0):
+        self._out.append([self._now + delay_us, bytearray(data)])
+
+    def _next_out(self):
+        while self._out:
+            ready, data = self._out[0]
+            if self._now < ready:
+                return 0xFF
+            if data:
+                return data.pop(0)
+            self._out.pop(0)
+        if self._mode == "read_multi":
+            self._queue_block(self._read_block)
+            self._read_block += 1
+            return self._next_out()
+        return 0x00 if self._busy() else 0xFF
+
+    def _garbled(self, data, bit):
+        data = bytearray(data)
+        self.data_blocks += 1
+        if (self.max_baudrate and self.baudrate > self.max_baudrate) or \
+           (self.flaky and self.data_blocks % self.flaky == 0):
+            for i in range(0, len(data), 61):
+                data[i] ^= bit
+        return data
+
+    def _queue_block(self, block_num):
+        data = self.blocks.get(block_num, bytes(512))
+        crc = crc16(data)
+        self._queue(b"\xfe" + self._garbled(data, 0x10) + bytes((crc >> 8, crc & 0xFF)), self.read_us)
+
+    def _exchange(self, mosi):
+        if self.cs.value():
+            return 0xFF
+        miso = self._next_out()
+        if self._mode in ("write", "write_multi"):
+            self._receive_data(mosi)
+        elif self._cmd or (mosi & 0xC0) == 0x40:
+            self._cmd.append(mosi)
+            if len(self._cmd) == 6:
+                cmd = bytes(self._cmd)
+                self._cmd = bytearray()
+                self._command(cmd)
+        return miso
+
+    def _receive_data(self, byte):
+        if not self._rx:
+            if self._busy() or byte == 0xFF:
+                return
+            if self._mode == "write_multi" and byte == 0xFD:  # stop transmission
+                self._mode = None
+                self._queue(b"\xff")
+                self._busy_until = self._now + self.write_us
+                return
+            if byte not in (0xFE, 0xFC):
+                return
+        self._rx.append(byte)
+        if len(self._rx) == 515:
+            data = self._garbled(self._rx[1:513], 0x04)
+            crc = self._rx[513] << 8 | self._rx[514]
+            self._rx = bytearray()
+            if self.crc_on and crc != crc16(data):
+                self.crc_errors += 1
+                self._queue(b"\x0b")  # data rejected, CRC error
+            else:
+                self.blocks[self._rx_block] = bytearray(data)
+                self._rx_block += 1
+                self._queue(b"\x05")  # data accepted
+                self._busy_until = self._now + self.write_us
+            if self._mode == "write":
+                self._mode = None
+
+    def _command(self, frame):
+        index = frame[0] & 0x3F
+        arg = int.from_bytes(frame[1:5], "big")
+        if self.version == 1 and index in (17, 18, 24, 25):
+            arg //= 512  # byte addresses
+        app = self._app
+        self._app = False
+        self.commands.append(100 + index if app else index)
+        if self._busy():
+            self.busy_violations += 1
+            return
+        if self.crc_on and frame[5] != crc7(frame[:5]):
+            self._r1(0x08)
+            return
+        if index == 0:
+            self._reset()
+            self._r1(0x01)
+        elif index == 8:
+            if self.version == 1:
+                self._r1(0x05)
+            else:
+                self._r1(0x01 if self.idle else 0x00, b"\x00\x00\x01\xaa")
+        elif index == 9:
+            csd = bytearray(16)
+            csd[0] = 0x40
+            c_size = self.sectors // 1024 - 1
+            csd[7], csd[8], csd[9] = (c_size >> 16) & 0x3F, (c_size >> 8) & 0xFF, c_size & 0xFF
+            crc = crc16(csd)
+            self._r1(0x00)
+            self._queue(b"\xfe" + csd + bytes((crc >> 8, crc & 0xFF)), self.read_us)
+        elif index == 10:
+            crc = crc16(self.CID)
+            self._r1(0x00)
+            self._queue(b"\xfe" + self.CID + bytes((crc >> 8, crc & 0xFF)), self.read_us)
+        elif index == 12:
+            self._mode = None
+            self._out = []
+            self._queue(b"\xff\x00")
+        elif index == 13:
+            self._r1(0x00, b"\x00")
+        elif index == 16:
+            self._r1(0x00)
+        elif index in (17, 18):
+            if arg >= self.sectors:
+                self._r1(0x40)  # parameter error
+                return
+            self._r1(0x00)
+            if index == 17:
+                self._queue_block(arg)
+            else:
+                self._mode = "read_multi"
+                self._read_block = arg
+        elif index in (24, 25):
+            if arg >= self.sectors:
+                self._r1(0x40)
+                return
+            self._r1(0x00)
+            self._rx_block = arg
+            self._mode = "write" if index == 24 else "write_multi"
+        elif index == 55:
+            self._app = True
+            self._r1(0x01 if self.idle else 0x00)
+        elif index == 41 and app:
+            if self._init_started is None:
+                self._init_started = self._now
+            if self._now - self._init_started >= self.init_us:
+                self.idle = False
+            self._r1(0x01 if self.idle else 0x00)
+        elif index == 23 and app:
+            self.pre_erase = arg
+            self._r1(0x00)
+        elif index == 58:
+            self._r1(0x01 if self.idle else 0x00, b"\xc0\xff\x80\x00")
+        elif index == 59:
+            self.crc_on = bool(arg & 1)
+            self._r1(0x01 if self.idle else 0x00)
+        else:
+            self._r1(0x04 | (0x01 if self.idle else 0x00))  # illegal command
+
+    def _r1(self, r1, extra=b""):
+        # one byte of NCR, then the response
+        self._queue(b"\xff" + bytes((r1,)) + extra)
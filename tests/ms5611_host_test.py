@@ -0,0 +1,358 @@
+"""
+Host-side tests and benchmarks for lib/ms5611.py against a fake I2C bus.
+
+Run with pytest, or directly (python tests/ms5611_host_test.py) to also
+print the benchmark numbers.
+"""
+import os
+import tempfile
+import time
+from array import array
+
+from host import FakeMS5611, clock
+import ms5611
+from ms5611 import MS5611
+
+# Datasheet example: calibration, readings and the results at each step
+C = (40127, 36924, 23317, 23282, 33464, 28312)
+D1, D2 = 9085466, 8569150
+DT, OFF, SENS = 2366, 2420281617, 1315097036
+TEMP, P = 2007, 100009
+
+
+def test_update_gives_datasheet_values():
+    sensor = MS5611(FakeMS5611())
+    assert abs(sensor.TEMP - 20.07) < 0.01
+    assert abs(sensor.PRES - 100009) < 1
+
+
+def test_start_returns_before_conversion():
+    bus = FakeMS5611()
+    sensor = MS5611(bus)
+    conversions = bus.conversions
+    sensor.start()
+    assert not sensor.ready
+    assert not sensor.poll()
+    assert bus.conversions == conversions + 1
+    clock.advance_us(9040)
+    assert not sensor.poll()  # pressure read, temperature started
+    assert bus.conversions == conversions + 2
+    clock.advance_us(9040)
+    assert sensor.poll()
+    assert sensor.ready
+    assert sensor.poll()  # stays ready until the next start()
+    assert bus.early_reads == 0
+    assert abs(sensor.TEMP - 20.07) < 0.01
+
+
+def test_poll_never_reads_early():
+    bus = FakeMS5611()
+    sensor = MS5611(bus)
+    for _ in range(5):
+        sensor.start()
+        polls = 0
+        while not sensor.poll():
+            clock.advance_us(250)
+            polls += 1
+        assert polls >= 2 * 9040 // 250
+    assert bus.early_reads == 0
+
+
+def _measure(sensor, step_us=100):
+    start = clock.ticks_us()
+    sensor.start()
+    while not sensor.poll():
+        clock.advance_us(step_us)
+    return clock.ticks_us() - start
+
+
+def test_osr_selects_commands_and_conversion_time():
+    bus = FakeMS5611()
+    sensor = MS5611(bus, osr=512)
+    assert sensor.sample_osr == 512
+    assert sensor.conversion_us() == 1170
+    assert sensor.conversion_us(4096) == 9040
+    del bus.commands[:]
+    assert 2 * 1170 <= _measure(sensor) < 2 * 1170 + 1000
+    assert bytes(bus.commands) == b"\x42\x52"
+    sensor.set_osr(4096)
+    del bus.commands[:]
+    assert 2 * 9040 <= _measure(sensor) < 2 * 9040 + 1000
+    assert bytes(bus.commands) == b"\x48\x58"
+    assert bus.early_reads == 0
+    assert abs(sensor.TEMP - 20.07) < 0.01
+
+
+def test_unsupported_osr_is_rejected():
+    sensor = MS5611(FakeMS5611())
+    try:
+        sensor.set_osr(8192)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("OSR 8192 accepted")
+    assert sensor.osr == 4096
+
+
+def test_osr_policy_applies_at_start():
+    # Like Can.ms5611_osr(): the OSR follows a flight phase variable.
+    phase = [0]
+    by_phase = (4096, 512, 256)
+    sensor = MS5611(FakeMS5611())
+    sensor.osr_policy = lambda: by_phase[phase[0]]
+    for index, osr in enumerate(by_phase):
+        phase[0] = index
+        sensor.start()
+        phase[0] = 0  # a change during the measurement applies to the next one
+        while not sensor.poll():
+            clock.advance_us(100)
+        assert sensor.sample_osr == osr
+
+
+def _run(sensor, count):
+    for _ in range(count):
+        _measure(sensor)
+
+
+def test_temperature_decimation_reuses_d2():
+    bus = FakeMS5611()
+    sensor = MS5611(bus, temperature_every=4)
+    del bus.commands[:]
+    _run(sensor, 12)
+    assert bus.commands.count(0x48) == 12
+    assert bus.commands.count(0x58) == 3
+    assert sensor.temperature_cdeg == TEMP and sensor.pressure_pa == P
+    assert bus.early_reads == 0
+
+
+def test_temperature_drift_forces_refresh():
+    counts_per_cdeg = 2**23 / C[5]
+    bus = FakeMS5611()
+    sensor = MS5611(bus, temperature_every=10, drift_limit_cdeg=10)
+    _run(sensor, 9)
+    assert sensor.temperature_due()
+    bus.d2 += int(40 * counts_per_cdeg)  # +0.4 degC over 10 measurements
+    _run(sensor, 1)
+    assert sensor.temperature_cdeg == TEMP + 40
+    # 4 cdeg per measurement: due again at the third one instead of the tenth
+    due = []
+    for _ in range(4):
+        due.append(sensor.temperature_due())
+        _run(sensor, 1)
+    assert due == [False, False, True, False]
+
+
+def test_pressure_rate_metric():
+    sensor = MS5611(FakeMS5611(), osr=1024)
+    end = clock.ticks_us() + 2100000
+    while clock.ticks_us() < end:
+        _measure(sensor)
+    assert 190 <= sensor.pressure_rate_hz <= 220  # 2 x 2.28 ms per measurement
+
+
+def test_prom_crc_is_checked():
+    bus = FakeMS5611()
+    bus.prom[3] ^= 0x0100  # C3 corrupted after the CRC was written
+    try:
+        MS5611(bus)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("corrupted PROM accepted")
+
+
+def test_calibration_is_cached():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "calibration.bin")
+        bus = FakeMS5611()
+        sensor = MS5611(bus, calibration_file=path)
+        assert not sensor.calibration_cached
+        assert bus.prom_reads == 8
+        bus = FakeMS5611()
+        sensor = MS5611(bus, calibration_file=path)
+        assert sensor.calibration_cached
+        assert bus.prom_reads == 1  # C7 only
+        assert (sensor.C1, sensor.C6) == (C[0], C[5])
+        assert sensor.pressure_pa == P
+        # another sensor at the same address: C7 differs, PROM read again
+        other = (0, 40000, 36924, 23317, 23282, 33464, 28312, 0)
+        bus = FakeMS5611(prom=other)
+        sensor = MS5611(bus, calibration_file=path)
+        assert not sensor.calibration_cached and sensor.C1 == 40000
+        assert MS5611(FakeMS5611(prom=other), calibration_file=path).calibration_cached
+
+
+def test_corrupted_cache_is_ignored():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "calibration.bin")
+        MS5611(FakeMS5611(), calibration_file=path)
+        with open(path, "rb") as f:
+            data = bytearray(f.read())
+        data[6] ^= 0x01
+        with open(path, "wb") as f:
+            f.write(data)
+        bus = FakeMS5611()
+        sensor = MS5611(bus, calibration_file=path)
+        assert not sensor.calibration_cached and bus.prom_reads == 8
+        assert sensor.pressure_pa == P
+
+
+def test_read_into_fills_result():
+    sensor = MS5611(FakeMS5611(), osr=1024)
+    result = array("i", [0, 0, 0])
+    sensor.read_into(result)
+    assert list(result) == [TEMP, P, 1024]
+    pair = array("i", [0, 0])
+    sensor.read_into(pair)
+    assert list(pair) == [TEMP, P]
+
+
+def test_sampling_does_not_allocate():
+    # Count the buffers the driver creates and the bus calls that return new
+    # bytes while sampling, once it is set up.
+    bus = FakeMS5611()
+    sensor = MS5611(bus, temperature_every=4)
+    result = array("i", [0, 0, 0])
+    created = []
+    allocating_reads = []
+
+    def counting(kind):
+        def create(*args):
+            created.append(kind.__name__)
+            return kind(*args)
+        return create
+
+    def readfrom_mem(*args):
+        allocating_reads.append(args)
+        return FakeMS5611.readfrom_mem(bus, *args)
+
+    bus.readfrom_mem = readfrom_mem
+    for kind in (bytes, bytearray, memoryview, array):
+        setattr(ms5611, kind.__name__, counting(kind))
+    try:
+        for _ in range(50):
+            sensor.read_into(result)
+        for _ in range(50):
+            _measure(sensor)
+    finally:
+        for name in ("bytes", "bytearray", "memoryview"):
+            delattr(ms5611, name)
+        ms5611.array = array
+    assert created == [] and allocating_reads == []
+    assert list(result[:2]) == [TEMP, P]
+
+
+def _float_compensation(c, d1, d2):
+    # The original float compensation, with the very low temperature branch
+    # nested as in the datasheet. Reference for the integer path only.
+    c1, c2, c3, c4, c5, c6 = c
+    dT = d2 - c5 * 2**8
+    temp = 2000 + dT * c6 / 2**23
+    off = c2 * 2**16 + (c4 * dT) / 2**7
+    sens = c1 * 2**15 + (c3 * dT) / 2**8
+    t2 = off2 = sens2 = 0
+    if temp < 2000:
+        t2 = dT * dT / 2**31
+        off2 = 5 * ((temp - 2000) ** 2) / 2
+        sens2 = off2 / 2
+        if temp < -1500:
+            off2 = off2 + 7 * ((temp + 1500) ** 2)
+            sens2 = sens2 + 11 * (temp + 1500) ** 2 / 2
+    temp = temp - t2
+    off = off - off2
+    sens = sens - sens2
+    return temp, (d1 * sens / 2**21 - off) / 2**15
+
+
+def _sensor(d1=D1, d2=D2):
+    return MS5611(FakeMS5611(prom=(0,) + C + (0,), d1=d1, d2=d2))
+
+
+def test_integer_compensation_matches_datasheet():
+    sensor = _sensor()
+    assert sensor.D2 - sensor._c5_ref == DT
+    assert sensor._off_ref + ((sensor.C4 * DT) >> 7) == OFF
+    assert sensor._sens_ref + ((sensor.C3 * DT) >> 8) == SENS
+    assert sensor.temperature_cdeg == TEMP
+    assert sensor.pressure_pa == P
+    assert sensor.TEMP == 20.07
+    temp, pres = _float_compensation(C, D1, D2)
+    assert int(temp) == TEMP and int(pres) == P
+
+
+def test_integer_compensation_matches_float_over_range():
+    # -40 to +85 degC and 10 to 1100 mbar, through both second order branches.
+    # The float path squares the unrounded TEMP, so it drifts a few Pa from
+    # the datasheet's integer result at very low temperature.
+    sensor = _sensor()
+    very_low = 0
+    for temp_c in range(-40, 86, 5):
+        d2 = (C[4] << 8) + (temp_c * 100 - 2000) * 2**23 // C[5]
+        for d1 in range(4000000, 9700000, 300000):
+            sensor.D1, sensor.D2 = d1, d2
+            sensor.calculatePressureAndTemperature()
+            temp, pres = _float_compensation(C, d1, d2)
+            assert abs(sensor.temperature_cdeg - temp) <= 1, (d1, d2)
+            assert abs(sensor.pressure_pa - pres) <= 6, (d1, d2)
+            very_low += temp < -1500
+    assert very_low
+
+
+def bench_decimation(work_us=1000):
+    for every in (1, 2, 4, 8, 16):
+        sensor = MS5611(FakeMS5611(), temperature_every=every)
+        _main_loop(sensor, False, duration_us=2100000, work_us=work_us)
+        print("temperature every {:2d}: {:3d} pressure samples/s at OSR 4096".format(
+            every, sensor.pressure_rate_hz))
+
+
+def bench_compensation(count=20000):
+    sensor = _sensor()
+    start = time.perf_counter()
+    for _ in range(count):
+        sensor.calculatePressureAndTemperature()
+    integer = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(count):
+        _float_compensation(C, D1, D2)
+    floating = time.perf_counter() - start
+    print("compensation: integer {:.2f} us, float {:.2f} us per sample".format(
+        integer * 1e6 / count, floating * 1e6 / count))
+
+
+def _main_loop(sensor, blocking, duration_us=1000000, work_us=1000):
+    # One iteration is work_us of other sensors and radio plus the barometer.
+    iterations = samples = 0
+    end = clock.ticks_us() + duration_us
+    sensor.start()
+    while clock.ticks_us() < end:
+        clock.advance_us(work_us)
+        if blocking:
+            sensor.update()
+            samples += 1
+        elif sensor.poll():
+            sensor.start()
+            samples += 1
+        iterations += 1
+    return iterations, samples
+
+
+def bench_loop(work_us=1000):
+    for label, blocking in (("update()", True), ("start/poll", False)):
+        iterations, samples = _main_loop(MS5611(FakeMS5611()), blocking, work_us=work_us)
+        print("{:10s} {:5d} loop iterations/s, {:3d} barometer samples/s".format(
+            label, iterations, samples))
+    for osr in (4096, 2048, 1024, 512, 256):
+        iterations, samples = _main_loop(MS5611(FakeMS5611(), osr=osr), False, work_us=work_us)
+        print("OSR {:4d}   {:5d} loop iterations/s, {:3d} barometer samples/s".format(
+            osr, iterations, samples))
+
+
+if __name__ == "__main__":
+    for name, func in sorted(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print("ok", name)
+    bench_loop()
+    bench_decimation()
+    bench_compensation()
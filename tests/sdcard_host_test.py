@@ -0,0 +1,579 @@
+"""
+Host-side tests and benchmarks for lib/sdcard.py against a fake card on a
+fake SPI bus (host.FakeSDCard).
+
+Run with pytest, or directly (python tests/sdcard_host_test.py) to also
+print the benchmark numbers.
+"""
+import os
+import struct
+import time
+
+from host import FakeSDCard, clock, crc7, crc16
+import sdcard
+from sdcard import SDCard
+
+
+def _card(**kwargs):
+    card = FakeSDCard(sectors=8192, **kwargs)
+    return card, card.cs
+
+
+def _pattern(nblocks, seed=0):
+    return bytearray((seed + i * 7) & 0xFF for i in range(nblocks * 512))
+
+
+def test_init_reads_card_size():
+    card, cs = _card()
+    sd = SDCard(card, cs)
+    assert sd.sectors == 8192
+    assert sd.cdv == 1
+    assert sd.ioctl(4, 0) == 8192
+    assert sd.ioctl(5, 0) == 512
+
+
+def test_round_trip_single_and_multi_block():
+    for write_behind in (False, True):
+        card, cs = _card()
+        sd = SDCard(card, cs, write_behind=write_behind)
+        one = _pattern(1, 3)
+        four = _pattern(4, 5)
+        sd.writeblocks(7, one)
+        sd.writeblocks(20, four)
+        out = bytearray(512)
+        sd.readblocks(7, out)
+        assert out == one
+        out = bytearray(4 * 512)
+        sd.readblocks(20, out)
+        assert out == four
+        assert card.busy_violations == 0
+
+
+def test_write_waits_for_card_by_default():
+    card, cs = _card(write_us=20000)
+    sd = SDCard(card, cs)
+    start = clock.ticks_us()
+    sd.writeblocks(1, _pattern(1))
+    assert clock.ticks_us() - start >= 20000
+    assert not sd.busy()
+
+
+def test_write_behind_returns_while_card_programs():
+    card, cs = _card(write_us=20000)
+    sd = SDCard(card, cs, write_behind=True)
+    start = clock.ticks_us()
+    sd.writeblocks(1, _pattern(1))
+    assert clock.ticks_us() - start < 20000
+    assert sd.busy() and card.busy()
+    clock.advance_us(20000)
+    assert not sd.busy()
+    # nothing left to wait for
+    wait_us = sd.busy_wait_us
+    sd.flush()
+    assert sd.busy_wait_us == wait_us
+
+
+def test_next_command_waits_for_write_behind():
+    card, cs = _card(write_us=20000)
+    sd = SDCard(card, cs, write_behind=True)
+    sd.writeblocks(1, _pattern(1, 1))
+    sd.writeblocks(2, _pattern(1, 2))
+    out = bytearray(512)
+    sd.readblocks(1, out)
+    assert out == _pattern(1, 1)
+    assert card.busy_violations == 0
+    assert sd.busy_wait_us > 0
+
+
+def test_sync_ioctl_flushes():
+    card, cs = _card(write_us=20000)
+    sd = SDCard(card, cs, write_behind=True)
+    sd.writeblocks(1, _pattern(1))
+    assert sd.ioctl(3, 0) == 0
+    assert not card.busy()
+
+
+def test_busy_histogram():
+    card, cs = _card(write_us=2800)
+    sd = SDCard(card, cs, baudrate=8000000)
+    sd.writeblocks(1, _pattern(1))
+    # 2.8 ms lands in the 2048..4095 us bin (128 << 4 up to 128 << 5)
+    assert sum(sd.busy_histogram) == 1
+    assert sd.busy_histogram[5] == 1
+    assert 2048 <= sd.busy_max_us < 4096
+    sd.writeblocks(2, _pattern(3))
+    # three blocks and the stop token
+    assert sum(sd.busy_histogram) == 5
+    assert sd.busy_unmeasured == 0
+
+
+def test_busy_histogram_with_write_behind():
+    # programming slow enough that host scheduling hiccups don't outlast it
+    card, cs = _card(write_us=20000)
+    sd = SDCard(card, cs, baudrate=8000000, write_behind=True)
+    # back to back writes: each one waits for the previous one to finish
+    for block in range(1, 6):
+        sd.writeblocks(block, _pattern(1))
+    sd.flush()
+    assert sum(sd.busy_histogram) == 5 and sd.busy_unmeasured == 0
+    assert 20000 <= sd.busy_max_us < 40000
+    # other work between writes: the card is done before it is checked, so
+    # the gap isn't taken for programming time
+    for block in range(1, 6):
+        sd.writeblocks(block, _pattern(1))
+        clock.advance_us(100000)
+    sd.flush()
+    assert sum(sd.busy_histogram) == 5 and sd.busy_unmeasured == 5
+    assert sd.busy_max_us < 40000
+
+
+def test_multi_block_write_pre_erases():
+    card, cs = _card()
+    sd = SDCard(card, cs)
+    sd.writeblocks(40, _pattern(4))
+    assert card.commands[-3:] == [55, 123, 25]
+    assert card.pre_erase == 4
+    # single blocks go without the hint
+    sd.writeblocks(50, _pattern(1))
+    assert card.commands[-1] == 24
+
+
+def test_block_writer_streams_across_calls():
+    card, cs = _card()
+    sd = SDCard(card, cs, write_behind=True)
+    data = _pattern(6, 9)
+    writer = sd.open_writer(60, 6)
+    writer.write(data[:1024])
+    writer.payload[:] = data[1024:1536]
+    writer.write()
+    writer.write(data[1536:])
+    assert writer.blocks == 6 and writer.next_block == 66
+    writer.close()
+    out = bytearray(len(data))
+    sd.readblocks(60, out)
+    assert out == data
+    assert card.commands.count(25) == 1
+    assert card.busy_violations == 0
+
+
+def test_next_command_closes_writer():
+    card, cs = _card()
+    sd = SDCard(card, cs)
+    writer = sd.open_writer(70)
+    writer.write(_pattern(2, 4))
+    out = bytearray(1024)
+    sd.readblocks(70, out)
+    assert out == _pattern(2, 4)
+    try:
+        writer.write(_pattern(1))
+    except OSError:
+        pass
+    else:
+        raise AssertionError("write to a closed writer")
+
+
+def test_streamed_block_is_one_transfer():
+    card, cs = _card()
+    sd = SDCard(card, cs)
+    writer = sd.open_writer(80)
+    writer.write(_pattern(1))
+    clock.advance_us(card.write_us)
+    before = card.transactions
+    writer.write(_pattern(1))
+    # busy check (select, poll, release), then frame, data response, release
+    assert card.transactions - before == 5
+    writer.close()
+
+
+def test_read_has_no_millisecond_floor():
+    card, cs = _card(read_us=100)
+    sd = SDCard(card, cs, baudrate=8000000)
+    buf = bytearray(512)
+    start = clock.ticks_us()
+    sd.readblocks(3, buf)
+    # 100 us access time and 0.5 ms of data at 8 MHz
+    assert clock.ticks_us() - start < 1000
+
+
+def test_block_read_transactions():
+    # no access delay, so no token polls beyond the first: MOSI high,
+    # command, NCR and R1, token, data, CRC, release
+    card, cs = _card(read_us=0)
+    sd = SDCard(card, cs)
+    before = card.transactions
+    sd.readblocks(3, bytearray(512))
+    assert card.transactions - before == 8
+
+
+def test_slow_token_backs_off():
+    card, cs = _card(read_us=20000)
+    sd = SDCard(card, cs, baudrate=8000000)
+    before = card.transactions
+    sd.readblocks(3, bytearray(512))
+    assert card.transactions - before < 250
+
+
+def test_autotune_stops_below_corruption():
+    card, cs = _card(max_baudrate=12000000)
+    sd = SDCard(card, cs, crc=True)
+    assert sd.autotune(8191) == 12000000
+    assert sd.baudrate == card.baudrate == 12000000
+    data = _pattern(2, 11)
+    sd.writeblocks(30, data)
+    out = bytearray(1024)
+    sd.readblocks(30, out)
+    assert out == data
+
+
+def test_autotune_keeps_init_rate_if_nothing_passes():
+    card, cs = _card(max_baudrate=3000000)
+    sd = SDCard(card, cs, crc=True)
+    assert sd.autotune(8191) == 1320000
+    assert card.baudrate == 1320000
+
+
+def test_autotune_needs_crc():
+    card, cs = _card()
+    sd = SDCard(card, cs)
+    blocks = card.data_blocks
+    try:
+        sd.autotune(8191)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("autotune ran without CRC")
+    assert card.data_blocks == blocks and card.baudrate == 1320000
+
+
+def test_autotune_refuses_filesystem_blocks():
+    # a partition, and a volume without partition table, covering 8191
+    mbr = bytearray(512)
+    mbr[446 + 4] = 0x0C
+    mbr[446 + 8:446 + 16] = struct.pack("<II", 2048, 6144)
+    mbr[510:512] = b"\x55\xaa"
+    boot = bytearray(512)
+    boot[0:3] = b"\xeb\x58\x90"
+    struct.pack_into("<HBHBHHBH", boot, 11, 512, 8, 32, 2, 0, 8192, 0xF8, 0)
+    boot[510:512] = b"\x55\xaa"
+    for block0 in (mbr, boot):
+        card, cs = _card()
+        sd = SDCard(card, cs, crc=True)
+        sd.writeblocks(0, block0)
+        before = card.blocks.get(8191)
+        try:
+            sd.autotune(8191)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("autotune wrote inside the filesystem")
+        assert card.blocks.get(8191) == before and card.baudrate == 1320000
+
+
+def test_autotune_survives_failed_latency_measurement():
+    card, cs = _card()
+    sd = SDCard(card, cs, crc=True)
+    init = card.init
+
+    def init_then_fail(*args, **kwargs):
+        # every data block corrupted once the clock starts changing
+        init(*args, **kwargs)
+        card.flaky = 1
+    card.init = init_then_fail
+    assert sd.autotune(8191) == 1320000
+    assert sd.baudrate == card.baudrate == 1320000
+    assert sd.read_us is None and sd.write_us is None
+
+
+def test_autotune_limit():
+    card, cs = _card()
+    sd = SDCard(card, cs, crc=True)
+    assert sd.autotune(8191, max_baudrate=10000000) == 10000000
+
+
+def test_card_profile():
+    card, cs = _card(read_us=200, write_us=800)
+    sd = SDCard(card, cs, crc=True)
+    assert sd.csd_version == 2
+    assert bytes(sd.cid) == FakeSDCard.CID
+    assert sd.read_us is None
+    sd.autotune(8191)
+    # access time plus the block on the bus at 25 MHz
+    assert 200 < sd.read_us < 1000
+    assert 800 < sd.write_us < 2000
+
+
+def test_init_follows_card_readiness():
+    for init_us in (1000, 5000, 20000, 100000):
+        card, cs = _card(init_us=init_us)
+        sd = SDCard(card, cs)
+        # sub-millisecond polls at first, never more than 8 ms apart
+        assert init_us // 1000 <= sd.init_ms <= init_us // 1000 + 10
+        assert card.commands.count(141) < 20
+
+
+def test_begin_and_poll_do_not_block():
+    card, cs = _card(init_us=30000)
+    start = clock.ticks_us()
+    sd = SDCard(card, cs, wait=False)
+    assert not sd.ready
+    assert clock.ticks_us() - start < 20000
+    # nothing goes to the card until the next ACMD41 is due
+    before = card.transactions
+    assert not sd.poll()
+    assert card.transactions == before
+    polls = 0
+    while not sd.poll():
+        clock.advance_us(700)  # bringing up something else
+        polls += 1
+    assert sd.ready and sd.poll()
+    assert 30 <= sd.init_ms <= 40
+    sd.writeblocks(3, _pattern(1))
+    out = bytearray(512)
+    sd.readblocks(3, out)
+    assert out == _pattern(1)
+
+
+def test_late_polls_count_as_polled_time():
+    # the first poll comes after seconds of bringing up other devices
+    card, cs = _card(init_us=20000)
+    sd = SDCard(card, cs, wait=False)
+    clock.advance_us(3000000)
+    assert sd.poll()
+    assert sd.init_ms <= 15
+    # a card still initialising by then gets the whole timeout
+    card, cs = _card(init_us=2500000)
+    sd = SDCard(card, cs, wait=False)
+    clock.advance_us(2400000)
+    assert not sd.poll()
+    sd.finish()
+    assert sd.ready
+    assert 100 <= sd.init_ms <= 125
+
+
+def test_init_timeout():
+    card, cs = _card(init_us=10000000)
+    try:
+        SDCard(card, cs)
+    except OSError as e:
+        assert "timeout waiting for v2 card" in str(e)
+    else:
+        raise AssertionError("card never got ready")
+
+
+def test_v1_card():
+    card, cs = _card(version=1)
+    sd = SDCard(card, cs)
+    assert sd.cdv == 512
+    sd.writeblocks(9, _pattern(1, 2))
+    assert card.blocks[9] == _pattern(1, 2)
+
+
+def test_crc_tables():
+    for frame in (b"\x40\x00\x00\x00\x00", b"\x48\x00\x00\x01\xaa", os.urandom(5)):
+        assert sdcard._crc7(frame) == crc7(frame)
+    assert sdcard._crc7(b"\x40\x00\x00\x00\x00") == 0x95
+    data = os.urandom(512)
+    assert sdcard.crc16(data) == crc16(data)
+    assert sdcard.crc16(memoryview(data)[100:200]) == crc16(data[100:200])
+
+
+def test_crc_mode_round_trip():
+    card, cs = _card()
+    sd = SDCard(card, cs, crc=True)
+    assert card.crc_on
+    data = _pattern(4, 13)
+    sd.writeblocks(10, data[:512])
+    sd.writeblocks(11, data[512:])
+    out = bytearray(len(data))
+    sd.readblocks(10, out)
+    assert out == data
+    assert (sd.read_crc_errors, sd.write_errors, sd.retries) == (0, 0, 0)
+
+
+def test_corrupted_blocks_are_retried():
+    card, cs = _card()
+    sd = SDCard(card, cs, crc=True)
+    data = _pattern(8, 17)
+    card.flaky = 5
+    sd.writeblocks(20, data[:512])
+    sd.writeblocks(21, data[512:])
+    out = bytearray(512)
+    sd.readblocks(20, out)
+    assert out == data[:512]
+    out = bytearray(len(data))
+    sd.readblocks(20, out)
+    card.flaky = 0
+    assert out == data
+    assert bytes(card.blocks[27]) == data[-512:]
+    assert sd.write_errors == card.crc_errors > 0
+    assert sd.read_crc_errors > 0
+    assert sd.retries == sd.write_errors + sd.read_crc_errors
+
+
+def test_streamed_write_resumes_after_rejected_block():
+    card, cs = _card()
+    sd = SDCard(card, cs, crc=True)
+    card.flaky = 3
+    data = _pattern(6, 19)
+    writer = sd.open_writer(40, 6)
+    writer.write(data)
+    writer.close()
+    card.flaky = 0
+    out = bytearray(len(data))
+    sd.readblocks(40, out)
+    assert out == data
+    assert sd.write_errors == 2
+    assert card.commands.count(25) == 3
+
+
+def test_persistent_errors_raise():
+    card, cs = _card(max_baudrate=4000000)
+    sd = SDCard(card, cs, crc=True, retries=2)
+    sd.init_spi(8000000)
+    for op, args in ((sd.writeblocks, (5, _pattern(1))), (sd.writeblocks, (5, _pattern(3))),
+                     (sd.readblocks, (5, bytearray(512)))):
+        try:
+            op(*args)
+        except OSError:
+            pass
+        else:
+            raise AssertionError("{} passed on a corrupting bus".format(op.__name__))
+    assert sd.retries == 3 * 2
+    # the card is still usable at a rate it copes with
+    sd.init_spi(4000000)
+    sd.writeblocks(5, _pattern(1, 1))
+    out = bytearray(512)
+    sd.readblocks(5, out)
+    assert out == _pattern(1, 1)
+
+
+def test_crc_catches_what_autotune_would_miss():
+    # without CRC, corruption above the card's limit passes unnoticed
+    card, cs = _card(max_baudrate=4000000)
+    sd = SDCard(card, cs)
+    sd.init_spi(8000000)
+    sd.writeblocks(5, _pattern(1))
+    sd.init_spi(4000000)
+    out = bytearray(512)
+    sd.readblocks(5, out)
+    assert out != _pattern(1)
+    assert sd.write_errors == 0
+
+
+def bench_crc(blocks=64, baudrate=8000000):
+    # CPU cost of the CRC, and the retry cost on a bus corrupting one block
+    # in 20.
+    data = _pattern(1)
+    start = time.perf_counter()
+    for _ in range(100):
+        sdcard.crc16(data)
+    print("crc16 of a block: {:.0f} us on this host".format((time.perf_counter() - start) * 1e4))
+    for crc, flaky in ((False, 0), (True, 0), (True, 20)):
+        card, cs = _card(read_us=100, write_us=300, flaky=flaky)
+        sd = SDCard(card, cs, baudrate=baudrate, crc=crc)
+        start = clock.ticks_us()
+        writer = sd.open_writer(100, blocks)
+        for i in range(blocks):
+            writer.write(data)
+        writer.close()
+        out = bytearray(8 * 512)
+        for i in range(0, blocks, 8):
+            sd.readblocks(100 + i, out)
+        elapsed = clock.ticks_us() - start
+        print("crc={!s:5} flaky={:2d}: {:6.1f} us per block written and read, {} retries".format(
+            crc, flaky, elapsed / blocks, sd.retries))
+
+
+def bench_init():
+    # Time to initialise cards needing 1 to 200 ms after the first ACMD41,
+    # against the fixed 50 ms sleep before every ACMD41 this replaced.
+    for init_us in (1000, 5000, 20000, 60000, 200000):
+        card, cs = _card(init_us=init_us)
+        sd = SDCard(card, cs)
+        fixed_ms = (init_us // 50000 + 1) * 50
+        print("card ready after {:3d} ms: init_ms {:3d} with {:2d} ACMD41, fixed 50 ms polling >= {:3d} ms".format(
+            init_us // 1000, sd.init_ms, card.commands.count(141), fixed_ms))
+
+
+def bench_transactions(rounds=20, baudrate=8000000):
+    # SPI transactions and time per operation, card answering reads after
+    # 100 us and programming blocks in 300 us.
+    def read1(sd, i):
+        sd.readblocks(i, bytearray(512))
+
+    def read8(sd, i):
+        sd.readblocks(i * 8, bytearray(8 * 512))
+
+    def write1(sd, i):
+        sd.writeblocks(i, _pattern(1))
+
+    def write8(sd, i):
+        sd.writeblocks(i * 8, _pattern(8))
+
+    for name, op, blocks in (("read 1", read1, 1), ("read 8", read8, 8),
+                             ("write 1", write1, 1), ("write 8", write8, 8)):
+        card, cs = _card(read_us=100, write_us=300)
+        sd = SDCard(card, cs, baudrate=baudrate)
+        before = card.transactions
+        start = clock.ticks_us()
+        for i in range(rounds):
+            op(sd, i)
+        elapsed = clock.ticks_us() - start
+        print("{:8}: {:5.1f} SPI transactions per block, {:6.1f} us per block".format(
+            name, (card.transactions - before) / rounds / blocks, elapsed / rounds / blocks))
+
+
+def bench_write_behind(blocks=50, work_us=2000):
+    # One block per loop, with 2 ms of sensor work between writes, on a card
+    # programming for 1.5 ms: the time the loop spends blocked on the card.
+    for write_behind in (False, True):
+        card, cs = _card(write_us=1500)
+        sd = SDCard(card, cs, baudrate=8000000, write_behind=write_behind)
+        data = _pattern(1)
+        start = clock.ticks_us()
+        for i in range(blocks):
+            sd.writeblocks(100 + i, data)
+            clock.advance_us(work_us)
+        sd.flush()
+        elapsed = clock.ticks_us() - start - blocks * work_us
+        print("write_behind={!s:5}: {:5.2f} ms per block blocked, {:5.2f} ms waiting for busy, "
+              "histogram {}, {} done before checked".format(
+                  write_behind, elapsed / blocks / 1000, sd.busy_wait_us / blocks / 1000,
+                  list(sd.busy_histogram), sd.busy_unmeasured))
+
+
+def bench_throughput(kib=256, baudrate=8000000, write_us=300):
+    # Sustained write rate of a log going to consecutive blocks, on a card
+    # programming each block in 300 us.
+    blocks = kib * 2
+    for batch in (1, 8, 32, None):
+        card, cs = _card(write_us=write_us)
+        sd = SDCard(card, cs, baudrate=baudrate, write_behind=True)
+        data = _pattern(batch or 1)
+        transactions = card.transactions
+        start = clock.ticks_us()
+        if batch is None:
+            writer = sd.open_writer(100, blocks)
+            for i in range(blocks):
+                writer.write(data)
+            writer.close()
+        else:
+            for i in range(0, blocks, batch):
+                sd.writeblocks(100 + i, data)
+        sd.flush()
+        elapsed = clock.ticks_us() - start
+        print("{:>14}: {:6.1f} KiB/s, {:4.1f} SPI transfers per block".format(
+            "stream" if batch is None else "writeblocks x{}".format(batch),
+            kib * 1e6 / elapsed, (card.transactions - transactions) / blocks))
+
+
+if __name__ == "__main__":
+    for name, func in sorted(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print("ok", name)
+    bench_init()
+    bench_transactions()
+    bench_write_behind()
+    bench_throughput()
+    bench_crc()